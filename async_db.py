@@ -0,0 +1,47 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import manager as m
+
+# SQLite calls are run on their own threads so they never block the bot's event loop
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="database")
+
+
+async def run(function, *args):
+    """
+    Runs a blocking database function on the database threads and returns its result.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(function, *args))
+
+
+async def get_catalog() -> tuple[list[tuple[int, str]], list[tuple[int, int, str]]]:
+    return await run(m.get_catalog)
+
+
+async def get_user_lectures(user_id: str) -> list[tuple[int, str]]:
+    return await run(m.get_user_lectures, user_id)
+
+
+async def toggle_lecture_notification(lecture_id: str, user_id: str) -> bool:
+    return await run(m.toggle_lecture_notification, lecture_id, user_id)
+
+
+async def changes_since(
+    seq: int, limit: int = 1000, lecture_id: str = None
+) -> list[tuple]:
+    return await run(m.changes_since, seq, limit, lecture_id)
+
+
+async def get_last_change_seq() -> int:
+    return await run(m.get_last_change_seq)
+
+
+async def claim_outbox(limit: int) -> list[tuple]:
+    return await run(m.claim_outbox, limit)
+
+
+async def finish_outbox(
+    results: list[tuple[int, str, str | None]], max_attempts: int
+) -> None:
+    return await run(m.finish_outbox, results, max_attempts)
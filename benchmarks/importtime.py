@@ -0,0 +1,102 @@
+"""
+Measures how long importing main.py takes with "python -X importtime" and fails if it
+goes over a budget, or if a module that should only be loaded by the scrapers was imported.
+
+    python benchmarks/importtime.py --budget 5000
+
+The environment has to be configured like it is for running the bot (see .env.example).
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# These take seconds to import and are only needed once a scraper starts
+HEAVY_MODULES = (
+    "torch",
+    "torchvision",
+    "selenium",
+    "cv2",
+    "numpy",
+    "PIL",
+    "sklearn",
+    "matplotlib",
+)
+
+
+def measure(module: str) -> tuple[int, list[tuple[str, int, int]]]:
+    """
+    Imports "module" in a fresh interpreter, returns its cumulative import time and
+    (name, self, cumulative) for every module it imported, in microseconds.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        sys.exit(f"Importing {module} failed:\n{result.stderr}")
+    total = None
+    modules = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name, self_us, cumulative_us = (
+            fields[2].strip(),
+            int(fields[0]),
+            int(fields[1]),
+        )
+        modules.append((name, self_us, cumulative_us))
+        # The module itself is the last to finish importing
+        if name == module:
+            total = cumulative_us
+    return total, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--module", default="main", help="Module to import")
+    parser.add_argument(
+        "--budget", type=float, default=5000, help="Maximum import time in milliseconds"
+    )
+    parser.add_argument("--top", type=int, default=15, help="How many modules to list")
+    parser.add_argument(
+        "--runs", type=int, default=3, help="The fastest of this many runs is used"
+    )
+    args = parser.parse_args()
+
+    total, modules = min(
+        (measure(args.module) for _ in range(args.runs)), key=lambda x: x[0]
+    )
+    total /= 1000
+
+    print(f"Importing {args.module} took {total:.0f} ms (budget {args.budget:.0f} ms).")
+    print("Slowest modules by self time:")
+    for name, self_us, cumulative_us in sorted(modules, key=lambda x: -x[1])[
+        : args.top
+    ]:
+        print(
+            f"  {self_us / 1000:8.1f} ms self {cumulative_us / 1000:8.1f} ms cumulative  {name}"
+        )
+
+    failed = False
+    heavy = sorted({name.split(".")[0] for name, _, _ in modules} & set(HEAVY_MODULES))
+    if heavy:
+        print(
+            f"Modules that should be imported lazily were imported: {', '.join(heavy)}"
+        )
+        failed = True
+    if total > args.budget:
+        print(f"Over the budget by {total - args.budget:.0f} ms.")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
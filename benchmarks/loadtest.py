@@ -0,0 +1,711 @@
+"""
+Load test for the whole system, without touching the real OBS or Telegram.
+
+Runs a fake OBS (login page with equation CAPTCHAs made from ocr/testdata, the popup
+form, the menu and an exam results page whose grades change on a schedule) and a fake
+Telegram Bot API, then runs N accounts through Manager and the bot with M subscribers.
+Reports the poll throughput, how long it takes for a grade change to reach the
+subscribers, how much memory and CPU the bot and its browsers use and how long it takes
+to shut down.
+
+    python benchmarks/loadtest.py --accounts 4 --subscribers 200 --duration 900
+
+Firefox and geckodriver have to be installed, like they are for running the bot.
+Everything else (database, accounts, logs) is created in a temporary directory.
+"""
+
+import argparse
+import asyncio
+import glob
+import html
+import json
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from dataclasses import dataclass, field
+
+import cv2
+import numpy as np
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BOT_TOKEN = "123456:loadtest"
+# Where the digits are placed on the CAPTCHA, same as in ocr/solver.py
+CAPTCHA_SIZE = (28, 130)
+CAPTCHA_POSITIONS = (5, 45)
+CAPTCHA_TOP = 7
+
+
+class CaptchaFactory:
+    """
+    Composes equation CAPTCHAs like the ones on OBS out of the labelled digit
+    images in ocr/testdata (named "label_date.png").
+    """
+
+    def __init__(self, folder: str, seed: int = None):
+        self.random = random.Random(seed)
+        self.digits: list[tuple[int, np.ndarray]] = []
+        # The images were saved after the solver blurred and eroded them, which would be
+        # done a second time, so the digits are thinned and moved back by a pixel first
+        kernel = np.ones((2, 2), np.uint8)
+        shift = np.float32([[1, 0, -1], [0, 1, -1]])
+        for path in sorted(glob.glob(f"{folder}/*.png")):
+            label = int(os.path.basename(path).split("_")[0])
+            digit = cv2.dilate(cv2.imread(path), kernel)
+            digit = cv2.warpAffine(
+                digit, shift, digit.shape[1::-1], borderValue=(255, 255, 255)
+            )
+            self.digits.append((label, digit))
+        if not self.digits:
+            raise ValueError(f'No CAPTCHA images found in "{folder}".')
+
+    def create(self) -> tuple[bytes, int]:
+        """
+        Returns a new CAPTCHA as a PNG and its answer.
+        """
+        image = np.full((*CAPTCHA_SIZE, 3), 255, np.uint8)
+        answer = 0
+        for x in CAPTCHA_POSITIONS:
+            label, digit = self.random.choice(self.digits)
+            height, width = digit.shape[:2]
+            image[CAPTCHA_TOP : CAPTCHA_TOP + height, x : x + width] = digit
+            answer += label
+        cv2.putText(image, "+", (33, 23), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
+        cv2.putText(image, "= ?", (78, 23), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
+        _, png = cv2.imencode(".png", image)
+        return png.tobytes(), answer
+
+
+@dataclass
+class Session:
+    username: str = None
+    captcha_answer: int = None
+
+
+@dataclass
+class Stats:
+    pages: int = 0
+    logins: int = 0
+    failed_logins: int = 0
+    changes: list[tuple[float, str, str]] = field(default_factory=list)
+
+
+class FakeOBS:
+    """
+    Serves just enough of OBS for the scraper to log in and read the exam results.
+    Every account has its own lectures, one exam result of a random account changes every
+    "change_interval" seconds. Like the real site, the session ends after "session_timeout"
+    seconds on the results page, so the scraper has to log in again on every poll.
+    """
+
+    def __init__(
+        self,
+        accounts: list[dict],
+        lectures: int,
+        exams: int,
+        change_interval: float,
+        session_timeout: float,
+        captchas: CaptchaFactory,
+        seed: int = None,
+    ):
+        self.random = random.Random(seed)
+        self.change_interval = change_interval
+        self.session_timeout = session_timeout
+        self.captchas = captchas
+        self.sessions: dict[str, Session] = {}
+        self.stats = Stats()
+        self.changing = True
+        self.passwords = {a["username"]: a["password"] for a in accounts}
+        # Exam results of every account as {username: [{"name", "exams": [...]}]}
+        self.results = {
+            a["username"]: [
+                {
+                    "name": f"LOADTEST {i:03d}-{j:02d}",
+                    "exams": [
+                        {"name": f"Sinav {k + 1}", "percentage": "%40", "date": "-"}
+                        for k in range(exams)
+                    ],
+                }
+                for j in range(lectures)
+            ]
+            for i, a in enumerate(accounts)
+        }
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/", self.index)
+        app.router.add_post("/login", self.login)
+        app.router.add_get("/captcha.png", self.captcha)
+        app.router.add_get("/results", self.exam_results)
+        app.router.add_get("/logout", self.logout)
+        return app
+
+    def session(self, request: web.Request) -> tuple[str, Session]:
+        session_id = request.cookies.get("session")
+        if session_id not in self.sessions:
+            session_id = uuid.uuid4().hex
+            self.sessions[session_id] = Session()
+        return session_id, self.sessions[session_id]
+
+    def page(self, session_id: str, body: str) -> web.Response:
+        self.stats.pages += 1
+        response = web.Response(
+            text=f"<!DOCTYPE html><html><head><title>OBS</title></head><body>{body}</body></html>",
+            content_type="text/html",
+        )
+        response.set_cookie("session", session_id)
+        return response
+
+    async def index(self, request: web.Request) -> web.Response:
+        session_id, session = self.session(request)
+        if session.username is None:
+            return self.page(session_id, self.login_page())
+        return self.page(session_id, self.main_page())
+
+    async def login(self, request: web.Request) -> web.Response:
+        session_id, session = self.session(request)
+        form = await request.post()
+        username = form.get("OtherUsername")
+        try:
+            captcha = int(form.get("Captcha", ""))
+        except ValueError:
+            captcha = None
+        if (
+            username in self.passwords
+            and self.passwords[username] == form.get("OtherPassword")
+            and captcha is not None
+            and captcha == session.captcha_answer
+        ):
+            session.username = username
+            self.stats.logins += 1
+        else:
+            self.stats.failed_logins += 1
+        session.captcha_answer = None
+        raise web.HTTPSeeOther("/")
+
+    async def captcha(self, request: web.Request) -> web.Response:
+        session_id, session = self.session(request)
+        png, session.captcha_answer = self.captchas.create()
+        response = web.Response(body=png, content_type="image/png")
+        response.set_cookie("session", session_id)
+        return response
+
+    async def exam_results(self, request: web.Request) -> web.Response:
+        session_id, session = self.session(request)
+        if session.username is None:
+            raise web.HTTPSeeOther("/")
+        return self.page(session_id, self.results_page(self.results[session.username]))
+
+    async def logout(self, request: web.Request) -> web.Response:
+        _, session = self.session(request)
+        session.username = None
+        raise web.HTTPSeeOther("/")
+
+    async def change_grades(self) -> None:
+        """
+        Changes the result of a random exam every change_interval seconds.
+        """
+        while True:
+            await asyncio.sleep(self.change_interval)
+            if not self.changing:
+                continue
+            lecture = self.random.choice(
+                self.random.choice(list(self.results.values()))
+            )
+            exam = self.random.choice(lecture["exams"])
+            exam["date"] = str(self.random.randint(0, 100))
+            self.stats.changes.append((time.time(), lecture["name"], exam["name"]))
+
+    @staticmethod
+    def filler(count: int) -> str:
+        return "<div></div>" * count
+
+    def login_page(self) -> str:
+        # The scraper finds the CAPTCHA by its XPath, /html/body/div[4]/form/div[4]/img
+        return (
+            self.filler(3)
+            + '<div><form method="post" action="/login">'
+            + '<div><input id="OtherUsername" name="OtherUsername" type="text"></div>'
+            + '<div><input id="OtherPassword" name="OtherPassword" type="password"></div>'
+            + '<div><input id="Captcha" name="Captcha" type="text"></div>'
+            + f'<div><img src="/captcha.png?{uuid.uuid4().hex}" style="width:130px;height:28px"></div>'
+            + '<div><button id="btnSend" type="submit">Giris</button></div>'
+            + '<a id="recover" href="#">Sifremi unuttum</a>'
+            + "</form></div>"
+        )
+
+    def main_page(self) -> str:
+        # The menu is /html/body/div[8]/div[1]/ul and the popup form is /html/body/div[16]
+        toggle = "this.nextElementSibling.style.display = 'block'; return false;"
+        menu = (
+            f'<ul><li><a href="#" onclick="{toggle}">Ogrenci</a><ul style="display:none">'
+            + '<li><a href="#">Ders</a></li>'
+            + f'<li><a href="#" onclick="{toggle}">Not</a><ul style="display:none">'
+            + '<li><a href="#">1</a></li><li><a href="#">2</a></li><li><a href="#">3</a></li>'
+            + '<li><a href="/results">Not Listesi</a></li>'
+            + "</ul></li></ul></li></ul>"
+        )
+        popup = (
+            '<div style="display:block"><div>Duyuru</div><div>Duyuru metni</div>'
+            + "<div><div><button onclick=\"this.closest('body > div').style.display = 'none'\">"
+            + "Kapat</button></div></div></div>"
+        )
+        return (
+            '<div style="display:none"></div>'
+            + self.filler(6)
+            + f'<div><div>{menu}</div><div id="column-1"></div></div>'
+            + self.filler(7)
+            + popup
+        )
+
+    def results_page(self, lectures: list[dict]) -> str:
+        # The table is /html/body/div[8]/div[4]/div[5]/form/table/tbody
+        rows = []
+        for lecture in lectures:
+            rows.append(
+                f"<tr><td>{html.escape(lecture['name'])}</td><td></td><td></td>"
+                + '<td class="textC"></td></tr>'
+            )
+            exams = "".join(
+                f"<tr><td>{html.escape(e['name'])}</td><td></td>"
+                + f"<td>{html.escape(e['percentage'])}</td><td>{html.escape(e['date'])}</td></tr>"
+                for e in lecture["exams"]
+            )
+            rows.append(
+                '<tr class="sub-tr" style="display:none"><td></td>'
+                + f"<td><table><tbody>{exams}</tbody></table></td></tr>"
+            )
+        show_all = (
+            "document.querySelectorAll('tr.sub-tr')"
+            + ".forEach(function (tr) { tr.style.display = 'table-row'; })"
+        )
+        return (
+            self.filler(7)
+            + "<div>"
+            + self.filler(3)
+            + "<div>"
+            + f'<div><button id="btnToggle" onclick="{show_all}">Tumunu ac</button></div>'
+            + self.filler(3)
+            + '<div><form><table id="confirmationReport-list"><tbody>'
+            + "".join(rows)
+            + "</tbody></table></form></div>"
+            + "</div></div>"
+            + f"<script>setTimeout(function () {{ location.href = '/logout'; }}, {int(self.session_timeout * 1000)});</script>"
+        )
+
+
+class FakeTelegram:
+    """
+    Answers the Bot API calls the bot makes and records the messages it sends.
+    More than "rate_limit" messages in a second are answered with 429 like Telegram does.
+    """
+
+    def __init__(self, rate_limit: int, delay: float):
+        self.rate_limit = rate_limit
+        self.delay = delay
+        self.messages: list[tuple[float, str, str]] = []
+        self.rate_limited = 0
+        self.window = (0, 0)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+    @staticmethod
+    def ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        data = dict(await request.post()) if request.can_read_body else {}
+        if method == "getme":
+            return self.ok(
+                {
+                    "id": 123456,
+                    "is_bot": True,
+                    "first_name": "Load",
+                    "username": "loadtest_bot",
+                }
+            )
+        if method == "getupdates":
+            await asyncio.sleep(min(float(data.get("timeout") or 0), 5))
+            return self.ok([])
+        if method == "sendmessage":
+            return await self.send_message(data)
+        return self.ok(True)
+
+    async def send_message(self, data: dict) -> web.Response:
+        await asyncio.sleep(self.delay)
+        second = int(time.time())
+        start, count = self.window
+        if start != second:
+            start, count = second, 0
+        self.window = (start, count + 1)
+        if self.rate_limit and count >= self.rate_limit:
+            self.rate_limited += 1
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                },
+                status=429,
+            )
+        self.messages.append((time.time(), str(data["chat_id"]), data["text"]))
+        return self.ok(
+            {
+                "message_id": len(self.messages),
+                "date": int(time.time()),
+                "chat": {"id": int(data["chat_id"]), "type": "private"},
+                "text": data["text"],
+            }
+        )
+
+
+def run_servers(apps: list[tuple[web.Application, int]]) -> asyncio.AbstractEventLoop:
+    """
+    Serves the apps on 127.0.0.1 from an event loop on a background thread.
+    """
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    async def serve():
+        for app, port in apps:
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", port).start()
+        started.set()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(serve())
+        loop.run_forever()
+
+    threading.Thread(target=run, name="fake-servers", daemon=True).start()
+    started.wait()
+    return loop
+
+
+def notified_exams(text: str) -> list[tuple[str, str]]:
+    """
+    Returns the (lecture_name, exam_name) pairs a notification message is about.
+    """
+    pairs = re.findall(r"<b>(.*?)</b> dersinde <b>(.*?)</b>", text)
+    pairs += re.findall(r"• <b>(.*?)</b> / <b>(.*?)</b>", text)
+    return [(html.unescape(lecture), html.unescape(exam)) for lecture, exam in pairs]
+
+
+def percentile(values: list[float], percent: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def descendants(pid: int) -> list[int]:
+    """
+    Returns the ids of every process started by "pid", like the browsers and geckodrivers.
+    """
+    children: dict[int, list[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as file:
+                # The name can contain spaces, the fields after it can't
+                ppid = int(file.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    result, stack = [], [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            result.append(child)
+            stack.append(child)
+    return result
+
+
+def process_usage(pid: int) -> tuple[int, float]:
+    """
+    Returns the resident memory in bytes and the CPU time in seconds of a process.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as file:
+            fields = file.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/statm") as file:
+            pages = int(file.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return 0, 0
+    ticks = os.sysconf("SC_CLK_TCK")
+    # utime and stime are the 14th and 15th fields of /proc/<pid>/stat
+    cpu = (int(fields[11]) + int(fields[12])) / ticks
+    return pages * os.sysconf("SC_PAGE_SIZE"), cpu
+
+
+def latencies(
+    changes: list[tuple[float, str, str]],
+    subscribers: dict[str, list[str]],
+    messages: list[tuple[float, str, str]],
+) -> tuple[list[float], int]:
+    """
+    Matches every grade change with the first message about it each subscriber of the
+    lecture got afterwards. Returns the latencies and how many were never delivered.
+    """
+    deliveries: dict[tuple[str, str, str], list[float]] = {}
+    for received, chat_id, text in messages:
+        for lecture, exam in notified_exams(text):
+            deliveries.setdefault((chat_id, lecture, exam), []).append(received)
+    result, missing = [], 0
+    for changed, lecture, exam in changes:
+        for chat_id in subscribers.get(lecture, []):
+            times = deliveries.get((chat_id, lecture, exam), [])
+            i = bisect_left(times, changed)
+            if i < len(times):
+                result.append(times[i] - changed)
+            else:
+                missing += 1
+    return result, missing
+
+
+async def run(
+    args, scrapers, obs: FakeOBS, telegram_api: FakeTelegram, subscribers
+) -> dict:
+    import lifecycle
+    import metrics
+    import telegram
+    from global_variables import SHUTDOWN_TIMEOUT
+
+    bot = asyncio.create_task(telegram.start())
+    await telegram.started.wait()
+    start_time = time.time()
+    await asyncio.to_thread(scrapers.start)
+
+    pid = os.getpid()
+    samples = []
+    stop_changes = start_time + args.duration - args.drain
+    while time.time() - start_time < args.duration:
+        await asyncio.sleep(1)
+        if time.time() >= stop_changes:
+            obs.changing = False
+        own = process_usage(pid)
+        children = [process_usage(child) for child in descendants(pid)]
+        samples.append(
+            (
+                own[0],
+                sum(rss for rss, _ in children),
+                own[1],
+                sum(cpu for _, cpu in children),
+            )
+        )
+    elapsed = time.time() - start_time
+
+    # Shuts down like main.py, the scrapers first and then the bot, which sends what
+    # their last polls queued before it goes away
+    shutdown_start = time.time()
+    scrapers_stopped = await asyncio.to_thread(scrapers.stop, SHUTDOWN_TIMEOUT)
+    bot.cancel()
+    await asyncio.gather(bot, return_exceptions=True)
+    browsers_killed = lifecycle.kill_browsers()
+    shutdown_seconds = time.time() - shutdown_start
+
+    polls = sum(count for _, _, count in metrics.POLL_SECONDS.values.values())
+    poll_time = sum(total for _, total, _ in metrics.POLL_SECONDS.values.values())
+    delays, missing = latencies(obs.stats.changes, subscribers, telegram_api.messages)
+    bot_rss = [s[0] for s in samples]
+    browser_rss = [s[1] for s in samples]
+    return {
+        "accounts": args.accounts,
+        "subscribers": args.subscribers,
+        "duration_seconds": round(elapsed, 1),
+        "polls": polls,
+        "polls_per_minute": round(polls / elapsed * 60, 2),
+        "mean_poll_seconds": round(poll_time / polls, 2) if polls else None,
+        "pages_served": obs.stats.pages,
+        "logins": obs.stats.logins,
+        "failed_logins": obs.stats.failed_logins,
+        "grade_changes": len(obs.stats.changes),
+        "messages_sent": len(telegram_api.messages),
+        "messages_rate_limited": telegram_api.rate_limited,
+        "notifications_delivered": len(delays),
+        "notifications_missing": missing,
+        "latency_seconds": {
+            "p50": percentile(delays, 50),
+            "p90": percentile(delays, 90),
+            "p99": percentile(delays, 99),
+            "max": max(delays) if delays else None,
+        },
+        "bot_rss_mb": {
+            "mean": round(sum(bot_rss) / len(bot_rss) / 2**20, 1) if bot_rss else None,
+            "peak": round(max(bot_rss, default=0) / 2**20, 1),
+        },
+        "browser_rss_mb": {
+            "mean": (
+                round(sum(browser_rss) / len(browser_rss) / 2**20, 1)
+                if browser_rss
+                else None
+            ),
+            "peak": round(max(browser_rss, default=0) / 2**20, 1),
+        },
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "bot_cpu_seconds": round(samples[-1][2], 1) if samples else None,
+        "browser_cpu_seconds": round(samples[-1][3], 1) if samples else None,
+        "shutdown_seconds": round(shutdown_seconds, 1),
+        "scrapers_stopped_in_time": scrapers_stopped,
+        "browsers_killed": browsers_killed,
+        "database_mb": round(
+            os.path.getsize(os.environ["SQL_DATABASE_PATH"]) / 2**20, 2
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--accounts", type=int, default=2, help="How many accounts are scraped"
+    )
+    parser.add_argument(
+        "--subscribers", type=int, default=100, help="How many users follow lectures"
+    )
+    parser.add_argument(
+        "--follows",
+        type=int,
+        default=5,
+        help="How many lectures every subscriber follows",
+    )
+    parser.add_argument("--lectures", type=int, default=10, help="Lectures per account")
+    parser.add_argument("--exams", type=int, default=3, help="Exams per lecture")
+    parser.add_argument(
+        "--duration", type=float, default=600, help="Length of the test in seconds"
+    )
+    parser.add_argument(
+        "--interval", type=int, default=60, help="INTERVAL of the scrapers in seconds"
+    )
+    parser.add_argument(
+        "--change-interval",
+        type=float,
+        default=10,
+        help="Seconds between grade changes",
+    )
+    parser.add_argument(
+        "--drain",
+        type=float,
+        default=None,
+        help="Grades stop changing this many seconds before the end, defaults to two intervals",
+    )
+    parser.add_argument(
+        "--session-timeout",
+        type=float,
+        default=None,
+        help="Seconds until OBS logs the scraper out, defaults to half the interval",
+    )
+    parser.add_argument(
+        "--telegram-rate-limit",
+        type=int,
+        default=30,
+        help="Messages per second, 0 for no limit",
+    )
+    parser.add_argument(
+        "--telegram-delay", type=float, default=0.05, help="Seconds every message takes"
+    )
+    parser.add_argument("--obs-port", type=int, default=8090)
+    parser.add_argument("--telegram-port", type=int, default=8091)
+    parser.add_argument(
+        "--workdir",
+        help="Where the database and logs go, a temporary directory by default",
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+    if args.drain is None:
+        args.drain = 2 * args.interval
+    if args.session_timeout is None:
+        args.session_timeout = args.interval / 2
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="loadtest_")
+    os.makedirs(workdir, exist_ok=True)
+    accounts = [
+        {
+            "label": f"Loadtest {i:03d}",
+            "username": f"user{i:03d}",
+            "password": "password",
+        }
+        for i in range(args.accounts)
+    ]
+    with open(f"{workdir}/accounts.json", "w", encoding="utf-8") as file:
+        json.dump(accounts, file)
+
+    obs = FakeOBS(
+        accounts,
+        args.lectures,
+        args.exams,
+        args.change_interval,
+        args.session_timeout,
+        CaptchaFactory(f"{ROOT}/ocr/testdata", args.seed),
+        args.seed,
+    )
+    telegram_api = FakeTelegram(args.telegram_rate_limit, args.telegram_delay)
+    loop = run_servers(
+        [(obs.app(), args.obs_port), (telegram_api.app(), args.telegram_port)]
+    )
+    asyncio.run_coroutine_threadsafe(obs.change_grades(), loop)
+
+    os.environ.update(
+        {
+            "OBS_LOGIN_URL": f"http://127.0.0.1:{args.obs_port}/",
+            "SQL_DATABASE_PATH": f"{workdir}/results.db",
+            "ACCOUNTS_JSON_PATH": f"{workdir}/accounts.json",
+            "INTERVAL": str(args.interval),
+            "LOG_DIR": f"{workdir}/logs",
+            "LOG_MODE": "file",
+            "BOT_TOKEN": BOT_TOKEN,
+            "BOT_MODE": "polling",
+            "BOT_API_URL": f"http://127.0.0.1:{args.telegram_port}",
+            "METRICS_PORT": "",
+        }
+    )
+    # The scrapers can't open windows on a server
+    os.environ.setdefault("MOZ_HEADLESS", "1")
+    os.chdir(ROOT)
+    # Reads its configuration from the environment when it is imported
+    import manager
+
+    scrapers = manager.Manager()
+    # The lectures are created up front, so that the subscribers can follow them
+    # and only the grades changed during the test are notified
+    for account in accounts:
+        manager.upsert_data(account["label"], obs.results[account["username"]])
+    lectures = manager.get_catalog()[1]
+    subscriber_random = random.Random(args.seed)
+    subscribers: dict[str, list[str]] = {}
+    for user_id in range(1, args.subscribers + 1):
+        for lecture_id, _, name in subscriber_random.sample(
+            lectures, min(args.follows, len(lectures))
+        ):
+            manager.add_lecture_notification(lecture_id, str(user_id))
+            subscribers.setdefault(name, []).append(str(user_id))
+
+    print(
+        f"Running {args.accounts} accounts and {args.subscribers} subscribers for {args.duration:.0f} seconds, files are in {workdir}."
+    )
+    report = asyncio.run(run(args, scrapers, obs, telegram_api, subscribers))
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Replays recorded polls (see recording.py) without a browser, to profile the scraper's
+page handling, the CAPTCHA solver and the result extraction offline, and to check that
+changes to them still read the recorded pages the same way.
+
+    python benchmarks/replay.py recordings/ --rounds 20 --output replay.json
+
+Every archive is replayed "rounds" times. Fails if any step came out differently from
+the recording. The environment has to be configured like it is for running the bot
+(see .env.example), lxml and cssselect have to be installed.
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def find_archives(paths: list[str]) -> list[str]:
+    archives = []
+    for path in paths:
+        if os.path.isdir(path):
+            archives.extend(sorted(glob.glob(os.path.join(glob.escape(path), "*.zip"))))
+        else:
+            archives.append(path)
+    return archives
+
+
+def run(archives: list[str], rounds: int) -> dict:
+    import recording
+
+    # The first replay loads the OCR model, it isn't counted
+    for path in archives[:1]:
+        recording.replay(path)
+
+    seconds = {"page": 0.0, "captcha": 0.0, "results": 0.0}
+    steps = 0
+    mismatches = {}
+    start_time = time.perf_counter()
+    for _ in range(rounds):
+        for path in archives:
+            report = recording.replay(path)
+            steps += report["steps"]
+            for kind, value in report["seconds"].items():
+                seconds[kind] += value
+            if report["mismatches"]:
+                mismatches[path] = report["mismatches"]
+    elapsed = time.perf_counter() - start_time
+    replays = rounds * len(archives)
+    return {
+        "archives": len(archives),
+        "replays": replays,
+        "steps": steps,
+        "seconds": round(elapsed, 3),
+        "replays_per_minute": round(replays / elapsed * 60, 1) if elapsed else None,
+        "mean_milliseconds": {
+            kind: round(value / replays * 1000, 3) for kind, value in seconds.items()
+        },
+        "mismatches": mismatches,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded polls offline.")
+    parser.add_argument(
+        "paths", nargs="+", help="Archives, or folders of archives, to replay"
+    )
+    parser.add_argument("--rounds", type=int, default=10, help="Replays per archive")
+    parser.add_argument("--output", help="Also write the report into this JSON file")
+    args = parser.parse_args()
+
+    archives = find_archives(args.paths)
+    if not archives:
+        parser.error("No archives found.")
+    report = run(archives, args.rounds)
+    print(json.dumps(report, indent=4, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=4, ensure_ascii=False)
+    sys.exit(1 if report["mismatches"] else 0)
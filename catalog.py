@@ -0,0 +1,72 @@
+import threading
+from dataclasses import dataclass, field
+import async_db as db
+from global_variables import get_logger
+
+logger = get_logger("catalog")
+
+
+@dataclass
+class CatalogSnapshot:
+    """
+    The departments and lectures in the database at one point in time, sorted by name.
+    """
+
+    departments: list[tuple[int, str]]
+    department_names: dict[int, str]
+    lectures: dict[int, list[tuple[int, str]]]
+    lecture_names: dict[int, str]
+    # Anything derived from the catalog (like the bot's keyboards) can be cached here,
+    # it is thrown away together with the snapshot
+    cache: dict = field(default_factory=dict)
+
+
+class Catalog:
+    """
+    A read-through cache for the departments and lectures the bot shows.
+    The catalog only changes when upsert_data creates a new department or lecture,
+    which calls invalidate(). It can be called from any thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.snapshot: CatalogSnapshot = None
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.version += 1
+            self.snapshot = None
+
+    async def get(self) -> CatalogSnapshot:
+        snapshot = self.snapshot
+        if snapshot is not None:
+            return snapshot
+        with self.lock:
+            version = self.version
+        logger.info("Loading the catalog.")
+        departments, lectures = await db.get_catalog()
+        snapshot = build_snapshot(departments, lectures)
+        with self.lock:
+            # Don't keep the snapshot if it was invalidated while it was being loaded
+            if self.version == version:
+                self.snapshot = snapshot
+        return snapshot
+
+
+def build_snapshot(
+    departments: list[tuple[int, str]], lectures: list[tuple[int, int, str]]
+) -> CatalogSnapshot:
+    departments = sorted(departments, key=lambda x: x[1])
+    lectures_by_department = {id: [] for id, _ in departments}
+    for id, department_id, name in sorted(lectures, key=lambda x: x[2]):
+        lectures_by_department.setdefault(department_id, []).append((id, name))
+    return CatalogSnapshot(
+        departments=departments,
+        department_names=dict(departments),
+        lectures=lectures_by_department,
+        lecture_names={id: name for id, _, name in lectures},
+    )
+
+
+cache = Catalog()
@@ -0,0 +1,137 @@
+import random
+import threading
+import time
+from typing import Literal
+from urllib.parse import urlparse
+from global_variables import get_logger
+import metrics
+
+logger = get_logger("circuit")
+
+# How many failures in a row open the circuit
+FAILURE_THRESHOLD = 5
+# How long the circuit stays open the first time, doubled every time the probe fails, in seconds
+BASE_DELAY = 5
+MAX_DELAY = 600
+# How long a probe can take before another scraper is allowed to probe instead, in seconds
+PROBE_TIMEOUT = 120
+# How often scrapers waiting on an open circuit check it again at most, in seconds
+CHECK_INTERVAL = 10
+
+
+def backoff(attempt: int) -> float:
+    """
+    Returns how long to wait before the given retry, doubling every time up to MAX_DELAY.
+    Half of it is random, so the scrapers don't all retry at the same moment.
+    """
+    delay = min(MAX_DELAY, BASE_DELAY * 2 ** max(0, attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class CircuitBreaker:
+    """
+    Stops every scraper of a host from sending requests while it is down.
+
+    Closed: requests go through, FAILURE_THRESHOLD failures in a row open the circuit.
+    Open: nobody sends requests until the backoff is over, then the circuit is half open.
+    Half open: a single scraper probes the host, success closes the circuit and failure
+    opens it again with twice the backoff.
+    """
+
+    def __init__(self, host: str):
+        self.host = host
+        self.lock = threading.Lock()
+        self.state: Literal["closed", "open", "half_open"] = "closed"
+        self.failures = 0
+        # How many times the circuit was opened since it was last closed
+        self.opened = 0
+        self.open_until = 0.0
+        self.prober: int = None
+        self.probe_started = 0.0
+        self.state_since = time.monotonic()
+
+    def account(self, now: float) -> None:
+        metrics.CIRCUIT_STATE_SECONDS.inc(
+            now - self.state_since, host=self.host, state=self.state
+        )
+        self.state_since = now
+
+    def transition(self, state: str, now: float) -> None:
+        self.account(now)
+        logger.info(f'Circuit of "{self.host}" went from {self.state} to {state}.')
+        self.state = state
+
+    def acquire(self) -> float:
+        """
+        Returns 0 if the calling scraper can send requests, otherwise how long it should
+        wait before asking again.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.account(now)
+            if self.state == "closed":
+                return 0
+            if self.state == "open":
+                if now < self.open_until:
+                    return min(CHECK_INTERVAL, self.open_until - now)
+                self.transition("half_open", now)
+                self.prober = None
+            # A single probe at a time, the others wait for its outcome
+            if self.prober == threading.get_ident():
+                return 0
+            if self.prober is None or now - self.probe_started > PROBE_TIMEOUT:
+                self.prober = threading.get_ident()
+                self.probe_started = now
+                return 0
+            return random.uniform(1, 2)
+
+    def wait(self, stopped: threading.Event) -> bool:
+        """
+        Blocks while the calling scraper isn't allowed to send requests. Returns False if
+        "stopped" was set in the meantime.
+        """
+        while True:
+            delay = self.acquire()
+            if delay <= 0:
+                return True
+            if stopped.wait(delay):
+                return False
+
+    def record_success(self) -> None:
+        with self.lock:
+            if self.state != "closed":
+                self.transition("closed", time.monotonic())
+            self.failures = 0
+            self.opened = 0
+            self.prober = None
+
+    def record_failure(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.failures += 1
+            # Requests that were already under way when it opened don't count again
+            if self.state == "open":
+                return
+            if self.state == "half_open" or self.failures >= FAILURE_THRESHOLD:
+                self.opened += 1
+                self.open_until = now + backoff(self.opened)
+                self.prober = None
+                self.transition("open", now)
+                logger.warning(
+                    f'"{self.host}" failed {self.failures} times in a row, pausing requests for {self.open_until - now:.0f} seconds.'
+                )
+
+
+breakers: dict[str, CircuitBreaker] = {}
+breakers_lock = threading.Lock()
+
+
+def get(url: str) -> CircuitBreaker:
+    """
+    Returns the circuit breaker of the host of the URL, shared by every scraper.
+    """
+    host = urlparse(url).netloc or url
+    with breakers_lock:
+        if host not in breakers:
+            breakers[host] = CircuitBreaker(host)
+        return breakers[host]
@@ -0,0 +1,389 @@
+"""
+Dumps, backs up and restores the results database while the bot is running.
+
+    python export.py dump dumps/today --format jsonl
+    python export.py backup backups/results.db
+    python export.py restore dumps/today restored.db
+
+Dumps hold a file per table and the schema. All tables are read in a single transaction,
+so they are consistent with each other, and in batches, so they never have to fit in
+memory. "parquet" needs pyarrow, which isn't installed with the bot. In CSV files an empty
+value of a column that can be NULL stands for NULL. The AUTOINCREMENT counters are kept in
+sequences.json, so a restored database never hands out an id that was used before, e.g.
+an ExamHistory seq its readers have already seen.
+
+The database is SQL_DATABASE_PATH unless --database is given.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+import time
+
+# How many rows are read and written at a time
+BATCH_SIZE = 5000
+# How many pages a backup step copies, the scrapers can write between steps
+BACKUP_PAGES = 1024
+BACKUP_SLEEP = 0.01
+# How often a backup reports its progress at most, in seconds
+PROGRESS_INTERVAL = 1
+FORMATS = ("csv", "jsonl", "parquet")
+SCHEMA_FILE = "schema.sql"
+SEQUENCES_FILE = "sequences.json"
+
+
+def default_database() -> str:
+    # Only imported when needed, it sets up the bot's logging
+    from global_variables import SQL_DATABASE_PATH
+
+    return SQL_DATABASE_PATH
+
+
+def connect(path: str) -> sqlite3.Connection:
+    return sqlite3.connect(path, timeout=30)
+
+
+def list_tables(conn: sqlite3.Connection) -> list[str]:
+    return [
+        row[0]
+        for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        )
+    ]
+
+
+def table_columns(conn: sqlite3.Connection, table: str) -> list[tuple[str, str, bool]]:
+    """
+    Returns (name, declared type, whether it can be NULL) for every column of the table.
+    """
+    return [
+        (name, type.upper(), not notnull)
+        for _, name, type, notnull, _, _ in conn.execute(
+            f'PRAGMA table_info("{table}")'
+        )
+    ]
+
+
+def stream_rows(conn: sqlite3.Connection, table: str):
+    """
+    Yields the rows of the table in batches of BATCH_SIZE.
+    """
+    cursor = conn.execute(f'SELECT * FROM "{table}" ORDER BY rowid')
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        yield rows
+    cursor.close()
+
+
+def write_csv(path: str, columns: list[str], batches) -> int:
+    count = 0
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        for rows in batches:
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+
+def write_jsonl(path: str, columns: list[str], batches) -> int:
+    count = 0
+    with open(path, "w", encoding="utf-8") as file:
+        for rows in batches:
+            file.writelines(
+                json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n"
+                for row in rows
+            )
+            count += len(rows)
+    return count
+
+
+def python_type(type: str) -> type:
+    """
+    Returns the Python type of a declared column type, following SQLite's affinity rules.
+    """
+    if "INT" in type:
+        return int
+    if "REAL" in type or "FLOA" in type or "DOUB" in type:
+        return float
+    return str
+
+
+def arrow_schema(columns: list[tuple[str, str, bool]]):
+    import pyarrow as pa
+
+    arrow_types = {int: pa.int64(), float: pa.float64(), str: pa.string()}
+    return pa.schema(
+        [(name, arrow_types[python_type(type)]) for name, type, _ in columns]
+    )
+
+
+def write_parquet(path: str, columns: list[tuple[str, str, bool]], batches) -> int:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = arrow_schema(columns)
+    count = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for rows in batches:
+            writer.write_batch(
+                pa.RecordBatch.from_arrays(
+                    [
+                        pa.array(column, schema.field(i).type)
+                        for i, column in enumerate(zip(*rows))
+                    ],
+                    schema=schema,
+                )
+            )
+            count += len(rows)
+    return count
+
+
+def read_sequences(conn: sqlite3.Connection) -> dict[str, int]:
+    """
+    Returns the last id every AUTOINCREMENT table handed out, by table.
+    """
+    if conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_sequence'"
+    ).fetchone():
+        return dict(conn.execute("SELECT name, seq FROM sqlite_sequence"))
+    return {}
+
+
+def dump(
+    database: str, output: str, format: str, tables: list[str] = None
+) -> dict[str, int]:
+    """
+    Writes the tables and the schema of the database into the output folder and returns
+    how many rows every table had.
+    """
+    os.makedirs(output, exist_ok=True)
+    conn = connect(database)
+    # A read transaction sees the database as it was when it started, the scrapers
+    # can keep writing in the meantime since the database is in WAL mode
+    conn.execute("BEGIN")
+    counts = {}
+    try:
+        with open(os.path.join(output, SCHEMA_FILE), "w", encoding="utf-8") as file:
+            for (sql,) in conn.execute(
+                "SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY type = 'index', name"
+            ):
+                file.write(f"{sql};\n")
+        tables = tables or list_tables(conn)
+        with open(os.path.join(output, SEQUENCES_FILE), "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    name: seq
+                    for name, seq in read_sequences(conn).items()
+                    if name in tables
+                },
+                file,
+                indent=4,
+            )
+        for table in tables:
+            columns = table_columns(conn, table)
+            names = [name for name, _, _ in columns]
+            path = os.path.join(output, f"{table}.{format}")
+            batches = stream_rows(conn, table)
+            if format == "csv":
+                counts[table] = write_csv(path, names, batches)
+            elif format == "jsonl":
+                counts[table] = write_jsonl(path, names, batches)
+            else:
+                counts[table] = write_parquet(path, columns, batches)
+            print(f"{table}: {counts[table]} rows", file=sys.stderr)
+    finally:
+        conn.rollback()
+        conn.close()
+    return counts
+
+
+def backup(
+    database: str, output: str, pages: int = BACKUP_PAGES, sleep: float = BACKUP_SLEEP
+) -> None:
+    """
+    Copies the database with SQLite's backup API, a few pages at a time so that the
+    scrapers are never locked out for long. The copy is consistent even if they write.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    temporary_path = f"{output}.tmp"
+    source = connect(database)
+    target = sqlite3.connect(temporary_path)
+
+    last_report = 0.0
+
+    def progress(status, remaining, total):
+        nonlocal last_report
+        # A step is only BACKUP_PAGES pages, large databases take thousands of them
+        now = time.monotonic()
+        if remaining and now - last_report < PROGRESS_INTERVAL:
+            return
+        last_report = now
+        print(f"Copied {total - remaining}/{total} pages", file=sys.stderr)
+
+    try:
+        source.backup(target, pages=pages, progress=progress, sleep=sleep)
+    finally:
+        target.close()
+        source.close()
+    os.replace(temporary_path, output)
+
+
+def read_csv(path: str, columns: list[tuple[str, str, bool]]):
+    # Converted here, SQLite doesn't always parse floats back to the exact same value
+    types = {name: (type, null) for name, type, null in columns}
+
+    def converter(name: str):
+        type, can_be_null = types.get(name, ("", True))
+        convert = python_type(type)
+        return lambda value: None if value == "" and can_be_null else convert(value)
+
+    with open(path, "r", encoding="utf-8", newline="") as file:
+        reader = csv.reader(file)
+        names = next(reader)
+        converters = [converter(name) for name in names]
+        batch = []
+        for row in reader:
+            batch.append([convert(value) for convert, value in zip(converters, row)])
+            if len(batch) >= BATCH_SIZE:
+                yield names, batch
+                batch = []
+        if batch:
+            yield names, batch
+
+
+def read_jsonl(path: str, columns: list[tuple[str, str, bool]]):
+    names = [name for name, _, _ in columns]
+    with open(path, "r", encoding="utf-8") as file:
+        batch = []
+        for line in file:
+            entry = json.loads(line)
+            batch.append([entry.get(name) for name in names])
+            if len(batch) >= BATCH_SIZE:
+                yield names, batch
+                batch = []
+        if batch:
+            yield names, batch
+
+
+def read_parquet(path: str, columns: list[tuple[str, str, bool]]):
+    import pyarrow.parquet as pq
+
+    file = pq.ParquetFile(path)
+    for batch in file.iter_batches(batch_size=BATCH_SIZE):
+        yield batch.schema.names, list(
+            zip(*(column.to_pylist() for column in batch.columns))
+        )
+
+
+def restore(dump_folder: str, database: str, format: str = None) -> dict[str, int]:
+    """
+    Creates a new database from a dump and returns how many rows every table got. The
+    tables are filled before the indexes are created, in a single transaction.
+    """
+    if os.path.exists(database):
+        raise FileExistsError(f'"{database}" already exists, restore into a new file.')
+    with open(os.path.join(dump_folder, SCHEMA_FILE), "r", encoding="utf-8") as file:
+        statements = [s.strip() for s in file.read().split(";\n") if s.strip()]
+    conn = connect(database)
+    # Nothing else uses the new database until it is complete
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    counts = {}
+    try:
+        tables = [s for s in statements if s.upper().startswith("CREATE TABLE")]
+        others = [s for s in statements if s not in tables]
+        for statement in tables:
+            conn.execute(statement)
+        for table in list_tables(conn):
+            columns = table_columns(conn, table)
+            formats = [format] if format else FORMATS
+            paths = [os.path.join(dump_folder, f"{table}.{f}") for f in formats]
+            path = next((p for p in paths if os.path.exists(p)), None)
+            if path is None:
+                continue
+            reader = {"csv": read_csv, "jsonl": read_jsonl, "parquet": read_parquet}[
+                path.rsplit(".", 1)[1]
+            ]
+            counts[table] = 0
+            for names, rows in reader(path, columns):
+                placeholders = ", ".join("?" for _ in names)
+                quoted = ", ".join(f'"{name}"' for name in names)
+                conn.executemany(
+                    f'INSERT INTO "{table}" ({quoted}) VALUES ({placeholders})', rows
+                )
+                counts[table] += len(rows)
+            print(f"{table}: {counts[table]} rows", file=sys.stderr)
+        sequences_path = os.path.join(dump_folder, SEQUENCES_FILE)
+        if os.path.exists(sequences_path):
+            with open(sequences_path, "r", encoding="utf-8") as file:
+                sequences: dict[str, int] = json.load(file)
+            # Inserting the rows only counted up to the largest id that is left
+            for table, seq in sequences.items():
+                if table in counts:
+                    conn.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table,))
+                    conn.execute(
+                        "INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)",
+                        (table, seq),
+                    )
+        for statement in others:
+            conn.execute(statement)
+        conn.commit()
+        conn.execute("PRAGMA journal_mode=WAL")
+    except BaseException:
+        conn.close()
+        # Half a database is worse than none, the restore can just be run again
+        os.remove(database)
+        raise
+    conn.close()
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Dump, back up and restore the results database."
+    )
+    source = argparse.ArgumentParser(add_help=False)
+    source.add_argument(
+        "--database", help="Database to read, SQL_DATABASE_PATH by default"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    dump_parser = commands.add_parser(
+        "dump", parents=[source], help="Write every table into a folder"
+    )
+    dump_parser.add_argument("output", help="Folder to write the tables into")
+    dump_parser.add_argument("--format", choices=FORMATS, default="jsonl")
+    dump_parser.add_argument("--tables", nargs="+", help="Only these tables")
+
+    backup_parser = commands.add_parser(
+        "backup", parents=[source], help="Copy the database while it is in use"
+    )
+    backup_parser.add_argument("output", help="Path of the copy")
+    backup_parser.add_argument(
+        "--pages", type=int, default=BACKUP_PAGES, help="Pages copied per step"
+    )
+
+    restore_parser = commands.add_parser(
+        "restore", help="Create a database from a dump"
+    )
+    restore_parser.add_argument("dump", help="Folder written by the dump command")
+    restore_parser.add_argument("output", help="Path of the new database")
+    restore_parser.add_argument(
+        "--format", choices=FORMATS, help="Format of the dump, found out by default"
+    )
+
+    args = parser.parse_args()
+    start_time = time.perf_counter()
+    if args.command == "dump":
+        dump(args.database or default_database(), args.output, args.format, args.tables)
+    elif args.command == "backup":
+        backup(args.database or default_database(), args.output, args.pages)
+    else:
+        restore(args.dump, args.output, args.format)
+    print(f"Done in {time.perf_counter() - start_time:.2f} seconds.", file=sys.stderr)
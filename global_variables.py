@@ -1,40 +1,199 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import queue
 import time
 import os
 from os import getenv
-from dotenv import load_dotenv
+from dotenv import dotenv_values, find_dotenv, load_dotenv
 
-load_dotenv()
+ENV_PATH = find_dotenv()
+load_dotenv(ENV_PATH)
 
 OBS_LOGIN_URL = getenv("OBS_LOGIN_URL")
 TRAIN_DATA_FOLDER = getenv("TRAIN_DATA_FOLDER")
 TEST_DATA_FOLDER = getenv("TEST_DATA_FOLDER")
+OCR_PIPELINE = getenv("OCR_PIPELINE", "segment")
+OCR_MODEL_PATH = getenv("OCR_MODEL_PATH", "ocr_model.pth")
+OCR_SERVER_SOCKET = getenv("OCR_SERVER_SOCKET")
+OCR_SERVER_ENABLED = getenv("OCR_SERVER_ENABLED", "false").lower() == "true"
+SAMPLES_FOLDER = getenv("SAMPLES_FOLDER", "ocr/samples")
+SAMPLES_MAX = int(getenv("SAMPLES_MAX", "20000"))
+FINETUNE_ENABLED = getenv("FINETUNE_ENABLED", "false").lower() == "true"
+FINETUNE_INTERVAL = int(getenv("FINETUNE_INTERVAL", "3600"))
+FINETUNE_MIN_SAMPLES = int(getenv("FINETUNE_MIN_SAMPLES", "200"))
+FINETUNE_EPOCHS = int(getenv("FINETUNE_EPOCHS", "5"))
 SQL_DATABASE_PATH = getenv("SQL_DATABASE_PATH")
 ACCOUNTS_JSON_PATH = getenv("ACCOUNTS_JSON_PATH")
+SITES_JSON_PATH = getenv("SITES_JSON_PATH")
+RECORD_FOLDER = getenv("RECORD_FOLDER")
 INTERVAL = int(getenv("INTERVAL"))
+CONFIG_CHECK_INTERVAL = int(getenv("CONFIG_CHECK_INTERVAL", "5"))
+SHUTDOWN_TIMEOUT = int(getenv("SHUTDOWN_TIMEOUT", "30"))
 LOG_DIR = getenv("LOG_DIR")
 LOG_MODE = getenv("LOG_MODE")
 BOT_TOKEN = getenv("BOT_TOKEN")
+BOT_MODE = getenv("BOT_MODE", "polling")
+BOT_API_URL = getenv("BOT_API_URL")
+WEBHOOK_URL = getenv("WEBHOOK_URL")
+WEBHOOK_PATH = getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = getenv("WEBHOOK_SECRET")
+METRICS_HOST = getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(getenv("METRICS_PORT") or 0)
+TRACE_ENABLED = getenv("TRACE_ENABLED", "false").lower() == "true"
+PROFILE_ENABLED = getenv("PROFILE_ENABLED", "false").lower() == "true"
+TRACE_DIR = getenv("TRACE_DIR", "traces")
+TRACE_DUMP_INTERVAL = int(getenv("TRACE_DUMP_INTERVAL", "300"))
+
+LOG_LEVEL = getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = getenv("LOG_LEVELS", "")
+LOG_FORMAT = getenv("LOG_FORMAT", "text")
+LOG_ROTATION = getenv("LOG_ROTATION", "none")
+LOG_MAX_BYTES = int(getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_ROTATION_WHEN = getenv("LOG_ROTATION_WHEN", "midnight")
+LOG_BACKUP_COUNT = int(getenv("LOG_BACKUP_COUNT", "10"))
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats every record as a single line of JSON.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records in a queue for the listener thread to format and write.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The arguments are merged in right away since they could change before the
+        # listener gets to them, everything else (tracebacks too) is left to the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Returns the logger of a module. Its level can be set separately with LOG_LEVELS,
+    e.g. LOG_LEVELS="scraper=WARNING,ocr.solver=DEBUG".
+    """
+    return logging.getLogger(f"main_logger.{name}")
+
 
 execution_time = time.strftime("%Y-%m-%d_%H-%M-%S")
-log_formatter = logging.Formatter(
-    fmt="%(asctime)s - %(levelname)s - [%(threadName)s]: %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
+if LOG_FORMAT == "json":
+    log_formatter = JsonFormatter(datefmt="%Y-%m-%d %H:%M:%S")
+else:
+    log_formatter = logging.Formatter(
+        fmt="%(asctime)s - %(levelname)s - [%(threadName)s]: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
 
 logger = logging.getLogger("main_logger")
+log_handlers: list[logging.Handler] = []
 
 if LOG_MODE == "file" or LOG_MODE == "both":
     os.makedirs(LOG_DIR, exist_ok=True)
     log_filename = f"{LOG_DIR}/{execution_time}.log"
-    file_handler = logging.FileHandler(log_filename, encoding="utf-8")
-    file_handler.setFormatter(log_formatter)
-    logger.addHandler(file_handler)
+    if LOG_ROTATION == "size":
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_filename,
+            maxBytes=LOG_MAX_BYTES,
+            backupCount=LOG_BACKUP_COUNT,
+            encoding="utf-8",
+        )
+    elif LOG_ROTATION == "time":
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            log_filename,
+            when=LOG_ROTATION_WHEN,
+            backupCount=LOG_BACKUP_COUNT,
+            encoding="utf-8",
+        )
+    else:
+        file_handler = logging.FileHandler(log_filename, encoding="utf-8")
+    log_handlers.append(file_handler)
 
 if LOG_MODE == "terminal" or LOG_MODE == "both":
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(log_formatter)
-    logger.addHandler(stream_handler)
+    log_handlers.append(logging.StreamHandler())
+
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+
+# Records are only put in a queue by the threads that log them,
+# the handlers doing the actual I/O run on the listener's own thread
+log_queue = queue.SimpleQueue()
+logger.addHandler(LogQueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(
+    log_queue, *log_handlers, respect_handler_level=True
+)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# The modules whose level was set with LOG_LEVELS
+module_loggers: list[logging.Logger] = []
+
+
+def apply_log_levels() -> None:
+    logger.setLevel(LOG_LEVEL)
+    for module_logger in module_loggers:
+        module_logger.setLevel(logging.NOTSET)
+    module_loggers.clear()
+    for entry in filter(None, LOG_LEVELS.split(",")):
+        name, level = entry.split("=")
+        module_logger = get_logger(name.strip())
+        module_logger.setLevel(level.strip().upper())
+        module_loggers.append(module_logger)
+
+
+apply_log_levels()
+
+# What .env had the last time it was read
+env_values = dotenv_values(ENV_PATH) if ENV_PATH else {}
+
+
+def reload_config() -> list[str]:
+    """
+    Reads .env again and applies the settings that can be changed while running,
+    INTERVAL, LOG_LEVEL and LOG_LEVELS. Variables set in the environment are only
+    overridden if their line in .env changed. Returns the names of the changed settings.
+    """
+    global env_values, INTERVAL, LOG_LEVEL, LOG_LEVELS
+    values = dotenv_values(ENV_PATH) if ENV_PATH else {}
+    for key, value in values.items():
+        if value is not None and env_values.get(key) != value:
+            os.environ[key] = value
+    env_values = values
+
+    changed = []
+    interval = int(getenv("INTERVAL"))
+    if interval != INTERVAL:
+        INTERVAL = interval
+        changed.append("INTERVAL")
+    log_level = getenv("LOG_LEVEL", "INFO").upper()
+    log_levels = getenv("LOG_LEVELS", "")
+    if log_level != LOG_LEVEL or log_levels != LOG_LEVELS:
+        LOG_LEVEL, LOG_LEVELS = log_level, log_levels
+        apply_log_levels()
+        changed.append("LOG_LEVEL")
+    return changed
+
 
-logger.setLevel(logging.INFO)
 logger.info("Booting up.")
@@ -0,0 +1,118 @@
+import os
+import signal
+import time
+from global_variables import get_logger
+
+logger = get_logger("lifecycle")
+
+# Set in the environment of the geckodriver and Firefox processes the bot starts, to the
+# pid of the bot. The processes started by Firefox inherit it too
+OWNER_VARIABLE = "OBS_BROWSER_OWNER"
+# How long a process gets to exit after SIGTERM before it is killed
+TERMINATE_TIMEOUT = 5
+
+
+def browser_environment() -> dict[str, str]:
+    """
+    Returns the environment to start a browser with, so it is recognised as ours.
+    """
+    return {**os.environ, OWNER_VARIABLE: str(os.getpid())}
+
+
+def list_browsers() -> dict[int, int]:
+    """
+    Returns the browser processes of the current user as {pid: owner}, where the owner is
+    the pid of the bot that started them, read from /proc. Empty where there is no /proc.
+    """
+    browsers = {}
+    try:
+        pids = [int(entry) for entry in os.listdir("/proc") if entry.isdigit()]
+    except FileNotFoundError:
+        return browsers
+    uid = os.getuid()
+    prefix = f"{OWNER_VARIABLE}=".encode()
+    for pid in pids:
+        try:
+            if os.stat(f"/proc/{pid}").st_uid != uid:
+                continue
+            with open(f"/proc/{pid}/environ", "rb") as file:
+                environment = file.read().split(b"\0")
+        except OSError:
+            # The process exited in the meantime
+            continue
+        for variable in environment:
+            owner = variable[len(prefix) :]
+            if variable.startswith(prefix) and owner.isdigit():
+                browsers[pid] = int(owner)
+                break
+    return browsers
+
+
+def is_running(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat", "r") as file:
+            stat = file.read()
+    except OSError:
+        return False
+    if stat[stat.rindex(")") + 2] != "Z":
+        return True
+    # Exited, but our own children stay zombies until they are waited for
+    try:
+        os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        ...
+    return False
+
+
+def terminate(pids: list[int]) -> None:
+    """
+    Sends SIGTERM to the processes and SIGKILL to the ones still running after TERMINATE_TIMEOUT seconds.
+    """
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            ...
+    deadline = time.monotonic() + TERMINATE_TIMEOUT
+    while pids and time.monotonic() < deadline:
+        time.sleep(0.1)
+        pids = [pid for pid in pids if is_running(pid)]
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            ...
+
+
+def reap_orphans() -> int:
+    """
+    Stops the geckodriver and Firefox processes left behind by an earlier run that didn't
+    shut down cleanly, recognised by the bot that started them no longer running. Returns
+    how many were stopped.
+    """
+    browsers = list_browsers()
+    gone = {
+        owner
+        for owner in set(browsers.values())
+        if owner != os.getpid() and not is_running(owner)
+    }
+    pids = [pid for pid, owner in browsers.items() if owner in gone]
+    if pids:
+        logger.warning(
+            f"Stopping {len(pids)} browser processes left behind by an earlier run."
+        )
+        terminate(pids)
+    return len(pids)
+
+
+def kill_browsers() -> int:
+    """
+    Stops the browser processes started by this process that are still running, also
+    the ones that were adopted by another process in the meantime. Returns how many were
+    stopped.
+    """
+    pids = [pid for pid, owner in list_browsers().items() if owner == os.getpid()]
+    if pids:
+        logger.warning(f"Stopping {len(pids)} browser processes that didn't quit.")
+        terminate(pids)
+    return len(pids)
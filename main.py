@@ -1,8 +1,71 @@
 from manager import Manager
+from global_variables import (
+    get_logger,
+    METRICS_HOST,
+    METRICS_PORT,
+    FINETUNE_ENABLED,
+    OCR_SERVER_ENABLED,
+    OCR_SERVER_SOCKET,
+    SHUTDOWN_TIMEOUT,
+)
+from ocr import finetune, server
 import telegram
+import metrics
+import tracing
+import lifecycle
 import asyncio
+import os
+import signal
 
-if __name__ == "__main__":
+logger = get_logger("main")
+
+
+async def main():
     x = Manager()
-    x.start()
-    asyncio.run(telegram.start())
+    stopping = asyncio.Event()
+
+    def on_signal(signum: int):
+        if stopping.is_set():
+            logger.warning("Received a second signal, exiting right away.")
+            os._exit(1)
+        logger.info(f"Received {signal.Signals(signum).name}, shutting down.")
+        stopping.set()
+
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, on_signal, signum)
+
+    bot = asyncio.create_task(telegram.start())
+    started = asyncio.create_task(telegram.started.wait())
+    await asyncio.wait([bot, started], return_when=asyncio.FIRST_COMPLETED)
+    if not bot.done():
+        # The scrapers import Selenium and the OCR model in their own threads,
+        # they are only started once the bot is already answering
+        x.start()
+    stopped = asyncio.create_task(stopping.wait())
+    await asyncio.wait([bot, stopped], return_when=asyncio.FIRST_COMPLETED)
+    started.cancel()
+    stopped.cancel()
+    # The bot only stops by itself if it failed, e.g. with a wrong token
+    crashed = bot.done()
+
+    # The scrapers go first, so the notifications of their last polls are sent by the bot
+    await asyncio.to_thread(x.stop, SHUTDOWN_TIMEOUT)
+    bot.cancel()
+    await asyncio.gather(bot, return_exceptions=True)
+    lifecycle.kill_browsers()
+    logger.info("Shut down.")
+    if crashed:
+        bot.result()
+
+
+if __name__ == "__main__":
+    lifecycle.reap_orphans()
+    if METRICS_PORT:
+        metrics.start_server(METRICS_HOST, METRICS_PORT)
+    tracing.start()
+    if FINETUNE_ENABLED:
+        finetune.start()
+    if OCR_SERVER_ENABLED and OCR_SERVER_SOCKET:
+        server.start()
+    asyncio.run(main())
@@ -1,18 +1,52 @@
 import json
+import math
+import os
 import threading
 import time
-from scraper import Scraper
-from global_variables import logger, SQL_DATABASE_PATH, ACCOUNTS_JSON_PATH, INTERVAL
+from global_variables import (
+    get_logger,
+    SQL_DATABASE_PATH,
+    ACCOUNTS_JSON_PATH,
+    SITES_JSON_PATH,
+    CONFIG_CHECK_INTERVAL,
+)
+import global_variables
 import sqlite3
+from collections import Counter
 from functools import partial
 import telegram
+import catalog
+import circuit
+import metrics
+import recording
+import sites
+import tracing
+
+logger = get_logger("manager")
 
 
 class Manager(object):
-    threads: list[threading.Thread] = []
     lock = threading.Lock()
     accounts: list[dict] = []
-    _ready = False
+    profiles: dict[str, sites.SiteProfile] = {}
+    # The running scrapers by account name, as the thread, the event that stops it, its
+    # account and the profile of its site
+    scrapers: dict[
+        str, tuple[threading.Thread, threading.Event, dict, sites.SiteProfile]
+    ] = {}
+    accounts_mtime: float = None
+    sites_mtime: float = None
+    # What every account saw in its last poll by account name, as
+    # {lecture name: {exam name: (percentage, date)}}
+    snapshots: dict[str, dict[str, dict[str, tuple[str, str]]]] = {}
+    # The polls of the accounts of a department are spread over INTERVAL from this time on
+    anchor: float = None
+    # Set once the process is shutting down
+    stopping = threading.Event()
+    # Keeps the config thread from starting scrapers while they are being stopped
+    config_lock = threading.Lock()
+    # The threads of the scrapers stopped by a reload that haven't exited yet
+    retiring: list[threading.Thread] = []
 
     def __new__(cls):
         if not hasattr(cls, "instance"):
@@ -21,65 +55,401 @@ class Manager(object):
 
     def __init__(self):
         initializeDatabase()
-        self.loadAccounts()
+        self.profiles = self.loadSites()
+        self.accounts = self.loadAccounts()
+        self.anchor = time.time()
 
     def start(self):
-        self.createThreads()
-        while not self._ready:
-            time.sleep(1)
-        self.startThreads()
+        for account in self.accounts:
+            profile = self.getSite(account)
+            if profile is not None:
+                self.startScraper(account, profile)
+        threading.Thread(target=self.watchConfig, name="config", daemon=True).start()
 
-    def loadAccounts(self):
+    def loadAccounts(self) -> list[dict]:
         logger.info("Loading accounts.")
+        mtime = get_mtime(ACCOUNTS_JSON_PATH)
         with open(ACCOUNTS_JSON_PATH, "r", encoding="utf-8") as file:
-            self.accounts = json.load(file)
-
-    def startThreads(self):
-        for thread in self.threads:
-            thread.start()
+            accounts = json.load(file)
+        name_accounts(accounts)
+        self.accounts_mtime = mtime
+        return accounts
+
+    def loadSites(self) -> dict[str, sites.SiteProfile]:
+        mtime = get_mtime(SITES_JSON_PATH)
+        profiles = sites.load_sites()
+        self.sites_mtime = mtime
+        return profiles
+
+    def getSite(self, account: dict) -> sites.SiteProfile | None:
+        """
+        Returns the profile of the site of the account, None if there is no such site.
+        """
+        name = account.get("site", sites.DEFAULT_SITE)
+        if name not in self.profiles:
+            logger.error(f'Unknown site "{name}" of "{account["name"]}", skipping it.')
+            return None
+        return self.profiles[name]
 
-    def createThreads(self):
-        logger.info("Creating threads..")
+    def getGroup(self, account: dict) -> list[str]:
+        """
+        Returns the names of the accounts of the department of the account, i.e. with the
+        same site and label, in the order of the accounts file.
+        """
+        department = department_name(account)
+        return [
+            other["name"]
+            for other in self.accounts
+            if department_name(other) == department
+            and other.get("site", sites.DEFAULT_SITE) in self.profiles
+        ]
+
+    def nextPoll(self, account: dict, after: float) -> float:
+        """
+        Returns when the account should poll next, the first of its slots after "after".
+        The accounts of a department take turns, so a change is seen within
+        INTERVAL / (number of accounts) seconds instead of INTERVAL.
+        """
+        group = self.getGroup(account)
+        index = group.index(account["name"]) if account["name"] in group else 0
+        interval = global_variables.INTERVAL
+        phase = self.anchor + index * interval / max(1, len(group))
+        return phase + (math.floor((after - phase) / interval) + 1) * interval
 
-        def threadTarget(account):
-            logger.info("Executing thread..")
-            scraper = Scraper(
-                account["label"], account["username"], account["password"]
+    def watchConfig(self):
+        """
+        Checks the accounts file, the sites file and .env for changes every
+        CONFIG_CHECK_INTERVAL seconds and applies them without restarting the scrapers
+        that didn't change.
+        """
+        env_mtime = get_mtime(global_variables.ENV_PATH)
+        while not self.stopping.wait(CONFIG_CHECK_INTERVAL):
+            try:
+                mtime = get_mtime(global_variables.ENV_PATH)
+                if mtime != env_mtime:
+                    env_mtime = mtime
+                    changed = global_variables.reload_config()
+                    logger.info(f"Reloaded the configuration, changed: {changed}.")
+                sites_changed = get_mtime(SITES_JSON_PATH) != self.sites_mtime
+                files_changed = (
+                    sites_changed
+                    or get_mtime(ACCOUNTS_JSON_PATH) != self.accounts_mtime
+                )
+                with self.config_lock:
+                    crashed = any(
+                        not thread.is_alive()
+                        for thread, _, _, _ in self.scrapers.values()
+                    )
+                if files_changed or crashed:
+                    # A file that can't be read is tried again until it is fixed
+                    profiles = self.loadSites() if sites_changed else self.profiles
+                    accounts = self.loadAccounts() if files_changed else self.accounts
+                    with self.config_lock:
+                        if self.stopping.is_set():
+                            break
+                        stopped, pending = self.applyAccounts(accounts, profiles)
+                    self.retireScrapers(stopped, pending)
+            except Exception as e:
+                logger.exception(f"Exception while reloading the configuration, {e}")
+
+    def applyAccounts(
+        self, accounts: list[dict], profiles: dict[str, sites.SiteProfile]
+    ) -> tuple[
+        list[tuple[str, threading.Thread]], list[tuple[dict, sites.SiteProfile]]
+    ]:
+        """
+        Tells the scrapers of the accounts that were removed or changed, or whose site
+        changed, to stop and starts the ones of the accounts that were added. Scrapers
+        whose thread died are started again too. Returns the names and threads of the
+        stopped scrapers, and the accounts and profiles of the changed ones, which are
+        started once their old scraper has exited.
+        """
+        self.profiles = profiles
+        wanted = {}
+        for account in accounts:
+            profile = self.getSite(account)
+            if profile is not None:
+                wanted[account["name"]] = (account, profile)
+        stopped = []
+        for name, (thread, _, account, profile) in self.scrapers.items():
+            if not thread.is_alive():
+                logger.warning(f'The scraper of "{name}" died, restarting it.')
+                stopped.append(name)
+            elif wanted.get(name) != (account, profile):
+                stopped.append(name)
+        threads = []
+        for name in stopped:
+            thread, stop, _, _ = self.scrapers.pop(name)
+            stop.set()
+            threads.append((name, thread))
+            self.retiring.append(thread)
+        # The polls in progress are left to finish, so a changed account is never polled
+        # twice at once
+        pending = []
+        for name, (account, profile) in wanted.items():
+            if name in stopped:
+                pending.append((account, profile))
+            elif name not in self.scrapers:
+                self.startScraper(account, profile)
+        self.accounts = accounts
+        return threads, pending
+
+    def retireScrapers(
+        self,
+        stopped: list[tuple[str, threading.Thread]],
+        pending: list[tuple[dict, sites.SiteProfile]],
+    ):
+        """
+        Waits for the stopped scrapers to finish their poll and starts the new scraper of
+        each changed account once its old one has exited. Waits without holding
+        config_lock, so a shutdown doesn't wait for the polls in progress longer than
+        SHUTDOWN_TIMEOUT.
+        """
+        remaining = dict(stopped)
+        replacements = {
+            account["name"]: (account, profile) for account, profile in pending
+        }
+        while remaining and not self.stopping.wait(0.5):
+            for name, thread in list(remaining.items()):
+                if thread.is_alive():
+                    continue
+                del remaining[name]
+                with self.lock:
+                    self.snapshots.pop(name, None)
+                logger.info(f'Stopped the scraper of "{name}".')
+                with self.config_lock:
+                    self.retiring.remove(thread)
+                    if name in replacements and not self.stopping.is_set():
+                        self.startScraper(*replacements[name])
+
+    def stop(self, timeout: float) -> bool:
+        """
+        Stops every scraper after its current poll, quitting its browser, and waits up to
+        "timeout" seconds for them. Returns whether all of them stopped in time.
+        """
+        with self.config_lock:
+            self.stopping.set()
+            scrapers = list(self.scrapers.values())
+            threads = [thread for thread, _, _, _ in scrapers] + list(self.retiring)
+        logger.info(f"Stopping {len(scrapers)} scrapers.")
+        for _, stop, _, _ in scrapers:
+            stop.set()
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        running = [thread.name for thread in threads if thread.is_alive()]
+        if running:
+            logger.warning(
+                f"Scrapers still running after {timeout} seconds: {running}."
             )
+        return not running
+
+    def startScraper(self, account: dict, profile: sites.SiteProfile):
+        logger.info(f'Starting the scraper of "{account["name"]}" on "{profile.name}".')
+        stop = threading.Event()
+        # Stopped through the event on shutdown, being a daemon only matters if one hangs
+        thread = threading.Thread(
+            target=partial(self.runScraper, account, profile, stop),
+            name=account["name"],
+            daemon=True,
+        )
+        self.scrapers[account["name"]] = (thread, stop, account, profile)
+        thread.start()
+
+    def runScraper(
+        self, account: dict, profile: sites.SiteProfile, stop: threading.Event
+    ):
+        logger.info("Executing thread..")
+        # Selenium and the OCR model take seconds to import, so they are only
+        # imported by the scraper threads instead of holding up the bot's start-up
+        from scraper import Scraper
+
+        scraper = Scraper(
+            account["label"],
+            account["username"],
+            account["password"],
+            stopped=stop,
+            site=profile,
+            name=account["name"],
+        )
 
+        try:
             logger.info("Starting scraper..")
             scraper.start()
+            # The first poll is right away unless another account of the department
+            # polls within INTERVAL / (number of accounts) seconds
+            group_size = max(1, len(self.getGroup(account)))
+            first_poll = self.nextPoll(
+                account, time.time() - global_variables.INTERVAL / group_size
+            )
+            if stop.wait(max(0, first_poll - time.time())):
+                return
+            while not stop.is_set():
+                self.poll(scraper, account, stop)
+        except Exception as e:
+            # The config thread starts it again, see applyAccounts
+            logger.exception(f"Exception in the scraper, stopping it. {e}")
+        finally:
+            scraper.stop()
+
+    def poll(self, scraper, account: dict, stop: threading.Event):
+        start_time = time.time()
+        logger.info("Scraping in session..")
+        navigation_seconds = extraction_seconds = upsert_seconds = 0.0
+        try:
+            # Sites can limit how many of their accounts are polled at once
+            with (
+                sites.limit(scraper.site, stop) as allowed,
+                tracing.span("poll", account=scraper.name),
+                recording.record(scraper),
+            ):
+                if not allowed:
+                    return
+                scraper.login_seconds = 0
+                phase_start = time.perf_counter()
+                reached = scraper.navigateSite()
+                navigation_seconds = time.perf_counter() - phase_start
+
+                # Navigation gives up when the scraper is stopped or OBS keeps failing
+                if reached:
+                    phase_start = time.perf_counter()
+                    scraper.extractResults()
+                    extraction_seconds = time.perf_counter() - phase_start
+
+                    phase_start = time.perf_counter()
+                    if scraper.results is not None:
+                        with self.lock:
+                            results = merge_results(
+                                scraper.results, self.snapshots.get(scraper.name, {})
+                            )
+                            upsert_data(department_name(account), results)
+                            # Only once they are saved, a failed save is tried again
+                            # at the next poll
+                            self.snapshots[scraper.name] = snapshot(scraper.results)
+                    upsert_seconds = time.perf_counter() - phase_start
+        except Exception as e:
+            # A results page that changed or a locked database fails this poll only,
+            # the scraper tries again at its next one
+            logger.exception(f"Exception while polling, {e}")
+            circuit.get(scraper.site.login_url).record_failure()
+
+        for phase, seconds in (
+            ("login", scraper.login_seconds),
+            ("navigation", navigation_seconds - scraper.login_seconds),
+            ("extraction", extraction_seconds),
+            ("upsert", upsert_seconds),
+        ):
+            metrics.POLL_PHASE_SECONDS.observe(
+                seconds, account=scraper.name, phase=phase
+            )
 
-            while True:
-                start_time = time.time()
-                logger.info("Scraping in session..")
-                scraper.navigateSite()
-                scraper.extractResults()
+        elapsed_time = time.time() - start_time
+        metrics.POLL_SECONDS.observe(elapsed_time, account=scraper.name)
+        logger.info(
+            "Completed execution in: %.2f seconds, remaining time is: %.2f seconds.",
+            elapsed_time,
+            self.nextPoll(account, start_time) - time.time(),
+        )
 
-                if scraper.results is not None:
-                    with self.lock:
-                        self.upsert_data(scraper.label, scraper.results)
+        # INTERVAL and the department's accounts are read every second, so changes
+        # apply to the wait in progress
+        while time.time() < self.nextPoll(account, start_time):
+            if stop.wait(1):
+                break
+
+
+def department_name(account: dict) -> str:
+    """
+    Returns the name the department of the account is saved under. Departments of sites
+    other than the default one are prefixed with the site, since universities can have
+    departments of the same name.
+    """
+    site = account.get("site", sites.DEFAULT_SITE)
+    if site == sites.DEFAULT_SITE:
+        return account["label"]
+    return f'{site}/{account["label"]}'
+
+
+def name_accounts(accounts: list[dict]) -> None:
+    """
+    Gives every account without a "name" one, used for its thread, browser and metrics.
+    It is the name of its department, with the username added if the department has
+    several accounts.
+    """
+    departments = Counter(department_name(account) for account in accounts)
+    for account in accounts:
+        if "name" not in account:
+            department = department_name(account)
+            account["name"] = (
+                department
+                if departments[department] == 1
+                else f'{department} ({account["username"]})'
+            )
 
-                elapsed_time = time.time() - start_time
-                logger.info(
-                    f"Completed execution in: {elapsed_time:.2f} seconds, remaining time is: {(INTERVAL - elapsed_time):.2f} seconds."
-                )
 
-                while time.time() - start_time < INTERVAL:
-                    time.sleep(1)
+def snapshot(results: list[dict]) -> dict[str, dict[str, tuple[str, str]]]:
+    return {
+        lecture["name"]: {
+            exam["name"]: (exam["percentage"], exam["date"])
+            for exam in lecture["exams"]
+        }
+        for lecture in results
+    }
+
+
+def merge_results(
+    results: list[dict], previous: dict[str, dict[str, tuple[str, str]]]
+) -> list[dict]:
+    """
+    Returns the part of the results of an account that is news: the exams that changed
+    since its previous poll and the lectures and exams it sees for the first time. The
+    accounts of a department can see an exam differently for a while, e.g. when one polls
+    right before the results are announced and the other right after. Without this they
+    would overwrite each other's values and notify the users every time. Whether what an
+    account sees for the first time was already reported is up to upsert_data, which
+    compares it with the database.
+    """
+    merged = []
+    for lecture in results:
+        seen = previous.get(lecture["name"])
+        exams = [
+            exam
+            for exam in lecture["exams"]
+            if seen is None
+            or seen.get(exam["name"]) != (exam["percentage"], exam["date"])
+        ]
+        if exams or seen is None:
+            merged.append({"name": lecture["name"], "exams": exams})
+    return merged
+
+
+def get_mtime(path: str) -> float | None:
+    try:
+        return os.stat(path).st_mtime
+    except (OSError, TypeError):
+        return None
 
-        for account in self.accounts:
-            thread = threading.Thread(
-                target=partial(threadTarget, account), name=account["label"]
-            )
-            self.threads.append(thread)
 
-        self._ready = True
+def db_helper(function):
+    """
+    Records the latency of a database helper in the metrics and the trace.
+    """
+    return tracing.traced(f"db.{function.__name__}")(
+        metrics.timed(metrics.DB_QUERY_SECONDS)(function)
+    )
+
 
+def connect() -> sqlite3.Connection:
+    # Wait for the write lock instead of failing right away while a scraper is writing
+    return sqlite3.connect(SQL_DATABASE_PATH, timeout=30)
 
+
+@db_helper
 def initializeDatabase():
-    conn = sqlite3.connect(SQL_DATABASE_PATH)
+    conn = connect()
     cursor = conn.cursor()
+    # Lets the bot read while the scrapers are writing
+    cursor.execute("PRAGMA journal_mode=WAL")
     cursor.execute(
         """
     CREATE TABLE IF NOT EXISTS Departments (
@@ -110,6 +480,54 @@ def initializeDatabase():
     )"""
     )
 
+    # Exams used to be deleted and inserted again when they changed, leaving duplicates behind
+    cursor.execute(
+        """
+        DELETE FROM Exams WHERE id NOT IN (
+            SELECT MAX(id) FROM Exams GROUP BY lecture_id, name
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_exams_lecture_name
+        ON Exams (lecture_id, name)
+    """
+    )
+
+    # Every version of every exam, in the order they were found. Rows are only ever
+    # appended, and seq never goes back, so readers can follow it with changes_since
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS ExamHistory (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        exam_id INTEGER NOT NULL,
+        lecture_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        percentage TEXT NOT NULL,
+        date TEXT NOT NULL,
+        changed_at REAL NOT NULL,
+        FOREIGN KEY (exam_id) REFERENCES Exams(id),
+        FOREIGN KEY (lecture_id) REFERENCES Lectures(id)
+    )"""
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_exam_history_lecture
+        ON ExamHistory (lecture_id, seq)
+    """
+    )
+    # Databases from before the history start it with the exams they already have
+    cursor.execute(
+        """
+        INSERT INTO ExamHistory (exam_id, lecture_id, name, percentage, date, changed_at)
+        SELECT id, lecture_id, name, percentage, date, ? FROM Exams
+        WHERE NOT EXISTS (SELECT 1 FROM ExamHistory)
+        ORDER BY id
+    """,
+        (time.time(),),
+    )
+
     cursor.execute(
         """
     CREATE TABLE IF NOT EXISTS Notifications (
@@ -120,14 +538,53 @@ def initializeDatabase():
     )"""
     )
 
+    # Remove duplicate notifications so that a user can follow a lecture only once
+    cursor.execute(
+        """
+        DELETE FROM Notifications WHERE id NOT IN (
+            SELECT MIN(id) FROM Notifications GROUP BY lecture_id, user_id
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_notifications_lecture_user
+        ON Notifications (lecture_id, user_id)
+    """
+    )
+
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS Outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        lecture_name TEXT NOT NULL,
+        exam_name TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        updated_at REAL,
+        last_error TEXT
+    )"""
+    )
+
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_outbox_status ON Outbox (status, user_id, id)"
+    )
+
+    # Messages that were being sent when the process died have to be sent again
+    cursor.execute("UPDATE Outbox SET status = 'pending' WHERE status = 'sending'")
+
     conn.commit()
     cursor.close()
     conn.close()
 
 
+@db_helper
 def upsert_data(department_name, lecture_data):
-    conn = sqlite3.connect(SQL_DATABASE_PATH)
+    conn = connect()
     cursor = conn.cursor()
+    catalog_changed = False
     # Ensure department exists
     cursor.execute("SELECT id FROM Departments WHERE name = ?", (department_name,))
     department_row = cursor.fetchone()
@@ -139,7 +596,9 @@ def upsert_data(department_name, lecture_data):
         )
         cursor.execute("INSERT INTO Departments (name) VALUES (?)", (department_name,))
         department_id = cursor.lastrowid
+        catalog_changed = True
 
+    queued_notifications = 0
     for lecture in lecture_data:
         # Ensure lecture exists
         cursor.execute(
@@ -158,40 +617,59 @@ def upsert_data(department_name, lecture_data):
                 (department_id, lecture["name"]),
             )
             lecture_id = cursor.lastrowid
+            catalog_changed = True
 
         for exam in lecture["exams"]:
-            # Check for an exam result with identical values
             cursor.execute(
-                """
-                SELECT id FROM Exams
-                WHERE lecture_id = ? AND name = ? AND percentage = ? AND date = ?
-            """,
-                (lecture_id, exam["name"], exam["percentage"], exam["date"]),
+                "SELECT id, percentage, date FROM Exams WHERE lecture_id = ? AND name = ?",
+                (lecture_id, exam["name"]),
             )
             exam_row = cursor.fetchone()
 
-            if exam_row is None:
+            if exam_row is None or exam_row[1:] != (exam["percentage"], exam["date"]):
                 logger.info(
-                    f'New exam results found for "{lecture["name"]} / {exam["name"]}". Overwriting old ones and sending notifications.'
+                    f'New exam results found for "{lecture["name"]} / {exam["name"]}". Updating them and sending notifications.'
                 )
-                # If none were found, that means new exam results were entered
+                # The row is updated in place, the old values are kept in ExamHistory
+                if exam_row is not None:
+                    exam_id = exam_row[0]
+                    cursor.execute(
+                        "UPDATE Exams SET percentage = ?, date = ? WHERE id = ?",
+                        (exam["percentage"], exam["date"], exam_id),
+                    )
+                else:
+                    cursor.execute(
+                        """
+                        INSERT INTO Exams (lecture_id, name, percentage, date)
+                        VALUES (?, ?, ?, ?)
+                    """,
+                        (lecture_id, exam["name"], exam["percentage"], exam["date"]),
+                    )
+                    exam_id = cursor.lastrowid
                 cursor.execute(
-                    "DELETE FROM Exams WHERE lecture_id = ? AND name = ?",
-                    (lecture_id, exam["name"]),
+                    """
+                    INSERT INTO ExamHistory
+                    (exam_id, lecture_id, name, percentage, date, changed_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                    (
+                        exam_id,
+                        lecture_id,
+                        exam["name"],
+                        exam["percentage"],
+                        exam["date"],
+                        time.time(),
+                    ),
                 )
+                # Queue the notifications in the same transaction as the exam change
                 cursor.execute(
                     """
-                    INSERT INTO Exams (lecture_id, name, percentage, date)
-                    VALUES (?, ?, ?, ?)
+                    INSERT INTO Outbox (user_id, lecture_name, exam_name, created_at)
+                    SELECT user_id, ?, ?, ? FROM Notifications WHERE lecture_id = ?
                 """,
-                    (lecture_id, exam["name"], exam["percentage"], exam["date"]),
-                )
-                user_ids = get_lecture_users(lecture_id=lecture_id)
-                telegram.send_mass_notifications(
-                    user_ids=user_ids,
-                    lecture_name=lecture["name"],
-                    exam_name=exam["name"],
+                    (lecture["name"], exam["name"], time.time(), lecture_id),
                 )
+                queued_notifications += cursor.rowcount
             else:
                 ...
                 # This line cluttered up the logs too much.
@@ -202,49 +680,37 @@ def upsert_data(department_name, lecture_data):
     cursor.close()
     conn.close()
 
+    if catalog_changed:
+        catalog.cache.invalidate()
 
-def get_departments():
-    logger.info("Retrieving department information.")
-    conn = sqlite3.connect(SQL_DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, name FROM Departments")
-    dept_info = cursor.fetchall()
-    conn.commit()
-    cursor.close()
-    conn.close()
-    return dept_info
-
-
-def get_department_name(dept_id: str):
-    logger.info(f'Retrieving department name from department with id: "{dept_id}" .')
-    conn = sqlite3.connect(SQL_DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name FROM Departments WHERE id = ?", dept_id)
-    dept_info = cursor.fetchone()
-    conn.commit()
-    cursor.close()
-    conn.close()
-    return dept_info[0]
+    if queued_notifications:
+        logger.info(f"Queued {queued_notifications} notifications.")
+        telegram.wake_notifications()
 
 
-def get_lectures(dept_id: str):
-    logger.info(
-        f'Retrieving lecture information from department with id: "{dept_id}" .'
-    )
-    conn = sqlite3.connect(SQL_DATABASE_PATH)
+@db_helper
+def get_catalog() -> tuple[list[tuple[int, str]], list[tuple[int, int, str]]]:
+    """
+    Returns every department as (id, name) and every lecture as (id, department_id, name).
+    """
+    logger.debug("Retrieving the catalog.")
+    conn = connect()
     cursor = conn.cursor()
-    cursor.execute("SELECT id, name FROM Lectures WHERE department_id = ?", dept_id)
+    cursor.execute("SELECT id, name FROM Departments")
     dept_info = cursor.fetchall()
+    cursor.execute("SELECT id, department_id, name FROM Lectures")
+    lecture_info = cursor.fetchall()
     conn.commit()
     cursor.close()
     conn.close()
-    return dept_info
+    return dept_info, lecture_info
 
 
+@db_helper
 def add_lecture_notification(lecture_id: str, user_id: str) -> bool:
-    logger.info(f'Adding user notification to lecture with id: "{lecture_id}".')
+    logger.debug('Adding user notification to lecture with id: "%s".', lecture_id)
     try:
-        conn = sqlite3.connect(SQL_DATABASE_PATH)
+        conn = connect()
         cursor = conn.cursor()
         cursor.execute(
             "SELECT id FROM Notifications WHERE lecture_id = ? AND user_id = ?",
@@ -270,87 +736,181 @@ def add_lecture_notification(lecture_id: str, user_id: str) -> bool:
         return False
 
 
-def delete_lecture_notification(lecture_id: str, user_id: str) -> bool:
-    logger.info(f'Deleting user notification to lecture with id: "{lecture_id}".')
-    try:
-        conn = sqlite3.connect(SQL_DATABASE_PATH)
-        cursor = conn.cursor()
+@db_helper
+def toggle_lecture_notification(lecture_id: str, user_id: str) -> bool:
+    """
+    Makes the user follow the lecture if they don't, or stop following it if they do.
+    Returns True if the user follows the lecture afterwards.
+    """
+    logger.debug('Toggling user notification to lecture with id: "%s".', lecture_id)
+    conn = connect()
+    # Take the write lock right away so two taps can't both see the same state
+    conn.isolation_level = "IMMEDIATE"
+    cursor = conn.cursor()
+    cursor.execute(
+        "DELETE FROM Notifications WHERE lecture_id = ? AND user_id = ?",
+        (str(lecture_id), str(user_id)),
+    )
+    followed = cursor.rowcount == 0
+    if followed:
         cursor.execute(
-            "SELECT id FROM Notifications WHERE lecture_id = ? AND user_id = ?",
-            (lecture_id, user_id),
+            "INSERT OR IGNORE INTO Notifications (lecture_id, user_id) VALUES (?, ?)",
+            (str(lecture_id), str(user_id)),
         )
-        department_row = cursor.fetchone()
-        if department_row is not None:
-            cursor.execute(
-                "DELETE FROM Notifications WHERE lecture_id = ? AND user_id = ?",
-                (
-                    str(lecture_id),
-                    str(user_id),
-                ),
-            )
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return True
-    except Exception as e:
-        logger.exception(
-            f'Exception while deleting user notification to lecture with id: "{lecture_id}", {e}'
-        )
-        return False
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return followed
 
 
-def get_lecture_users(lecture_id: str) -> list[str]:
-    logger.info(f'Getting user notifications from lecture with id: "{lecture_id}".')
-    conn = sqlite3.connect(SQL_DATABASE_PATH)
+@db_helper
+def get_user_lectures(user_id: str) -> list[tuple[int, str]]:
+    logger.debug('Getting followed lectures of user with id: "%s".', user_id)
+    conn = connect()
     cursor = conn.cursor()
     cursor.execute(
-        "SELECT user_id FROM Notifications WHERE lecture_id = ?", (str(lecture_id),)
+        """
+        SELECT Lectures.id, Lectures.name FROM Notifications
+        JOIN Lectures ON Lectures.id = Notifications.lecture_id
+        WHERE Notifications.user_id = ?
+        ORDER BY Lectures.name
+    """,
+        (str(user_id),),
     )
-    user_ids = [x[0] for x in cursor.fetchall()]
+    lecture_info = cursor.fetchall()
     conn.commit()
     cursor.close()
     conn.close()
-    return user_ids
+    return lecture_info
 
 
-def get_user_notifications(user_id: str) -> list[str]:
-    logger.info(f'Getting user notifications from user with id: "{user_id}".')
-    conn = sqlite3.connect(SQL_DATABASE_PATH)
+@db_helper
+def changes_since(seq: int, limit: int = 1000, lecture_id: str = None) -> list[tuple]:
+    """
+    Returns up to "limit" exam changes made after "seq", oldest first, as
+    (seq, department_name, lecture_id, lecture_name, exam_name, percentage, date, changed_at)
+    tuples. Pass the seq of the last change returned to get the next ones, 0 to start from
+    the beginning. Only the changes of a single lecture are returned if "lecture_id" is given.
+    """
+    conn = connect()
     cursor = conn.cursor()
+    where = "ExamHistory.seq > ?"
+    parameters = [seq]
+    if lecture_id is not None:
+        where += " AND ExamHistory.lecture_id = ?"
+        parameters.append(str(lecture_id))
     cursor.execute(
-        "SELECT lecture_id FROM Notifications WHERE user_id = ?",
-        (str(user_id),),
+        f"""
+        SELECT ExamHistory.seq, Departments.name, Lectures.id, Lectures.name,
+        ExamHistory.name, ExamHistory.percentage, ExamHistory.date, ExamHistory.changed_at
+        FROM ExamHistory
+        JOIN Lectures ON Lectures.id = ExamHistory.lecture_id
+        JOIN Departments ON Departments.id = Lectures.department_id
+        WHERE {where}
+        ORDER BY ExamHistory.seq LIMIT ?
+    """,
+        parameters + [limit],
     )
-    lecture_info = [x[0] for x in cursor.fetchall()]
+    changes = cursor.fetchall()
     conn.commit()
     cursor.close()
     conn.close()
-    return lecture_info
+    return changes
 
 
-def does_user_follow_lecture(lecture_id: str, user_id: str) -> bool:
-    conn = sqlite3.connect(SQL_DATABASE_PATH)
+@db_helper
+def get_last_change_seq() -> int:
+    """
+    Returns the seq of the latest exam change, to only follow the changes from now on.
+    """
+    conn = connect()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM ExamHistory")
+    seq = cursor.fetchone()[0]
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return seq
+
+
+@db_helper
+def claim_outbox(limit: int) -> list[tuple]:
+    """
+    Marks the pending notifications of up to "limit" users as being sent and returns them
+    as (id, user_id, lecture_name, exam_name) tuples.
+    """
+    conn = connect()
     cursor = conn.cursor()
     cursor.execute(
-        "SELECT id FROM Notifications WHERE lecture_id = ? AND user_id = ?",
-        (str(lecture_id), str(user_id)),
+        """
+        SELECT id, user_id, lecture_name, exam_name FROM Outbox
+        WHERE status = 'pending' AND user_id IN (
+            SELECT user_id FROM Outbox WHERE status = 'pending'
+            GROUP BY user_id ORDER BY MIN(id) LIMIT ?
+        )
+        ORDER BY id
+    """,
+        (limit,),
+    )
+    rows = cursor.fetchall()
+    cursor.executemany(
+        """
+        UPDATE Outbox SET status = 'sending', attempts = attempts + 1, updated_at = ?
+        WHERE id = ?
+    """,
+        [(time.time(), row[0]) for row in rows],
+    )
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return rows
+
+
+@db_helper
+def finish_outbox(
+    results: list[tuple[int, str, str | None]], max_attempts: int
+) -> None:
+    """
+    Records the outcome of sending claimed notifications, given as (id, status, error)
+    tuples where status is either "sent", "retry" or "failed". Notifications to be retried
+    are put back in the queue, unless they have already been tried "max_attempts" times.
+    """
+    now = time.time()
+    conn = connect()
+    cursor = conn.cursor()
+    cursor.executemany(
+        """
+        UPDATE Outbox SET
+        status = CASE
+            WHEN ? = 'retry' AND attempts < ? THEN 'pending'
+            WHEN ? = 'retry' THEN 'failed'
+            ELSE ?
+        END,
+        updated_at = ?, last_error = ? WHERE id = ?
+    """,
+        [
+            (status, max_attempts, status, status, now, error, id)
+            for id, status, error in results
+        ],
     )
-    return_bool = cursor.fetchone() is not None
     conn.commit()
     cursor.close()
     conn.close()
-    return return_bool
 
 
-def get_lecture_name(lecture_id: str) -> str:
-    conn = sqlite3.connect(SQL_DATABASE_PATH)
+@db_helper
+def count_pending_outbox() -> int:
+    conn = connect()
     cursor = conn.cursor()
-    cursor.execute("SELECT name FROM Lectures WHERE id = ?", (str(lecture_id),))
-    lecture_name = cursor.fetchone()
+    cursor.execute("SELECT COUNT(*) FROM Outbox WHERE status = 'pending'")
+    count = cursor.fetchone()[0]
     conn.commit()
     cursor.close()
     conn.close()
-    return lecture_name[0]
+    return count
+
+
+metrics.NOTIFICATION_QUEUE.set_function(count_pending_outbox)
 
 
 if __name__ == "__main__":
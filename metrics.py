@@ -0,0 +1,257 @@
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from global_variables import get_logger
+
+logger = get_logger("metrics")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Metric:
+    """
+    Base class for the metrics, every metric registers itself when it is created.
+    Label values are given as keyword arguments to the methods of the subclasses.
+    """
+
+    type = None
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+        self.values: dict[tuple, object] = {}
+        registry.append(self)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def format_labels(self, key: tuple, extra: dict = None) -> str:
+        pairs = list(zip(self.labelnames, key)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        return (
+            "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+        )
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [f"{self.name}{self.format_labels(k)} {v}" for k, v in values]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self.function = None
+
+    def set(self, value: float, **labels) -> None:
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, function) -> None:
+        """
+        Makes the gauge call the given function for its (unlabeled) value every time it is read.
+        """
+        self.function = function
+
+    def samples(self) -> list[str]:
+        if self.function is not None:
+            try:
+                self.set(self.function())
+            except Exception as e:
+                logger.exception(f'Exception while reading gauge "{self.name}", {e}')
+        with self.lock:
+            values = list(self.values.items())
+        return [f"{self.name}{self.format_labels(k)} {v}" for k, v in values]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            # Bucket counts, sum and count of the observations
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            values = [
+                (k, list(counts), total, count)
+                for k, (counts, total, count) in self.values.items()
+            ]
+        lines = []
+        for key, counts, total, count in values:
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(
+                    f"{self.name}_bucket{self.format_labels(key, {'le': bound})} {bucket_count}"
+                )
+            lines.append(
+                f"{self.name}_bucket{self.format_labels(key, {'le': '+Inf'})} {count}"
+            )
+            lines.append(f"{self.name}_sum{self.format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{self.format_labels(key)} {count}")
+        return lines
+
+
+def timed(histogram: Histogram, **labels):
+    """
+    Decorator that observes how long every call to the decorated function takes.
+    The "function" label is set to the name of the function unless it is given.
+    """
+
+    def decorator(function):
+        function_labels = dict(labels)
+        if "function" in histogram.labelnames:
+            function_labels.setdefault("function", function.__name__)
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**function_labels):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would flood the logs otherwise
+        ...
+
+
+def start_server(host: str, port: int) -> ThreadingHTTPServer:
+    """
+    Serves the metrics in Prometheus' text format at http://host:port/metrics
+    from a background thread.
+    """
+    logger.info(f"Serving metrics on {host}:{port}/metrics.")
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    return server
+
+
+registry: list[Metric] = []
+
+POLL_SECONDS = Histogram(
+    "scraper_poll_seconds",
+    "Time spent on a whole poll of an account",
+    ("account",),
+)
+POLL_PHASE_SECONDS = Histogram(
+    "scraper_poll_phase_seconds",
+    "Time spent on each phase of a poll (login, navigation, extraction, upsert)",
+    ("account", "phase"),
+)
+CAPTCHA_ATTEMPTS = Counter(
+    "captcha_attempts_total",
+    "CAPTCHA solve attempts by outcome (solved, failed, unreadable)",
+    ("account", "outcome"),
+)
+CAPTCHA_SOLVE_SECONDS = Histogram(
+    "captcha_solve_seconds",
+    "Time spent reading a CAPTCHA",
+)
+WEBDRIVER_COMMANDS = Counter(
+    "webdriver_commands_total",
+    "WebDriver round-trips by command",
+    ("account", "command"),
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_seconds",
+    "Time spent in each database helper",
+    ("function",),
+)
+NOTIFICATION_QUEUE = Gauge(
+    "notification_queue_depth",
+    "Notifications waiting in the outbox",
+)
+NOTIFICATION_MESSAGES = Counter(
+    "notification_messages_total",
+    "Notification messages sent to Telegram by outcome (sent, retry, failed)",
+    ("status",),
+)
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds",
+    "Time spent in each bot handler",
+    ("handler",),
+)
+CIRCUIT_STATE_SECONDS = Counter(
+    "circuit_state_seconds_total",
+    "Time the circuit breaker of each host spent in each state (closed, open, half_open)",
+    ("host", "state"),
+)
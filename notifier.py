@@ -0,0 +1,256 @@
+import asyncio
+import time
+from typing import Literal
+from aiogram import Bot, html
+from aiogram.exceptions import (
+    TelegramRetryAfter,
+    TelegramForbiddenError,
+    TelegramBadRequest,
+    TelegramNetworkError,
+)
+from global_variables import get_logger
+import async_db as db
+import metrics
+
+logger = get_logger("notifier")
+
+# Telegram allows roughly 30 messages per second in total and 1 message per second per chat
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+# How many messages can be in flight at the same time
+MAX_CONCURRENCY = 30
+# How many users' notifications are taken from the outbox at once
+BATCH_SIZE = 100
+# How long to wait after being woken up, so that changes arriving together are sent together
+COALESCE_WINDOW = 5
+# How long the text of a message can get before the remaining exams are only counted.
+# Telegram allows 4096 characters, the rest is left for the count
+MAX_TEXT_LENGTH = 4000
+# How many times a notification is tried before it is marked as failed
+MAX_ATTEMPTS = 5
+# How often the outbox is checked when nobody wakes the dispatcher up, in seconds
+POLL_INTERVAL = 30
+
+
+class TokenBucket:
+    """
+    A token bucket for pacing coroutines running on a single event loop.
+    Every call to acquire() takes a token, waiting until one is refilled if the bucket is empty.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self) -> bool:
+        self.refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self) -> None:
+        while True:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class NotificationDispatcher:
+    """
+    Drains the Outbox table on the bot's event loop, respecting Telegram's rate limits.
+    Notifications are written to the outbox by upsert_data, scraper threads then call
+    wake() (which is thread-safe) so they get sent without waiting for the next poll.
+    Every notification is delivered at least once, even if the process dies while sending.
+    """
+
+    def __init__(self, bot: Bot, concurrency: int = MAX_CONCURRENCY):
+        self.bot = bot
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.chat_buckets: dict[str, TokenBucket] = {}
+        self.wakeup = asyncio.Event()
+        # Makes run() exit once the batch it is sending is done
+        self.stopping = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        self.task: asyncio.Task = None
+
+    async def start(self) -> None:
+        logger.info("Starting notification dispatcher.")
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self, timeout: float = 0) -> None:
+        """
+        Stops the dispatcher, first trying to send what is left in the outbox for up to
+        "timeout" seconds. Whatever isn't sent by then is sent after the next start.
+        """
+        logger.info("Stopping notification dispatcher.")
+        deadline = self.loop.time() + timeout
+        self.stopping.set()
+        self.wakeup.set()
+        # The batch being sent is finished rather than cut off, cancelling it could
+        # send some of its messages again after the next start
+        try:
+            await asyncio.wait_for(asyncio.shield(self.task), timeout)
+        except asyncio.TimeoutError:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            if timeout > 0:
+                logger.warning(
+                    f"Couldn't send every notification in {timeout} seconds."
+                )
+            return
+        # Notifications queued while the last batch was being sent
+        try:
+            await asyncio.wait_for(self.drain(), max(0, deadline - self.loop.time()))
+        except asyncio.TimeoutError:
+            logger.warning(f"Couldn't send every notification in {timeout} seconds.")
+        except Exception as e:
+            logger.exception(f"Exception while draining the outbox, {e}")
+
+    def wake(self) -> None:
+        """
+        Makes the dispatcher check the outbox right away. Safe to call from any thread.
+        """
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def run(self) -> None:
+        while not self.stopping.is_set():
+            self.wakeup.clear()
+            try:
+                sent_everything = await self.drain()
+            except Exception as e:
+                logger.exception(f"Exception while draining the outbox, {e}")
+                sent_everything = False
+            # Wait a while before retrying if something went wrong
+            try:
+                if not sent_everything:
+                    await asyncio.wait_for(self.stopping.wait(), POLL_INTERVAL)
+                    continue
+                await asyncio.wait_for(self.wakeup.wait(), POLL_INTERVAL)
+                if not self.stopping.is_set():
+                    await asyncio.wait_for(self.stopping.wait(), COALESCE_WINDOW)
+            except asyncio.TimeoutError:
+                ...
+
+    async def drain(self) -> bool:
+        """
+        Sends pending notifications in batches until the outbox is empty.
+        All pending notifications of a user are combined into a single message.
+        Returns False if some notifications have to be retried.
+        """
+        while True:
+            rows = await db.claim_outbox(BATCH_SIZE)
+            if not rows:
+                return True
+            users: dict[str, list[tuple]] = {}
+            for row in rows:
+                users.setdefault(row[1], []).append(row)
+            logger.info(
+                f"Sending {len(rows)} notifications from the outbox to {len(users)} users."
+            )
+            tasks = [
+                asyncio.ensure_future(
+                    self.send(
+                        user_id,
+                        format_notifications([(row[2], row[3]) for row in user_rows]),
+                    )
+                )
+                for user_id, user_rows in users.items()
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                # If the batch is cancelled the messages that weren't sent are put back
+                # in the queue, instead of staying claimed until the next start
+                outcomes = [
+                    (
+                        task.result()
+                        if task.done()
+                        and not task.cancelled()
+                        and task.exception() is None
+                        else ("retry", "Stopped while sending")
+                    )
+                    for task in tasks
+                ]
+                for status, _ in outcomes:
+                    metrics.NOTIFICATION_MESSAGES.inc(status=status)
+                results = [
+                    (row[0], status, error)
+                    for user_rows, (status, error) in zip(users.values(), outcomes)
+                    for row in user_rows
+                ]
+                await db.finish_outbox(results, MAX_ATTEMPTS)
+            if any(status == "retry" for _, status, _ in results):
+                return False
+
+    def chat_bucket(self, chat_id: str) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Forget about chats that haven't been messaged recently
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets = {
+                    k: v for k, v in self.chat_buckets.items() if not v.is_full()
+                }
+            bucket = TokenBucket(CHAT_RATE, 1)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def send(
+        self, chat_id: str, text: str
+    ) -> tuple[Literal["sent", "retry", "failed"], str | None]:
+        async with self.semaphore:
+            while True:
+                await self.chat_bucket(chat_id).acquire()
+                await self.global_bucket.acquire()
+                try:
+                    await self.bot.send_message(chat_id=chat_id, text=text)
+                    return "sent", None
+                except TelegramRetryAfter as e:
+                    logger.info(
+                        f'Hit the rate limit while messaging "{chat_id}", retrying after {e.retry_after} seconds.'
+                    )
+                    await asyncio.sleep(e.retry_after)
+                except TelegramForbiddenError as e:
+                    logger.info(
+                        f'User "{chat_id}" has blocked the bot, dropping message.'
+                    )
+                    return "failed", str(e)
+                except TelegramBadRequest as e:
+                    logger.info(f'Telegram rejected the message to "{chat_id}", {e}')
+                    return "failed", str(e)
+                except TelegramNetworkError as e:
+                    logger.info(f'Network error while messaging "{chat_id}", {e}')
+                    return "retry", str(e)
+                except Exception as e:
+                    logger.exception(f'Exception while messaging "{chat_id}", {e}')
+                    return "retry", str(e)
+
+
+def format_notifications(exams: list[tuple[str, str]]) -> str:
+    """
+    Builds the notification text for a list of (lecture_name, exam_name) tuples.
+    """
+    # Grades can change more than once before the user is notified
+    exams = list(dict.fromkeys(exams))
+    if len(exams) == 1:
+        lecture_name, exam_name = exams[0]
+        return f"{html.bold(lecture_name)} dersinde {html.bold(exam_name)} sınavına dair bilgi girildi."
+    header = "Takip ettiğiniz derslerde şu sınavlara dair bilgi girildi:"
+    # Telegram counts the length of the text without the HTML tags
+    length = len(header)
+    lines = []
+    for lecture_name, exam_name in exams:
+        length += len(f"\n• {lecture_name} / {exam_name}")
+        if length > MAX_TEXT_LENGTH:
+            break
+        lines.append(f"• {html.bold(lecture_name)} / {html.bold(exam_name)}")
+    if len(lines) < len(exams):
+        lines.append(f"ve {len(exams) - len(lines)} sınav daha.")
+    return header + "\n" + "\n".join(lines)
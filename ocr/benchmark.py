@@ -0,0 +1,438 @@
+"""
+Benchmarks OCR models without needing a display.
+
+For every model file reports the accuracy and per-class confusion on the test set,
+p50/p99 latency of reading a single image the way the solver does, p50/p99 latency and
+throughput of batches at several batch sizes and thread counts, model load time and
+peak RSS. Every model is measured in a fresh process, so the numbers don't affect
+each other.
+
+With --captchas the solve rate and latency of the solver's pipelines are compared on
+whole CAPTCHAs named "answer_name.png", like the ones in ocr/testimages. --shift moves
+them around by up to that many pixels, to see how the pipelines handle layout changes.
+
+    python -m ocr.benchmark ocr_model.pth --captchas ocr/testimages
+    python -m ocr.benchmark ocr_model.pth --output benchmark.json --baseline ""
+    python -m ocr.benchmark ocr_model.pth --baseline benchmark.json
+    python -m ocr.benchmark ocr_model.pth --captchas ocr/testimages --shift 4
+
+The results are compared to benchmarks/ocr_baseline.json unless another --baseline is
+given, the exit code is 1 if a model is worse than in the baseline. Latency, throughput,
+load time and memory are only compared if the baseline was measured on the same kind of
+machine, accuracy and solve rates always are. After an intended change the baseline is
+updated with --output benchmarks/ocr_baseline.json, run from the repository's folder.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+NUM_CLASSES = 101
+BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "benchmarks",
+    "ocr_baseline.json",
+)
+# The baseline's numbers that depend on the machine are only compared if these match
+MACHINE_KEYS = ("machine", "cpus", "python", "torch")
+PIPELINES = ("fixed", "segment")
+# How many moved copies of every CAPTCHA are solved with --shift
+SHIFTED_COPIES = 5
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    """
+    Returns the p50 and p99 of the samples in milliseconds.
+    """
+    samples = np.array(samples) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(samples, 50)), 4),
+        "p99_ms": round(float(np.percentile(samples, 99)), 4),
+    }
+
+
+def load_images(folder: str) -> tuple[list[np.ndarray], np.ndarray]:
+    """
+    Reads every "label_date.png" image in the folder as a grayscale array.
+    """
+    from PIL import Image
+
+    images, labels = [], []
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if not os.path.isfile(path):
+            continue
+        images.append(np.array(Image.open(path).convert("L")))
+        labels.append(int(name[: name.find("_")]))
+    return images, np.array(labels)
+
+
+def load_captchas(folder: str, shift: int) -> list[tuple[np.ndarray, int]]:
+    """
+    Reads the "answer_name.png" CAPTCHAs in the folder. With a shift, every CAPTCHA is
+    also moved by up to "shift" pixels a few times, the uncovered area is left white.
+    """
+    import cv2
+
+    random = np.random.default_rng(0)
+    captchas = []
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if not os.path.isfile(path):
+            continue
+        image = cv2.imread(path)
+        answer = int(name[: name.find("_")])
+        captchas.append((image, answer))
+        for _ in range(SHIFTED_COPIES if shift else 0):
+            dx, dy = random.integers(-shift, shift + 1, 2)
+            matrix = np.float32([[1, 0, dx], [0, 1, dy]])
+            moved = cv2.warpAffine(
+                image, matrix, image.shape[1::-1], borderValue=(255, 255, 255)
+            )
+            captchas.append((moved, answer))
+    return captchas
+
+
+def benchmark_pipelines(captchas: list[tuple[np.ndarray, int]], rounds: int) -> dict:
+    """
+    Solves the CAPTCHAs with every pipeline of the solver, using the loaded model.
+    """
+    from ocr.solver import CaptchaSolver
+
+    results = {}
+    for pipeline in PIPELINES:
+        solved = 0
+        samples = []
+        for i in range(rounds):
+            for image, answer in captchas:
+                solve_start = time.perf_counter()
+                result = CaptchaSolver(image, pipeline).solve_captcha()
+                samples.append(time.perf_counter() - solve_start)
+                if i == 0:
+                    solved += result == answer
+        results[pipeline] = {
+            "captchas": len(captchas),
+            "solve_rate": round(solved / len(captchas), 4),
+            **percentiles(samples),
+        }
+    return results
+
+
+def confusion(labels: np.ndarray, predictions: np.ndarray) -> dict:
+    """
+    Returns the per-class precision and recall, and the most common mistakes.
+    """
+    matrix = np.zeros((NUM_CLASSES, NUM_CLASSES), np.int64)
+    np.add.at(matrix, (labels, predictions), 1)
+    classes = {}
+    for label in np.unique(np.concatenate([labels, predictions])):
+        correct = int(matrix[label, label])
+        support = int(matrix[label].sum())
+        predicted = int(matrix[:, label].sum())
+        classes[str(label)] = {
+            "support": support,
+            "correct": correct,
+            "recall": round(correct / support, 4) if support else None,
+            "precision": round(correct / predicted, 4) if predicted else None,
+        }
+    mistakes = matrix.copy()
+    np.fill_diagonal(mistakes, 0)
+    pairs = np.argwhere(mistakes > 0)
+    pairs = sorted(pairs, key=lambda p: -mistakes[p[0], p[1]])
+    return {
+        "classes": classes,
+        "mistakes": [
+            {"label": int(t), "predicted": int(p), "count": int(mistakes[t, p])}
+            for t, p in pairs
+        ],
+    }
+
+
+def benchmark_model(
+    path: str,
+    data_folder: str,
+    batch_sizes: list[int],
+    thread_counts: list[int],
+    rounds: int,
+    captcha_folder: str = None,
+    shift: int = 0,
+) -> dict:
+    """
+    Measures a single model, runs in its own process.
+    """
+    import torch
+    import ocr.ocr as o
+
+    start_time = time.perf_counter()
+    model = torch.load(path, weights_only=False, map_location="cpu")
+    model.eval()
+    load_seconds = time.perf_counter() - start_time
+
+    images, labels = load_images(data_folder)
+    if not images:
+        raise ValueError(f'No images found in "{data_folder}".')
+    tensors = torch.stack([o.transform(o.Image.fromarray(image)) for image in images])
+
+    with torch.no_grad():
+        predictions = model(tensors).argmax(dim=1).numpy()
+    accuracy = float((predictions == labels).mean())
+
+    # The same path the solver takes for every digit, image conversion included
+    o.set_model(model)
+    # The model measured here is the loaded one, never the OCR server's
+    from ocr import client
+
+    client.unavailable_until = float("inf")
+    single = []
+    for _ in range(rounds):
+        for image in images:
+            image_start = time.perf_counter()
+            o.predict(image)
+            single.append(time.perf_counter() - image_start)
+
+    batched = []
+    default_threads = torch.get_num_threads()
+    for threads in thread_counts:
+        torch.set_num_threads(threads)
+        for batch_size in batch_sizes:
+            # Enough batches to go over the test set "rounds" times, but at least 10
+            batches = max(10, rounds * len(tensors) // batch_size)
+            indices = torch.arange(batch_size) % len(tensors)
+            samples = []
+            with torch.no_grad():
+                model(tensors[indices])
+                for i in range(batches):
+                    batch = tensors[(indices + i * batch_size) % len(tensors)]
+                    batch_start = time.perf_counter()
+                    model(batch)
+                    samples.append(time.perf_counter() - batch_start)
+            batched.append(
+                {
+                    "threads": threads,
+                    "batch_size": batch_size,
+                    **percentiles(samples),
+                    "images_per_second": round(
+                        batch_size * len(samples) / sum(samples), 1
+                    ),
+                }
+            )
+    torch.set_num_threads(default_threads)
+
+    pipelines = None
+    if captcha_folder:
+        pipelines = benchmark_pipelines(load_captchas(captcha_folder, shift), rounds)
+
+    return {
+        "images": len(images),
+        "accuracy": round(accuracy, 4),
+        "load_seconds": round(load_seconds, 4),
+        "single": percentiles(single),
+        "batched": batched,
+        "pipelines": pipelines,
+        # Kilobytes on Linux
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "confusion": confusion(labels, predictions),
+    }
+
+
+def compare(
+    results: dict, baseline: dict, accuracy_tolerance: float, tolerance: float
+) -> list[str]:
+    """
+    Returns a line for every number that got worse than in the baseline by more than
+    the tolerance. Accuracy is compared in absolute terms, everything else relatively.
+    """
+    regressions = []
+    same_machine = all(results.get(key) == baseline.get(key) for key in MACHINE_KEYS)
+    for path, result in results["models"].items():
+        old = baseline.get("models", {}).get(path)
+        if old is None:
+            continue
+
+        def check(
+            name: str, new_value: float, old_value: float, higher_is_better=False
+        ):
+            if (
+                not same_machine
+                or old_value is None
+                or new_value is None
+                or old_value == 0
+            ):
+                return
+            change = (new_value - old_value) / old_value
+            if higher_is_better:
+                change = -change
+            if change > tolerance:
+                regressions.append(
+                    f"{path}: {name} went from {old_value} to {new_value} ({change:+.0%})."
+                )
+
+        if result["accuracy"] < old["accuracy"] - accuracy_tolerance:
+            regressions.append(
+                f"{path}: accuracy went from {old['accuracy']} to {result['accuracy']}."
+            )
+        for pipeline, solves in (result.get("pipelines") or {}).items():
+            old_solves = (old.get("pipelines") or {}).get(pipeline)
+            if old_solves is None:
+                continue
+            if solves["solve_rate"] < old_solves["solve_rate"] - accuracy_tolerance:
+                regressions.append(
+                    f"{path}: solve rate of the {pipeline} pipeline went from "
+                    f"{old_solves['solve_rate']} to {solves['solve_rate']}."
+                )
+            check(f"{pipeline} pipeline p50", solves["p50_ms"], old_solves["p50_ms"])
+        check("single image p50", result["single"]["p50_ms"], old["single"]["p50_ms"])
+        check("single image p99", result["single"]["p99_ms"], old["single"]["p99_ms"])
+        check("load time", result["load_seconds"], old["load_seconds"])
+        check("peak RSS", result["peak_rss_mb"], old["peak_rss_mb"])
+        old_batched = {(b["threads"], b["batch_size"]): b for b in old["batched"]}
+        for batch in result["batched"]:
+            old_batch = old_batched.get((batch["threads"], batch["batch_size"]))
+            if old_batch is None:
+                continue
+            check(
+                f"throughput with batch size {batch['batch_size']} on {batch['threads']} threads",
+                batch["images_per_second"],
+                old_batch["images_per_second"],
+                higher_is_better=True,
+            )
+    return regressions
+
+
+def print_results(results: dict) -> None:
+    for path, result in results["models"].items():
+        print(f"{path}:")
+        print(f"  accuracy {result['accuracy']:.4f} on {result['images']} images")
+        print(
+            f"  load time {result['load_seconds'] * 1000:.1f} ms, peak RSS {result['peak_rss_mb']} MB"
+        )
+        print(
+            f"  single image p50 {result['single']['p50_ms']:.3f} ms, p99 {result['single']['p99_ms']:.3f} ms"
+        )
+        for batch in result["batched"]:
+            print(
+                f"  batch {batch['batch_size']:>4} on {batch['threads']} threads: "
+                f"p50 {batch['p50_ms']:.3f} ms, p99 {batch['p99_ms']:.3f} ms, "
+                f"{batch['images_per_second']:.0f} images/s"
+            )
+        for pipeline, solves in (result["pipelines"] or {}).items():
+            print(
+                f"  {pipeline} pipeline: solved {solves['solve_rate']:.2%} of {solves['captchas']} CAPTCHAs, "
+                f"p50 {solves['p50_ms']:.3f} ms, p99 {solves['p99_ms']:.3f} ms"
+            )
+        mistakes = result["confusion"]["mistakes"][:5]
+        if mistakes:
+            print(
+                "  most common mistakes: "
+                + ", ".join(
+                    f"{m['label']} read as {m['predicted']} ({m['count']}x)"
+                    for m in mistakes
+                )
+            )
+
+
+def parse_list(value: str) -> list[int]:
+    return [int(x) for x in value.split(",") if x]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark OCR models.")
+    parser.add_argument("models", nargs="+", help="Paths to model files")
+    parser.add_argument(
+        "--data", help="Folder of labelled test images, TEST_DATA_FOLDER by default"
+    )
+    parser.add_argument("--batch-sizes", type=parse_list, default=[1, 8, 32, 128])
+    parser.add_argument("--threads", type=parse_list, default=[1, 2, 4])
+    parser.add_argument(
+        "--rounds", type=int, default=3, help="How many times the test set is gone over"
+    )
+    parser.add_argument(
+        "--captchas", help="Folder of whole CAPTCHAs to compare the pipelines on"
+    )
+    parser.add_argument(
+        "--shift",
+        type=int,
+        default=0,
+        help="Move the CAPTCHAs by up to this many pixels",
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument(
+        "--baseline",
+        default=BASELINE_PATH,
+        help='Compare the results to this earlier output, "" to skip it',
+    )
+    parser.add_argument(
+        "--accuracy-tolerance",
+        type=float,
+        default=0.005,
+        help="Allowed drop in accuracy",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed relative slowdown, 0.2 is 20%%",
+    )
+    args = parser.parse_args()
+
+    if args.data is None:
+        from global_variables import TEST_DATA_FOLDER
+
+        args.data = TEST_DATA_FOLDER
+
+    import torch
+
+    results = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "cpus": os.cpu_count(),
+        "data": args.data,
+        "models": {},
+    }
+    for path in args.models:
+        # A new process for every model, so load time and peak RSS are the model's own
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+            results["models"][path] = executor.submit(
+                benchmark_model,
+                path,
+                args.data,
+                args.batch_sizes,
+                args.threads,
+                args.rounds,
+                args.captchas,
+                args.shift,
+            ).result()
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+        if not all(results.get(key) == baseline.get(key) for key in MACHINE_KEYS):
+            print(
+                "The baseline was measured on another kind of machine, only accuracy "
+                "and solve rates are compared."
+            )
+        regressions = compare(
+            results, baseline, args.accuracy_tolerance, args.tolerance
+        )
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline.")
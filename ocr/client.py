@@ -0,0 +1,113 @@
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from global_variables import get_logger, OCR_SERVER_SOCKET
+
+logger = get_logger("ocr.client")
+
+# How long to wait for the server to answer, in seconds. Longer than the server waits
+# for a batch (REQUEST_TIMEOUT in ocr/server.py), which includes loading a model the
+# first time it is asked for
+CLIENT_TIMEOUT = 15
+# How long the server isn't tried again after it couldn't be reached, in seconds
+RETRY_DELAY = 30
+# A message is the length of its JSON header and of its payload, then the two of them
+FRAME = struct.Struct(">II")
+
+# Every thread keeps its own connection to the server
+connections = threading.local()
+unavailable_until = 0.0
+
+
+def send_message(sock: socket.socket, header: dict, payload: bytes = b"") -> None:
+    encoded = json.dumps(header).encode("utf-8")
+    sock.sendall(FRAME.pack(len(encoded), len(payload)) + encoded + payload)
+
+
+def receive_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("The connection was closed.")
+        data += chunk
+    return bytes(data)
+
+
+def receive_message(sock: socket.socket) -> tuple[dict, bytes] | None:
+    """
+    Returns the header and the payload of the next message, None if the other side
+    closed the connection in between messages.
+    """
+    try:
+        frame = receive_exactly(sock, FRAME.size)
+    except ConnectionError:
+        return None
+    header_size, payload_size = FRAME.unpack(frame)
+    header = json.loads(receive_exactly(sock, header_size))
+    return header, receive_exactly(sock, payload_size)
+
+
+def available() -> bool:
+    return bool(OCR_SERVER_SOCKET) and time.monotonic() >= unavailable_until
+
+
+def back_off() -> None:
+    """
+    Stops using the server for RETRY_DELAY seconds.
+    """
+    global unavailable_until
+    unavailable_until = time.monotonic() + RETRY_DELAY
+
+
+def close() -> None:
+    sock = getattr(connections, "socket", None)
+    connections.socket = None
+    if sock is not None:
+        sock.close()
+
+
+def request(header: dict, payload: bytes) -> tuple[dict, bytes]:
+    sock = getattr(connections, "socket", None)
+    reused = sock is not None
+    if sock is None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(CLIENT_TIMEOUT)
+        try:
+            sock.connect(OCR_SERVER_SOCKET)
+        except OSError:
+            sock.close()
+            raise
+        connections.socket = sock
+    try:
+        send_message(sock, header, payload)
+        response = receive_message(sock)
+        if response is None:
+            raise ConnectionError("The OCR server closed the connection.")
+        return response
+    except OSError as e:
+        close()
+        # The server may have been restarted since the connection was opened
+        if reused and not isinstance(e, TimeoutError):
+            return request(header, payload)
+        raise
+
+
+def predict_batch(images: list, model_path: str) -> tuple[list[int], list[float]]:
+    """
+    Reads the images with the OCR server, like ocr.ocr.predict_batch. Raises an OSError
+    if the server can't be reached and a RuntimeError if it failed to read them.
+    """
+    header = {
+        "model_path": os.path.abspath(model_path),
+        "images": [
+            {"shape": list(image.shape), "dtype": str(image.dtype)} for image in images
+        ],
+    }
+    response, _ = request(header, b"".join(image.tobytes() for image in images))
+    if "error" in response:
+        raise RuntimeError(f"The OCR server failed, {response['error']}")
+    return response["labels"], response["confidences"]
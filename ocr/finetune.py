@@ -0,0 +1,136 @@
+import copy
+import json
+import multiprocessing
+import os
+import time
+from global_variables import (
+    get_logger,
+    OCR_MODEL_PATH,
+    TRAIN_DATA_FOLDER,
+    TEST_DATA_FOLDER,
+    SAMPLES_FOLDER,
+    FINETUNE_INTERVAL,
+    FINETUNE_MIN_SAMPLES,
+    FINETUNE_EPOCHS,
+)
+
+logger = get_logger("ocr.finetune")
+
+# When the model was last fine-tuned, kept so restarts don't train on the same samples again
+STATE_PATH = f"{SAMPLES_FOLDER}/finetune.json"
+# Lower than when training from scratch, the model only has to be adjusted
+LEARNING_RATE = 1e-4
+
+
+def load_state() -> dict:
+    try:
+        with open(STATE_PATH, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"time": 0}
+
+
+def save_state(state: dict) -> None:
+    os.makedirs(SAMPLES_FOLDER, exist_ok=True)
+    with open(STATE_PATH, "w", encoding="utf-8") as file:
+        json.dump(state, file)
+
+
+def count_new_samples(folder: str, since: float) -> int:
+    try:
+        return sum(1 for entry in os.scandir(folder) if entry.stat().st_mtime > since)
+    except FileNotFoundError:
+        return 0
+
+
+def evaluate(model, folder: str) -> float:
+    """
+    Returns the accuracy of the model on the labelled images in the folder.
+    """
+    import torch
+    from torch.utils.data import DataLoader
+    import ocr.ocr as o
+
+    dataset = o.CaptchaImageDataset(root_dir=folder, transform=o.transform)
+    correct = 0
+    with torch.no_grad():
+        for x, y in DataLoader(dataset, batch_size=256):
+            correct += (model(x).argmax(dim=1) == y).sum().item()
+    return correct / len(dataset)
+
+
+def finetune() -> bool:
+    """
+    Trains a copy of the current model on the confirmed samples and the training data.
+    The copy replaces the model file only if it reads TEST_DATA_FOLDER better, the
+    running solvers then load it on their own. Returns whether it was replaced.
+    """
+    import torch
+    from ocr import samples
+    from ocr.train import train
+
+    current = torch.load(OCR_MODEL_PATH, weights_only=False)
+    current.eval()
+    # The training data is included so the model doesn't forget what it knew
+    folders = [samples.CONFIRMED_FOLDER]
+    if TRAIN_DATA_FOLDER and os.path.isdir(TRAIN_DATA_FOLDER):
+        folders.append(TRAIN_DATA_FOLDER)
+    candidate, _ = train(
+        folders,
+        model=copy.deepcopy(current),
+        epochs=FINETUNE_EPOCHS,
+        learning_rate=LEARNING_RATE,
+    )
+
+    current_accuracy = evaluate(current, TEST_DATA_FOLDER)
+    candidate_accuracy = evaluate(candidate, TEST_DATA_FOLDER)
+    logger.info(
+        f"Fine-tuned model accuracy: {candidate_accuracy:.4f}, current model accuracy: {current_accuracy:.4f}."
+    )
+    if candidate_accuracy <= current_accuracy:
+        logger.info("Keeping the current model.")
+        return False
+
+    # Renaming is atomic, the solvers never see a half written model
+    temporary_path = f"{OCR_MODEL_PATH}.tmp"
+    torch.save(candidate, temporary_path)
+    os.replace(temporary_path, OCR_MODEL_PATH)
+    logger.info(f'Replaced the model at "{OCR_MODEL_PATH}".')
+    return True
+
+
+def run() -> None:
+    """
+    Fine-tunes the model every FINETUNE_INTERVAL seconds if at least FINETUNE_MIN_SAMPLES
+    new confirmed samples were saved since the last time.
+    """
+    import torch
+    from ocr import samples
+
+    # Training shouldn't slow the scrapers and the bot down
+    os.nice(10)
+    torch.set_num_threads(1)
+    while True:
+        try:
+            state = load_state()
+            new_samples = count_new_samples(samples.CONFIRMED_FOLDER, state["time"])
+            if new_samples >= FINETUNE_MIN_SAMPLES:
+                logger.info(f"Fine-tuning the model on {new_samples} new samples.")
+                started = time.time()
+                replaced = finetune()
+                save_state({"time": started, "replaced": replaced})
+        except Exception as e:
+            logger.exception(f"Exception while fine-tuning the model, {e}")
+        time.sleep(FINETUNE_INTERVAL)
+
+
+def start() -> multiprocessing.Process:
+    """
+    Starts fine-tuning in a background process, which exits together with this one.
+    """
+    logger.info("Starting the fine-tuning process.")
+    process = multiprocessing.get_context("spawn").Process(
+        target=run, name="finetune", daemon=True
+    )
+    process.start()
+    return process
@@ -4,8 +4,19 @@ from PIL import Image
 import numpy as np
 from torch.utils.data import Dataset
 import os
+import threading
+import time
+from global_variables import get_logger, OCR_MODEL_PATH
 
-MODEL: "OCRModel" = None
+logger = get_logger("ocr.ocr")
+
+# The loaded models by absolute path, with the modification time of their file when
+# they were loaded (None if they were set by hand) and when the file was last checked.
+# Every scraper using the same model file shares a single copy
+models: dict[str, tuple["OCRModel", float | None, float]] = {}
+# How often a model file is checked for a new model, in seconds
+MODEL_CHECK_INTERVAL = 10
+model_lock = threading.Lock()
 
 
 class OCRModel(torch.nn.Module):
@@ -35,33 +46,94 @@ transform = transforms.Compose(
 )
 
 
-def load_model():
-    global MODEL
-    MODEL = torch.load("ocr_model.pth", weights_only=False)
-    MODEL.eval()
-
-
-def predict(image: np.ndarray):
-    global MODEL
-    # If the model is not loaded, load it
-    if MODEL is None:
-        load_model()
+def load_model(path: str = OCR_MODEL_PATH) -> "OCRModel":
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime
+    model = torch.load(path, weights_only=False)
+    model.eval()
+    # Threads that are in the middle of a prediction keep using the old model
+    models[path] = (model, mtime, time.monotonic())
+    return model
+
+
+def set_model(model: "OCRModel", path: str = OCR_MODEL_PATH) -> None:
+    """
+    Makes the given model be used for the path instead of the file, until it is set again.
+    """
+    models[os.path.abspath(path)] = (model, None, 0.0)
+
+
+def get_model(path: str = OCR_MODEL_PATH) -> "OCRModel":
+    """
+    Returns the model at the path, loading it the first time. The model file is replaced
+    when a fine-tuned model is better (see ocr/finetune.py), the new one is loaded here.
+    """
+    # A relative and an absolute path to the same file share a single copy
+    path = os.path.abspath(path)
+    entry = models.get(path)
+    if entry is None:
+        with model_lock:
+            if path not in models:
+                return load_model(path)
+            entry = models[path]
+    model, mtime, checked = entry
+    if mtime is None or time.monotonic() - checked < MODEL_CHECK_INTERVAL:
+        return model
+    with model_lock:
+        model, mtime, checked = models[path]
+        if time.monotonic() - checked < MODEL_CHECK_INTERVAL:
+            return model
+        try:
+            if os.stat(path).st_mtime == mtime:
+                models[path] = (model, mtime, time.monotonic())
+                return model
+            logger.info(f'The model at "{path}" has changed, reloading it.')
+            return load_model(path)
+        except Exception as e:
+            models[path] = (model, mtime, time.monotonic())
+            logger.exception(
+                f"Exception while reloading the model, keeping the old one. {e}"
+            )
+            return model
+
+
+def predict(image: np.ndarray, model_path: str = OCR_MODEL_PATH):
+    model = get_model(model_path)
     # Load and preprocess the image
     image = Image.fromarray(image).convert("L")  # Convert to grayscale
     image = transform(image).unsqueeze(0)  # Add batch dimension
 
     # Run the model on the image
     with torch.no_grad():
-        outputs = MODEL(image)
+        outputs = model(image)
         _, predicted_label = torch.max(outputs, 1)  # Get the index of the highest score
 
     return predicted_label.item()
 
 
+def predict_batch(
+    images: list[np.ndarray], model_path: str = OCR_MODEL_PATH
+) -> tuple[list[int], list[float]]:
+    """
+    Reads several images in a single forward pass, returns the labels and the model's
+    confidence in each of them.
+    """
+    model = get_model(model_path)
+    batch = torch.stack(
+        [transform(Image.fromarray(image).convert("L")) for image in images]
+    )
+    with torch.no_grad():
+        probabilities = torch.softmax(model(batch), dim=1)
+        confidences, labels = torch.max(probabilities, 1)
+    return labels.tolist(), confidences.tolist()
+
+
 class CaptchaImageDataset(Dataset):
     def __init__(self, root_dir: str, transform=None, target_transform=None):
         self.root_dir = root_dir
-        self.images = [f for f in os.listdir(root_dir) if os.path.isfile(root_dir + f)]
+        self.images = [
+            f for f in os.listdir(root_dir) if os.path.isfile(os.path.join(root_dir, f))
+        ]
         self.labels = [
             int(image_name[: image_name.find("_")]) for image_name in self.images
         ]
@@ -74,7 +146,7 @@ class CaptchaImageDataset(Dataset):
 
     def __getitem__(self, idx):
         image_name: str = self.images[idx]
-        image = Image.open(self.root_dir + image_name)
+        image = Image.open(os.path.join(self.root_dir, image_name))
         label = self.labels[idx]
         if self.transform:
             image = self.transform(image)
@@ -0,0 +1,85 @@
+import os
+import threading
+import uuid
+from datetime import datetime
+import cv2
+import numpy as np
+from global_variables import get_logger, SAMPLES_FOLDER, SAMPLES_MAX
+
+logger = get_logger("ocr.samples")
+
+# The numbers of CAPTCHAs that got us logged in, their labels are known to be right
+CONFIRMED_FOLDER = f"{SAMPLES_FOLDER}/confirmed"
+# The numbers of CAPTCHAs that didn't, at least one of the two labels is wrong
+SUSPECT_FOLDER = f"{SAMPLES_FOLDER}/suspect"
+# Whole CAPTCHAs that got us logged in, named after their answer
+CAPTCHAS_FOLDER = f"{SAMPLES_FOLDER}/captchas"
+# How many samples are saved between checks for old ones to delete
+PRUNE_EVERY = 100
+
+lock = threading.Lock()
+saved_since_prune = 0
+
+
+def save(folder: str, label: int, image: np.ndarray = None, data: bytes = None) -> None:
+    """
+    Saves an image as "label_year-month-day_hour-minute-second_id.png", the naming the
+    training data uses.
+    """
+    os.makedirs(folder, exist_ok=True)
+    name = f"{label}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_{uuid.uuid4().hex[:8]}.png"
+    if data is not None:
+        with open(f"{folder}/{name}", "wb") as file:
+            file.write(data)
+    else:
+        cv2.imwrite(f"{folder}/{name}", image)
+
+
+def record(
+    crops: list[tuple[np.ndarray, int]], captcha: bytes, answer: int, confirmed: bool
+) -> None:
+    """
+    Saves the numbers read from a CAPTCHA with the labels they were read as, and the
+    CAPTCHA itself if the login worked.
+
+    Args:
+        crops (list[tuple[np.ndarray, int]]): The enhanced images of the numbers and their labels.
+        captcha (bytes): The CAPTCHA as a PNG.
+        answer (int): The answer that was sent.
+        confirmed (bool): Whether the login worked.
+    """
+    global saved_since_prune
+    folder = CONFIRMED_FOLDER if confirmed else SUSPECT_FOLDER
+    for image, label in crops:
+        save(folder, label, image=image)
+    if confirmed and captcha is not None:
+        save(CAPTCHAS_FOLDER, answer, data=captcha)
+    with lock:
+        saved_since_prune += 1
+        if saved_since_prune < PRUNE_EVERY:
+            return
+        saved_since_prune = 0
+    for folder in (CONFIRMED_FOLDER, SUSPECT_FOLDER, CAPTCHAS_FOLDER):
+        prune(folder)
+
+
+def prune(folder: str) -> None:
+    """
+    Deletes the oldest images in the folder so that only SAMPLES_MAX of them are left.
+    """
+    try:
+        entries = sorted(os.scandir(folder), key=lambda e: e.stat().st_mtime)
+    except FileNotFoundError:
+        return
+    for entry in entries[: max(0, len(entries) - SAMPLES_MAX)]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            ...
+
+
+def count(folder: str) -> int:
+    try:
+        return sum(1 for entry in os.scandir(folder) if entry.is_file())
+    except FileNotFoundError:
+        return 0
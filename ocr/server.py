@@ -0,0 +1,209 @@
+"""
+Serves the OCR model on a Unix socket, so the scrapers of any number of processes share
+a single copy of it and of torch.
+
+    python -m ocr.server
+
+Requests arriving within BATCH_WINDOW of each other are read in a single forward pass
+per model. With OCR_SERVER_SOCKET set the solvers use the server, and read the CAPTCHAs
+themselves while it can't be reached.
+"""
+
+import multiprocessing
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from global_variables import get_logger, OCR_MODEL_PATH, OCR_SERVER_SOCKET
+from ocr import client
+import sites
+
+logger = get_logger("ocr.server")
+
+# How long the first request of a batch waits for others to join it, in seconds
+BATCH_WINDOW = 0.005
+# How many images are read in one forward pass at most
+MAX_BATCH = 64
+# How long a request waits for its batch to be read before the client is told it failed
+REQUEST_TIMEOUT = 10
+
+
+class Batcher:
+    """
+    Collects the images of the requests and reads them in batches on a single thread.
+    """
+
+    def __init__(self):
+        self.requests: queue.Queue[tuple[list, str, Future]] = queue.Queue()
+
+    def submit(self, images: list, model_path: str) -> Future:
+        future = Future()
+        self.requests.put((images, model_path, future))
+        return future
+
+    def collect(self) -> list[tuple[list, str, Future]]:
+        pending = [self.requests.get()]
+        count = len(pending[0][0])
+        deadline = time.monotonic() + BATCH_WINDOW
+        while count < MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+            count += len(pending[-1][0])
+        return pending
+
+    def run(self) -> None:
+        from ocr.ocr import predict_batch
+
+        while True:
+            pending = self.collect()
+            by_model: dict[str, list[tuple[list, Future]]] = {}
+            for images, model_path, future in pending:
+                by_model.setdefault(model_path, []).append((images, future))
+            for model_path, requests in by_model.items():
+                images = [
+                    image for request_images, _ in requests for image in request_images
+                ]
+                try:
+                    labels, confidences = predict_batch(images, model_path)
+                except Exception as e:
+                    logger.exception(
+                        f'Exception while reading a batch with "{model_path}", {e}'
+                    )
+                    for _, future in requests:
+                        future.set_exception(e)
+                    continue
+                logger.debug(
+                    f"Read {len(images)} images of {len(requests)} requests in one pass."
+                )
+                start = 0
+                for request_images, future in requests:
+                    end = start + len(request_images)
+                    future.set_result((labels[start:end], confidences[start:end]))
+                    start = end
+
+
+class Handler(socketserver.BaseRequestHandler):
+    """
+    Answers the requests of a client until it disconnects, see ocr/client.py.
+    """
+
+    def handle(self) -> None:
+        import numpy as np
+
+        batcher: Batcher = self.server.batcher
+        while True:
+            try:
+                message = client.receive_message(self.request)
+            except (OSError, ValueError):
+                return
+            if message is None:
+                return
+            header, payload = message
+            try:
+                images = []
+                offset = 0
+                for image in header["images"]:
+                    dtype = np.dtype(image["dtype"])
+                    size = int(np.prod(image["shape"])) * dtype.itemsize
+                    images.append(
+                        np.frombuffer(
+                            payload, dtype, offset=offset, count=size // dtype.itemsize
+                        ).reshape(image["shape"])
+                    )
+                    offset += size
+                labels, confidences = batcher.submit(
+                    images, header["model_path"]
+                ).result(REQUEST_TIMEOUT)
+                response = {"labels": labels, "confidences": confidences}
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            try:
+                client.send_message(self.request, response)
+            except OSError:
+                return
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str):
+        self.batcher = Batcher()
+        super().__init__(path, Handler)
+
+
+def is_served(path: str) -> bool:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def run(path: str = OCR_SERVER_SOCKET) -> None:
+    """
+    Serves the model on the socket at the path until the process is stopped.
+    """
+    from ocr.ocr import get_model
+
+    if is_served(path):
+        logger.info(f'An OCR server is already listening on "{path}".')
+        return
+    # Left behind by a server that didn't exit cleanly
+    if os.path.exists(path):
+        os.remove(path)
+    # Only our own user can connect, the requests name model files to load
+    previous_umask = os.umask(0o177)
+    try:
+        server = Server(path)
+    finally:
+        os.umask(previous_umask)
+    # The models of the sites are loaded before the first requests ask for them
+    model_paths = {os.path.abspath(OCR_MODEL_PATH)}
+    try:
+        model_paths.update(
+            os.path.abspath(profile.model_path)
+            for profile in sites.load_sites().values()
+        )
+    except Exception as e:
+        logger.exception(f"Exception while loading the sites, {e}")
+    for model_path in sorted(model_paths):
+        try:
+            get_model(model_path)
+        except Exception as e:
+            logger.exception(f'Exception while loading the model "{model_path}", {e}')
+    threading.Thread(target=server.batcher.run, name="batcher", daemon=True).start()
+    logger.info(f'Serving the OCR model on "{path}".')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def start() -> multiprocessing.Process:
+    """
+    Starts the server in a background process, which exits together with this one.
+    """
+    logger.info("Starting the OCR server process.")
+    process = multiprocessing.get_context("spawn").Process(
+        target=run, name="ocr-server", daemon=True
+    )
+    process.start()
+    return process
+
+
+if __name__ == "__main__":
+    if not OCR_SERVER_SOCKET:
+        raise SystemExit("Set OCR_SERVER_SOCKET to the path of the socket to serve on.")
+    run()
@@ -2,20 +2,85 @@ import cv2
 import numpy as np
 import os
 from datetime import datetime
-from global_variables import logger
-from ocr.ocr import predict
-from global_variables import TRAIN_DATA_FOLDER
+from global_variables import get_logger
+from global_variables import TRAIN_DATA_FOLDER, OCR_PIPELINE, OCR_MODEL_PATH
+from ocr import client
+import metrics
+import tracing
+
+logger = get_logger("ocr.solver")
+
+# Where the numbers are read from on the CAPTCHA when the layout is fixed, (x, y)
+FIXED_POSITIONS = {"left": (5, 7), "right": (45, 7)}
+# Size of the area a number is read from, (height, width)
+WINDOW_SIZE = (20, 25)
+# Where the numbers are relative to the top left corner of the operator. These are the
+# fixed positions above, measured from where the operator is on OBS' CAPTCHAs
+OPERATOR_OFFSETS = {"left": (-30, -4), "right": (10, -4)}
+
+# The characters of the equation are gray, the noise drawn over them is colored
+INK_MAX_SATURATION = 25
+INK_MAX_BRIGHTNESS = 160
+# How well the operator and the equals sign have to match to be trusted, from 0 to 1
+MATCH_THRESHOLD = 0.5
+
+
+def predict_batch(
+    images: list[np.ndarray], model_path: str
+) -> tuple[list[int], list[float]]:
+    """
+    Reads the images with the OCR server if OCR_SERVER_SOCKET is set, otherwise or while
+    the server can't be reached with the model loaded in this process.
+    """
+    if client.available():
+        try:
+            return client.predict_batch(images, model_path)
+        except Exception as e:
+            logger.warning(
+                f"Couldn't read the CAPTCHA with the OCR server, reading CAPTCHAs in this process for the next {client.RETRY_DELAY} seconds. {e}"
+            )
+            client.back_off()
+    # torch is only loaded by the processes that read the CAPTCHAs themselves
+    from ocr import ocr
+
+    return ocr.predict_batch(images, model_path)
+
+
+def template(lines: list[tuple[slice, slice]], size: tuple[int, int]) -> np.ndarray:
+    image = np.zeros(size, np.float32)
+    for rows, columns in lines:
+        image[rows, columns] = 1
+    return image
+
+
+# The horizontal lines of the signs are 2 pixels thick, the vertical one 1 pixel
+PLUS = template([(slice(None), slice(5, 6)), (slice(5, 7), slice(None))], (12, 11))
+MINUS = template([(slice(5, 7), slice(None))], (12, 11))
+EQUALS = template([(slice(1, 3), slice(None)), (slice(5, 7), slice(None))], (8, 10))
 
 
 class CaptchaSolver:
     """
     A class to solve equation Captchas.
     Create an object of this class with either the equation image path as input or the image data as an np.ndarray.
-    use object.solve_captcha() to get the result.
+    use object.solve_captcha() to get the result. The pipeline ("segment" or "fixed")
+    decides how the numbers are found, OCR_PIPELINE by default. Sites with a different
+    CAPTCHA layout or model pass their own positions, offsets and model path.
     """
 
-    def __init__(self, image: str | np.ndarray):
-        logger.info("Initializing a CaptchaSolver object.")
+    def __init__(
+        self,
+        image: str | np.ndarray,
+        pipeline: str = OCR_PIPELINE,
+        positions: dict[str, tuple[int, int]] = None,
+        offsets: dict[str, tuple[int, int]] = None,
+        model_path: str = OCR_MODEL_PATH,
+    ):
+        logger.debug("Initializing a CaptchaSolver object.")
+        self.pipeline = pipeline or OCR_PIPELINE
+        self.positions = positions or FIXED_POSITIONS
+        self.offsets = offsets or OPERATOR_OFFSETS
+        self.model_path = model_path or OCR_MODEL_PATH
         if isinstance(image, str):
             self.image = cv2.imread(image)
         elif isinstance(image, np.ndarray):
@@ -23,6 +88,10 @@ class CaptchaSolver:
         else:
             raise TypeError("Argument image must either be str or np.ndarray")
         self.kernel = np.ones((2, 2), np.uint8)
+        # The enhanced images of the numbers, what they were read as and the result,
+        # set by solve_captcha
+        self.crops: list[tuple[np.ndarray, int]] = []
+        self.result: int = None
 
     def enhance_legibility(self, cropped_image: np.ndarray) -> np.ndarray:
         """
@@ -55,10 +124,98 @@ class CaptchaSolver:
         logger.info(f'Saving training data to "{data_path}"')
         cv2.imwrite(data_path, image)
 
+    def ink_mask(self) -> np.ndarray:
+        """
+        Returns a float mask of the dark gray pixels, which the equation is drawn with.
+        """
+        image = self.image[:, :, :3].astype(np.int16)
+        saturation = image.max(axis=2) - image.min(axis=2)
+        return (
+            (saturation < INK_MAX_SATURATION)
+            & (image.mean(axis=2) < INK_MAX_BRIGHTNESS)
+        ).astype(np.float32)
+
+    def find_operator(self) -> tuple[int, int, str] | None:
+        """
+        Finds the operator of the equation by matching the ink against templates of the
+        signs. Returns the top left corner of the operator and the operator itself, or
+        None if the CAPTCHA doesn't look like "number operator number = ?".
+        """
+        mask = self.ink_mask()
+        if mask.shape[0] < PLUS.shape[0] or mask.shape[1] < EQUALS.shape[1]:
+            return None
+        # The equals sign is looked for first, the operator has to come before it
+        equals = cv2.matchTemplate(mask, EQUALS, cv2.TM_CCORR_NORMED)
+        if equals.max() < MATCH_THRESHOLD:
+            return None
+        equals_x = np.unravel_index(equals.argmax(), equals.shape)[1]
+        before_equals = mask[:, :equals_x]
+        if before_equals.shape[1] < PLUS.shape[1]:
+            return None
+        plus = cv2.matchTemplate(before_equals, PLUS, cv2.TM_CCORR_NORMED)
+        minus = cv2.matchTemplate(before_equals, MINUS, cv2.TM_CCORR_NORMED)
+        # A plus matches the minus template too, the vertical bar makes the difference
+        if plus.max() >= minus.max() * 0.9:
+            scores, operator = plus, "+"
+        else:
+            scores, operator = minus, "-"
+        y, x = np.unravel_index(scores.argmax(), scores.shape)
+        if scores[y, x] < MATCH_THRESHOLD:
+            return None
+        # There has to be a number on both sides of the operator
+        columns = before_equals.sum(axis=0)
+        if not columns[:x].any() or not columns[x + PLUS.shape[1] :].any():
+            return None
+        return int(x), int(y), operator
+
+    def crop(self, x: int, y: int) -> np.ndarray:
+        """
+        Returns the window a number is read from, padded with white outside the image.
+        """
+        height, width = WINDOW_SIZE
+        pad = max(height, width)
+        image = cv2.copyMakeBorder(
+            self.image[:, :, :3],
+            pad,
+            pad,
+            pad,
+            pad,
+            cv2.BORDER_CONSTANT,
+            value=(255, 255, 255),
+        )
+        return image[y + pad : y + pad + height, x + pad : x + pad + width]
+
+    def find_operands(self) -> tuple[np.ndarray, np.ndarray, str]:
+        """
+        Returns the windows of the left and right numbers and the operator.
+        With the pipeline set to "segment" the windows are placed around the operator,
+        so the CAPTCHA can move around. If the operator can't be found, or the pipeline
+        is "fixed", the numbers are read from fixed positions.
+        """
+        if self.pipeline == "segment":
+            found = self.find_operator()
+            if found is not None:
+                x, y, operator = found
+                positions = {
+                    side: (x + dx, y + dy) for side, (dx, dy) in self.offsets.items()
+                }
+                return (
+                    self.crop(*positions["left"]),
+                    self.crop(*positions["right"]),
+                    operator,
+                )
+            logger.debug("Couldn't find the operator, using the fixed positions.")
+        return (
+            self.crop(*self.positions["left"]),
+            self.crop(*self.positions["right"]),
+            "+",
+        )
+
+    @tracing.traced()
+    @metrics.timed(metrics.CAPTCHA_SOLVE_SECONDS)
     def solve_captcha(self, save: bool = False) -> int | None:
         """
-        Solves the CAPTCHA and returns a dictionary containing the numbers on the left
-        and right side of the equation, along with the calculated result.
+        Solves the CAPTCHA and returns the result of the equation.
 
         Args:
             save (bool, optional): If True, saves the enhanced images of the left and
@@ -67,24 +224,23 @@ class CaptchaSolver:
         Returns:
             int | None: The result of the equation, if found, will be returned. If not, None will be returned.
         """
-        logger.info("Attempting to solve CAPTCHA..")
-        positions = {"left": 5, "right": 45}
-        dimensions = {"width": 25}
-
-        left_image = self.image[
-            7:27, positions["left"] : positions["left"] + dimensions["width"]
-        ]
-        right_image = self.image[
-            7:27, positions["right"] : positions["right"] + dimensions["width"]
-        ]
+        logger.debug("Attempting to solve CAPTCHA..")
+        left_image, right_image, operator = self.find_operands()
 
         left_enhanced = self.enhance_legibility(left_image)
         right_enhanced = self.enhance_legibility(right_image)
 
-        left_number = predict(left_enhanced)
-        right_number = predict(right_enhanced)
+        # Both numbers are read in a single pass of the model
+        (left_number, right_number), _ = predict_batch(
+            [left_enhanced, right_enhanced], self.model_path
+        )
 
-        result = left_number + right_number
+        if operator == "-":
+            result = left_number - right_number
+        else:
+            result = left_number + right_number
+        self.crops = [(left_enhanced, left_number), (right_enhanced, right_number)]
+        self.result = result
 
         # Save the singular images as training data
         if save:
@@ -1,29 +1,18 @@
 import matplotlib
 from torch.utils.data import random_split
 from torch.utils.data import DataLoader
+from torch.utils.data import ConcatDataset
 from torch.optim import Adam
 from torch import nn
 import matplotlib.pyplot as plt
 import argparse
 import torch
 import time
-from global_variables import TRAIN_DATA_FOLDER
 import ocr.ocr as o
 
 # set the matplotlib backend so figures can be saved in the background
 matplotlib.use("Agg")
 
-# construct the argument parser and parse the arguments
-ap = argparse.ArgumentParser()
-ap.add_argument(
-    "-m", "--model", type=str, required=True, help="path to output trained model"
-)
-ap.add_argument(
-    "-p", "--plot", type=str, required=True, help="path to output loss/accuracy plot"
-)
-args = vars(ap.parse_args())
-
-
 # define training hyperparameters
 INIT_LR = 1e-3
 BATCH_SIZE = 64
@@ -36,119 +25,184 @@ VAL_SPLIT = 1 - TRAIN_SPLIT
 # set the device we will be using to train the model
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-trainData = o.CaptchaImageDataset(
-    root_dir=TRAIN_DATA_FOLDER,
-    transform=o.transform,
-    target_transform=lambda x: torch.tensor(x, dtype=torch.long),
-)
-
-numValSamples = int(len(trainData) * VAL_SPLIT)
-numTrainSamples = int(len(trainData)) - numValSamples
-
-(trainData, valData) = random_split(
-    trainData,
-    [numTrainSamples, numValSamples],
-    generator=torch.Generator().manual_seed(42),
-)
-
-# initialize the train, validation, and test data loaders
-trainDataLoader = DataLoader(trainData, shuffle=True, batch_size=BATCH_SIZE)
-valDataLoader = DataLoader(valData, batch_size=BATCH_SIZE)
-
-# calculate steps per epoch for training and validation set
-trainSteps = len(trainDataLoader.dataset) // BATCH_SIZE
-valSteps = len(valDataLoader.dataset) // BATCH_SIZE
-
-# initialize the model
-print("[INFO] initializing the model...")
-model = o.OCRModel().to(device)
-
-# initialize our optimizer and loss function
-opt = Adam(model.parameters(), lr=INIT_LR)
-lossFn = nn.CrossEntropyLoss()
-
-# initialize a dictionary to store training history
-H = {"train_loss": [], "train_acc": [], "val_loss": [], "val_acc": []}
-
-# measure how long training is going to take
-print("[INFO] training the network...")
-startTime = time.time()
-
-# loop over our epochs
-for e in range(0, EPOCHS):
-    # set the model in training mode
-    model.train()
-    # initialize the total training and validation loss
-    totalTrainLoss = 0
-    totalValLoss = 0
-    # initialize the number of correct predictions in the training
-    # and validation step
-    trainCorrect = 0
-    valCorrect = 0
-    # loop over the training set
-    for x, y in trainDataLoader:
-        # send the input to the device
-        (x, y) = (x.to(device), y.to(device))
-        # perform a forward pass and calculate the training loss
-        pred = model(x)
-        loss = lossFn(pred, y)
-        # zero out the gradients, perform the backpropagation step,
-        # and update the weights
-        opt.zero_grad()
-        loss.backward()
-        opt.step()
-        # add the loss to the total training loss so far and
-        # calculate the number of correct predictions
-        totalTrainLoss += loss
-        trainCorrect += (pred.argmax(1) == y).type(torch.float).sum().item()
-
-    # switch off autograd for evaluation
-    with torch.no_grad():
-        # set the model in evaluation mode
-        model.eval()
-        # loop over the validation set
-        for x, y in valDataLoader:
+
+def train(
+    data_folders: str | list[str],
+    model: o.OCRModel = None,
+    epochs: int = EPOCHS,
+    learning_rate: float = INIT_LR,
+) -> tuple[o.OCRModel, dict]:
+    """
+    Trains a model on the labelled images in the given folders and returns it along
+    with its training history. If a model is given it is trained further instead of
+    starting from scratch.
+    """
+    if isinstance(data_folders, str):
+        data_folders = [data_folders]
+    trainData = ConcatDataset(
+        [
+            o.CaptchaImageDataset(
+                root_dir=folder,
+                transform=o.transform,
+                target_transform=lambda x: torch.tensor(x, dtype=torch.long),
+            )
+            for folder in data_folders
+        ]
+    )
+
+    numValSamples = int(len(trainData) * VAL_SPLIT)
+    numTrainSamples = int(len(trainData)) - numValSamples
+
+    (trainData, valData) = random_split(
+        trainData,
+        [numTrainSamples, numValSamples],
+        generator=torch.Generator().manual_seed(42),
+    )
+
+    # initialize the train, validation, and test data loaders
+    trainDataLoader = DataLoader(trainData, shuffle=True, batch_size=BATCH_SIZE)
+    valDataLoader = DataLoader(valData, batch_size=BATCH_SIZE)
+
+    # calculate steps per epoch for training and validation set
+    trainSteps = max(1, len(trainDataLoader.dataset) // BATCH_SIZE)
+    valSteps = max(1, len(valDataLoader.dataset) // BATCH_SIZE)
+
+    # initialize the model
+    if model is None:
+        print("[INFO] initializing the model...")
+        model = o.OCRModel()
+    model = model.to(device)
+
+    # initialize our optimizer and loss function
+    opt = Adam(model.parameters(), lr=learning_rate)
+    lossFn = nn.CrossEntropyLoss()
+
+    # initialize a dictionary to store training history
+    H = {"train_loss": [], "train_acc": [], "val_loss": [], "val_acc": []}
+
+    # measure how long training is going to take
+    print("[INFO] training the network...")
+    startTime = time.time()
+
+    # loop over our epochs
+    for e in range(0, epochs):
+        # set the model in training mode
+        model.train()
+        # initialize the total training and validation loss
+        totalTrainLoss = 0
+        totalValLoss = 0
+        # initialize the number of correct predictions in the training
+        # and validation step
+        trainCorrect = 0
+        valCorrect = 0
+        # loop over the training set
+        for x, y in trainDataLoader:
             # send the input to the device
             (x, y) = (x.to(device), y.to(device))
-            # make the predictions and calculate the validation loss
+            # perform a forward pass and calculate the training loss
             pred = model(x)
-            totalValLoss += lossFn(pred, y)
+            loss = lossFn(pred, y)
+            # zero out the gradients, perform the backpropagation step,
+            # and update the weights
+            opt.zero_grad()
+            loss.backward()
+            opt.step()
+            # add the loss to the total training loss so far and
             # calculate the number of correct predictions
-            valCorrect += (pred.argmax(1) == y).type(torch.float).sum().item()
-
-    # calculate the average training and validation loss
-    avgTrainLoss = totalTrainLoss / trainSteps
-    avgValLoss = totalValLoss / valSteps
-    # calculate the training and validation accuracy
-    trainCorrect = trainCorrect / len(trainDataLoader.dataset)
-    valCorrect = valCorrect / len(valDataLoader.dataset)
-    # update our training history
-    H["train_loss"].append(avgTrainLoss.cpu().detach().numpy())
-    H["train_acc"].append(trainCorrect)
-    H["val_loss"].append(avgValLoss.cpu().detach().numpy())
-    H["val_acc"].append(valCorrect)
-    # print the model training and validation information
-    print("[INFO] EPOCH: {}/{}".format(e + 1, EPOCHS))
+            totalTrainLoss += loss
+            trainCorrect += (pred.argmax(1) == y).type(torch.float).sum().item()
+
+        # switch off autograd for evaluation
+        with torch.no_grad():
+            # set the model in evaluation mode
+            model.eval()
+            # loop over the validation set
+            for x, y in valDataLoader:
+                # send the input to the device
+                (x, y) = (x.to(device), y.to(device))
+                # make the predictions and calculate the validation loss
+                pred = model(x)
+                totalValLoss += lossFn(pred, y)
+                # calculate the number of correct predictions
+                valCorrect += (pred.argmax(1) == y).type(torch.float).sum().item()
+
+        # calculate the average training and validation loss
+        avgTrainLoss = totalTrainLoss / trainSteps
+        avgValLoss = totalValLoss / valSteps
+        # calculate the training and validation accuracy
+        trainCorrect = trainCorrect / max(1, len(trainDataLoader.dataset))
+        valCorrect = valCorrect / max(1, len(valDataLoader.dataset))
+        # update our training history
+        H["train_loss"].append(float(avgTrainLoss))
+        H["train_acc"].append(trainCorrect)
+        H["val_loss"].append(float(avgValLoss))
+        H["val_acc"].append(valCorrect)
+        # print the model training and validation information
+        print("[INFO] EPOCH: {}/{}".format(e + 1, epochs))
+        print(
+            "Train loss: {:.6f}, Train accuracy: {:.4f}".format(
+                avgTrainLoss, trainCorrect
+            )
+        )
+        print("Val loss: {:.6f}, Val accuracy: {:.4f}\n".format(avgValLoss, valCorrect))
+
+    # finish measuring how long training took
+    endTime = time.time()
     print(
-        "Train loss: {:.6f}, Train accuracy: {:.4f}".format(avgTrainLoss, trainCorrect)
+        "[INFO] total time taken to train the model: {:.2f}s".format(
+            endTime - startTime
+        )
     )
-    print("Val loss: {:.6f}, Val accuracy: {:.4f}\n".format(avgValLoss, valCorrect))
-
-# finish measuring how long training took
-endTime = time.time()
-print("[INFO] total time taken to train the model: {:.2f}s".format(endTime - startTime))
-
-# plot the training loss and accuracy
-plt.style.use("ggplot")
-plt.figure()
-plt.plot(H["train_loss"], label="train_loss")
-plt.plot(H["val_loss"], label="val_loss")
-plt.plot(H["train_acc"], label="train_acc")
-plt.plot(H["val_acc"], label="val_acc")
-plt.title("Training Loss and Accuracy on Dataset")
-plt.xlabel("Epoch #")
-plt.ylabel("Loss/Accuracy")
-plt.legend(loc="lower left")
-plt.savefig(args["plot"])
-# serialize the model to disk
-torch.save(model, args["model"])
+    model.eval()
+    return model.cpu(), H
+
+
+def plot_history(H: dict, path: str) -> None:
+    # plot the training loss and accuracy
+    plt.style.use("ggplot")
+    plt.figure()
+    plt.plot(H["train_loss"], label="train_loss")
+    plt.plot(H["val_loss"], label="val_loss")
+    plt.plot(H["train_acc"], label="train_acc")
+    plt.plot(H["val_acc"], label="val_acc")
+    plt.title("Training Loss and Accuracy on Dataset")
+    plt.xlabel("Epoch #")
+    plt.ylabel("Loss/Accuracy")
+    plt.legend(loc="lower left")
+    plt.savefig(path)
+
+
+if __name__ == "__main__":
+    # construct the argument parser and parse the arguments
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "-m", "--model", type=str, required=True, help="path to output trained model"
+    )
+    ap.add_argument(
+        "-p",
+        "--plot",
+        type=str,
+        required=True,
+        help="path to output loss/accuracy plot",
+    )
+    ap.add_argument(
+        "-d",
+        "--data",
+        type=str,
+        nargs="+",
+        help="folders of labelled images to train on, TRAIN_DATA_FOLDER by default",
+    )
+    ap.add_argument(
+        "-e", "--epochs", type=int, default=EPOCHS, help="how many epochs to train for"
+    )
+    args = vars(ap.parse_args())
+
+    if args["data"] is None:
+        from global_variables import TRAIN_DATA_FOLDER
+
+        args["data"] = TRAIN_DATA_FOLDER
+
+    model, H = train(args["data"], epochs=args["epochs"])
+    plot_history(H, args["plot"])
+    # serialize the model to disk
+    torch.save(model, args["model"])
@@ -0,0 +1,331 @@
+"""
+Records polls into archives and replays them without a browser.
+
+With RECORD_FOLDER set, every poll is saved as a zip archive holding the HTML of every
+page the scraper determined the state of, the CAPTCHAs it solved, the results it
+extracted and when each of these happened (manifest.json). Replaying an archive runs
+determineState, CaptchaSolver and extractResults on the recorded pages and reports what
+came out differently and how long each step took, see benchmarks/replay.py.
+
+Replaying needs lxml and cssselect, which aren't installed with the bot.
+"""
+
+import glob
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
+from functools import lru_cache
+from global_variables import get_logger, RECORD_FOLDER
+
+logger = get_logger("recording")
+
+MANIFEST_FILE = "manifest.json"
+# How many archives of an account are kept, the oldest ones are deleted
+KEEP_RECORDINGS = 100
+
+
+class Recorder:
+    """
+    Writes the pages, CAPTCHAs and results of a poll into a zip archive as they come.
+    """
+
+    def __init__(self, path: str, name: str, site: str):
+        self.path = path
+        self.temporary_path = f"{path}.tmp"
+        self.manifest = {"name": name, "site": site, "started": time.time()}
+        self.events: list[dict] = []
+        self.start_time = time.perf_counter()
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.archive = zipfile.ZipFile(
+            self.temporary_path, "w", zipfile.ZIP_DEFLATED, compresslevel=6
+        )
+
+    def add(self, kind: str, extension: str, data: bytes, **values) -> None:
+        with self.lock:
+            file = f"{len(self.events):04d}-{kind}.{extension}"
+            self.archive.writestr(file, data)
+            self.events.append(
+                {
+                    "kind": kind,
+                    "file": file,
+                    "at": round(time.perf_counter() - self.start_time, 4),
+                    **values,
+                }
+            )
+
+    def page(self, state: str, html: str) -> None:
+        self.add("page", "html", html.encode("utf-8"), state=state)
+
+    def captcha(self, png: bytes, result: int | None, seconds: float) -> None:
+        self.add("captcha", "png", png, result=result, seconds=round(seconds, 4))
+
+    def results(self, html: str, results: list[dict], seconds: float) -> None:
+        self.add(
+            "results",
+            "html",
+            html.encode("utf-8"),
+            results=results,
+            seconds=round(seconds, 4),
+        )
+
+    def close(self) -> None:
+        """
+        Writes the manifest and moves the archive in place, nothing is kept of a poll
+        that recorded nothing.
+        """
+        with self.lock:
+            self.manifest["events"] = self.events
+            self.archive.writestr(
+                MANIFEST_FILE, json.dumps(self.manifest, ensure_ascii=False, indent=1)
+            )
+            self.archive.close()
+            if self.events:
+                os.replace(self.temporary_path, self.path)
+            else:
+                os.remove(self.temporary_path)
+
+
+def prune(folder: str, name: str, keep: int = KEEP_RECORDINGS) -> None:
+    paths = sorted(
+        glob.glob(os.path.join(glob.escape(folder), f"{glob.escape(name)}-*.zip"))
+    )
+    for path in paths[:-keep]:
+        try:
+            os.remove(path)
+        except OSError:
+            ...
+
+
+@contextmanager
+def record(scraper):
+    """
+    Records the poll of the scraper into RECORD_FOLDER while in the context, if it is set.
+    """
+    if not RECORD_FOLDER:
+        yield None
+        return
+    name = "".join(c if c.isalnum() or c in "-_" else "_" for c in scraper.name)
+    path = os.path.join(
+        RECORD_FOLDER,
+        f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 10**9:09d}.zip",
+    )
+    recorder = Recorder(path, scraper.name, scraper.site.name)
+    scraper.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        scraper.recorder = None
+        try:
+            recorder.close()
+            prune(RECORD_FOLDER, name)
+        except Exception as e:
+            logger.exception(f"Exception while saving the recording, {e}")
+
+
+def load(path: str) -> tuple[dict, dict[str, bytes]]:
+    """
+    Returns the manifest of an archive and its files by name.
+    """
+    with zipfile.ZipFile(path, "r") as archive:
+        files = {name: archive.read(name) for name in archive.namelist()}
+    return json.loads(files.pop(MANIFEST_FILE)), files
+
+
+@lru_cache(maxsize=256)
+def compile_selector(by: str, value: str):
+    from cssselect import GenericTranslator
+    from lxml.etree import XPath
+
+    if by == "xpath":
+        return XPath(value)
+    css = {
+        "id": lambda: f"#{value}",
+        "name": lambda: f'[name="{value}"]',
+        "class name": lambda: f".{value}",
+        "tag name": lambda: value,
+        "css selector": lambda: value,
+    }[by]()
+    return XPath(GenericTranslator().css_to_xpath(css))
+
+
+class ReplayElement:
+    """
+    The parts of Selenium's WebElement the scraper uses, on a parsed HTML element.
+    """
+
+    def __init__(self, browser: "ReplayBrowser", element):
+        self.browser = browser
+        self.element = element
+
+    def find_element(self, by: str, value: str) -> "ReplayElement":
+        return self.browser.find_element(by, value, self)
+
+    def find_elements(self, by: str, value: str) -> list["ReplayElement"]:
+        return self.browser.find_elements(by, value, self)
+
+    @property
+    def text(self) -> str:
+        # Like Selenium, whitespace is collapsed and hidden elements have no text
+        if not self.is_displayed():
+            return ""
+        lines = (
+            " ".join(line.split()) for line in self.element.text_content().splitlines()
+        )
+        return "\n".join(line for line in lines if line)
+
+    @property
+    def screenshot_as_png(self) -> bytes:
+        return self.browser.captcha
+
+    def is_displayed(self) -> bool:
+        for element in (self.element, *self.element.iterancestors()):
+            style = element.get("style", "").replace(" ", "").lower()
+            if (
+                "display:none" in style
+                or "visibility:hidden" in style
+                or element.get("hidden") is not None
+                or element.get("type") == "hidden"
+            ):
+                return False
+        return True
+
+    def is_enabled(self) -> bool:
+        return self.element.get("disabled") is None
+
+    def get_attribute(self, name: str) -> str | None:
+        return self.element.get(name)
+
+    # What the scraper does to the page isn't replayed, the next recorded page already shows it
+    def click(self) -> None: ...
+
+    def clear(self) -> None: ...
+
+    def send_keys(self, *values) -> None: ...
+
+
+class ReplayBrowser:
+    """
+    Stands in for Firefox, finding elements on the recorded page that is loaded.
+    """
+
+    current_url = "about:replay"
+
+    def __init__(self):
+        self.document = None
+        self.captcha: bytes = None
+
+    def load(self, html: bytes) -> None:
+        from lxml import html as lxml_html
+
+        self.document = lxml_html.document_fromstring(html)
+
+    @property
+    def page_source(self) -> str:
+        from lxml import html as lxml_html
+
+        return lxml_html.tostring(self.document, encoding="unicode")
+
+    def find_elements(
+        self, by: str, value: str, parent: ReplayElement = None
+    ) -> list[ReplayElement]:
+        selector = compile_selector(by, value)
+        if parent is None:
+            found = selector(self.document)
+        elif by == "xpath":
+            found = selector(parent.element)
+        else:
+            # Like querySelectorAll on an element, the selector is matched against the
+            # whole page and only the descendants of the element are kept
+            found = [
+                element
+                for element in selector(self.document)
+                if any(a is parent.element for a in element.iterancestors())
+            ]
+        return [ReplayElement(self, element) for element in found]
+
+    def find_element(
+        self, by: str, value: str, parent: ReplayElement = None
+    ) -> ReplayElement:
+        from selenium.common.exceptions import NoSuchElementException
+
+        found = self.find_elements(by, value, parent)
+        if not found:
+            raise NoSuchElementException(f"Unable to locate element: {by}={value}")
+        return found[0]
+
+    def get(self, url: str) -> None: ...
+
+    def refresh(self) -> None: ...
+
+    def quit(self) -> None: ...
+
+
+def replay(path: str, profile=None) -> dict:
+    """
+    Replays an archive and returns how many steps were replayed, the ones whose outcome
+    differs from the recorded one and how long each kind of step took in total. The
+    site profile is the recorded site's unless one is given.
+    """
+    import numpy as np
+    from PIL import Image
+    from selenium.webdriver.support.ui import WebDriverWait
+    from ocr import solver as s
+    from scraper import Scraper
+    import sites
+
+    manifest, files = load(path)
+    if profile is None:
+        profiles = sites.load_sites()
+        profile = profiles.get(manifest["site"], profiles[sites.DEFAULT_SITE])
+    browser = ReplayBrowser()
+    scraper = Scraper(manifest["name"], None, None, site=profile, name=manifest["name"])
+    scraper.browser = browser
+    # What isn't on a recorded page never shows up, so there is nothing to wait for
+    scraper.wait = WebDriverWait(driver=browser, timeout=0)
+
+    seconds = {"page": 0.0, "captcha": 0.0, "results": 0.0}
+    mismatches = []
+    for event in manifest["events"]:
+        data = files[event["file"]]
+        start_time = time.perf_counter()
+        if event["kind"] == "page":
+            browser.load(data)
+            try:
+                outcome = scraper.determineState()
+            except Exception:
+                outcome = "unknown"
+            expected = event["state"]
+        elif event["kind"] == "captcha":
+            image = np.array(Image.open(io.BytesIO(data)))
+            outcome = s.CaptchaSolver(
+                image,
+                pipeline=profile.captcha_pipeline,
+                positions=profile.captcha_positions,
+                offsets=profile.captcha_offsets,
+                model_path=profile.model_path,
+            ).solve_captcha()
+            expected = event["result"]
+        else:
+            browser.load(data)
+            try:
+                scraper.extractResults()
+                outcome = scraper.results
+            except Exception as e:
+                outcome = f"{type(e).__name__}: {e}"
+            expected = event["results"]
+        seconds[event["kind"]] += time.perf_counter() - start_time
+        if outcome != expected:
+            mismatches.append(
+                {"file": event["file"], "expected": expected, "replayed": outcome}
+            )
+    scraper.browser = None
+    return {
+        "steps": len(manifest["events"]),
+        "mismatches": mismatches,
+        "seconds": seconds,
+    }
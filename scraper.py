@@ -1,36 +1,123 @@
 from selenium import webdriver
+from selenium.webdriver.firefox.service import Service
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 from typing import Literal
+import threading
 from PIL import Image
 import numpy as np
 import io
+import time
 from ocr import solver as s
-from global_variables import logger, OBS_LOGIN_URL
+from ocr import samples
+from global_variables import get_logger, OCR_MODEL_PATH
+import circuit
+import lifecycle
+import recording
+import sites
+import metrics
+import tracing
+
+logger = get_logger("scraper")
+
+# How many errors in a row a poll tolerates before giving up until the next one
+MAX_RETRIES = 5
+# How long to wait for a page to load, in seconds. Selenium waits for 5 minutes by default
+PAGE_LOAD_TIMEOUT = 30
+
+
+class Firefox(webdriver.Firefox):
+    """
+    Firefox driver that counts the WebDriver commands it sends. Its geckodriver and
+    Firefox processes are marked as the bot's, see lifecycle.py.
+    """
+
+    def __init__(self, label: str, *args, **kwargs):
+        self.label = label
+        kwargs.setdefault("service", Service(env=lifecycle.browser_environment()))
+        super().__init__(*args, **kwargs)
+
+    def execute(self, driver_command: str, params: dict = None) -> dict:
+        metrics.WEBDRIVER_COMMANDS.inc(account=self.label, command=driver_command)
+        return super().execute(driver_command, params)
 
 
 class Scraper:
     browser: webdriver.Firefox = None
     state: Literal["init", "mainmenu", "form", "examresults", "recaptcha"] = "init"
     results = None
-
-    def __init__(self, label: str, username: str, password: str):
+    # Time spent logging in during the current poll
+    login_seconds = 0.0
+    # Whether the outcome of the last login attempt is yet to be seen
+    awaiting_login = False
+    # The solver of the last login attempt and the CAPTCHA it solved, as a PNG
+    solver: s.CaptchaSolver = None
+    captcha: bytes = None
+    # Records the pages of the current poll, see recording.py
+    recorder: recording.Recorder = None
+
+    def __init__(
+        self,
+        label: str,
+        username: str,
+        password: str,
+        stopped: threading.Event = None,
+        site: sites.SiteProfile = None,
+        name: str = None,
+    ):
         logger.info("Initializing Scraper.")
         self.label = label
+        # Tells the accounts of a department apart, the label by default
+        self.name = name or label
         self.username = username
         self.password = password
-
-    def navigateSite(self) -> None:
-        while True:
-            logger.info("Navigating site..")
-            self.determineState()
+        # The OBS instance of the account, its URL, page layout and CAPTCHA model
+        self.site = site or sites.load_sites()[sites.DEFAULT_SITE]
+        self.selectors = self.site.selectors
+        # Set to make navigateSite give up, e.g. when shutting down
+        self.stopped = stopped or threading.Event()
+
+    @tracing.traced()
+    def navigateSite(self) -> bool:
+        """
+        Goes to the exam results page, logging in if needed. Gives up after MAX_RETRIES
+        errors in a row or when the scraper is stopped. Returns whether the page was
+        reached.
+        """
+        breaker = circuit.get(self.site.login_url)
+        errors = 0
+        while not self.stopped.is_set():
+            # Wait while OBS is down instead of trying again right away
+            if not breaker.wait(self.stopped):
+                return False
+            logger.debug("Navigating site..")
             try:
+                self.determineState()
+                if self.awaiting_login:
+                    self.awaiting_login = False
+                    solved = self.state != "init"
+                    metrics.CAPTCHA_ATTEMPTS.inc(
+                        account=self.name,
+                        outcome="solved" if solved else "failed",
+                    )
+                    self.recordSamples(solved)
                 match self.state:
                     case "recaptcha":
+                        # OBS asks for it when it sees too many logins, restarting
+                        # the browser right away would only make it ask again
+                        breaker.record_failure()
+                        errors += 1
+                        if errors >= MAX_RETRIES:
+                            logger.warning(
+                                f"Giving up on this poll after {errors} errors in a row."
+                            )
+                            return False
                         logger.info(
                             "ReCAPTCHA detected. Shutting the browser down and rebooting."
                         )
                         self.stop()
+                        if self.stopped.wait(circuit.backoff(errors)):
+                            return False
                         self.start()
                         continue
                     case "init":
@@ -40,15 +127,36 @@ class Scraper:
                     case "mainmenu":
                         self.enterResultsPage()
                     case "examresults":
-                        return
+                        breaker.record_success()
+                        return True
+                breaker.record_success()
+                errors = 0
             except Exception as e:
                 logger.exception(e)
-                self.browser.refresh()
+                breaker.record_failure()
+                errors += 1
+                if errors >= MAX_RETRIES:
+                    logger.warning(
+                        f"Giving up on this poll after {errors} errors in a row."
+                    )
+                    return False
+                if self.stopped.wait(circuit.backoff(errors)):
+                    return False
+                try:
+                    # The browser is gone if restarting it after a ReCAPTCHA failed
+                    if self.browser is None:
+                        self.start()
+                    else:
+                        self.refresh()
+                except Exception as e:
+                    logger.info(f"Couldn't refresh the page, {e}")
+        return False
 
+    @tracing.traced()
     def determineState(
         self,
     ) -> Literal["init", "mainmenu", "form", "examresults", "recaptcha"]:
-        logger.info("Determining state.. ")
+        logger.debug("Determining state.. ")
         if self.isReCaptcha():
             self.state = "recaptcha"
         if self.isInLogin():
@@ -60,26 +168,46 @@ class Scraper:
         elif self.isInExamResults():
             self.state = "examresults"
         else:
+            self.recordPage("unknown")
             raise Exception("Unknown state.")
+        self.recordPage(self.state)
         return self.state
 
+    def recordPage(self, state: str) -> None:
+        if self.recorder is not None:
+            self.recorder.page(state, self.browser.page_source)
+
+    def recordSamples(self, solved: bool) -> None:
+        """
+        Saves what the last CAPTCHA was read as, a successful login proves it was right.
+        Only CAPTCHAs read by the default model are saved, since it is the one fine-tuned.
+        """
+        if self.site.model_path != OCR_MODEL_PATH:
+            return
+        try:
+            samples.record(
+                self.solver.crops, self.captcha, self.solver.result, confirmed=solved
+            )
+        except Exception as e:
+            logger.exception(f"Exception while saving the CAPTCHA samples, {e}")
+
     def isReCaptcha(self):
         try:
-            self.browser.find_element("css selector", ".g-recaptcha")
+            self.browser.find_element(*self.selectors["recaptcha"])
             return True
         except Exception:
             return False
 
     def isInLogin(self):
         try:
-            self.browser.find_element("css selector", "#recover")
+            self.browser.find_element(*self.selectors["login_page"])
             return True
         except Exception:
             return False
 
     def isInForm(self):
         try:
-            form = self.browser.find_element("xpath", "/html/body/div[16]")
+            form = self.browser.find_element(*self.selectors["form"])
             form_bool = form.is_displayed()
             return form_bool
         except Exception:
@@ -87,51 +215,69 @@ class Scraper:
 
     def isInMainmenu(self):
         try:
-            self.browser.find_element("css selector", "#column-1")
+            self.browser.find_element(*self.selectors["main_menu"])
             return True
         except Exception:
             return False
 
     def isInExamResults(self):
         try:
-            self.browser.find_element("css selector", "#confirmationReport-list")
+            self.browser.find_element(*self.selectors["results_page"])
             return True
         except Exception:
             return False
 
+    @tracing.traced()
     def attemptLogin(self):
         logger.info("Attempting to log in..")
-        elements = self.getLoginElements()
-        elements["username"].clear()
-        elements["username"].send_keys(self.username)
-        elements["password"].clear()
-        elements["password"].send_keys(self.password)
-        image = self.getCaptchaImage(elements["captcha_photo"])
-        solver = s.CaptchaSolver(image)
-        result = solver.solve_captcha()
-        if result is None:
-            self.browser.refresh()
-            return
-        elements["captcha"].clear()
-        elements["captcha"].send_keys(str(result))
-        elements["login"].click()
+        start_time = time.perf_counter()
+        try:
+            elements = self.getLoginElements()
+            elements["username"].clear()
+            elements["username"].send_keys(self.username)
+            elements["password"].clear()
+            elements["password"].send_keys(self.password)
+            image = self.getCaptchaImage(elements["captcha_photo"])
+            solver = s.CaptchaSolver(
+                image,
+                pipeline=self.site.captcha_pipeline,
+                positions=self.site.captcha_positions,
+                offsets=self.site.captcha_offsets,
+                model_path=self.site.model_path,
+            )
+            solve_start = time.perf_counter()
+            result = solver.solve_captcha()
+            if self.recorder is not None:
+                self.recorder.captcha(
+                    self.captcha, result, time.perf_counter() - solve_start
+                )
+            if result is None:
+                metrics.CAPTCHA_ATTEMPTS.inc(account=self.name, outcome="unreadable")
+                self.browser.refresh()
+                return
+            elements["captcha"].clear()
+            elements["captcha"].send_keys(str(result))
+            elements["login"].click()
+            self.solver = solver
+            self.awaiting_login = True
+        finally:
+            self.login_seconds += time.perf_counter() - start_time
 
     def getCaptchaImage(self, captcha_photo):
-        return np.array(Image.open(io.BytesIO(captcha_photo.screenshot_as_png)))
+        self.captcha = captcha_photo.screenshot_as_png
+        return np.array(Image.open(io.BytesIO(self.captcha)))
 
     def getLoginElements(self):
         logger.info("Getting login elements..")
         self.wait.until(
-            (EC.element_to_be_clickable(("css selector", "#btnSend")))
-            and (EC.invisibility_of_element_located(("css selector", ".page_spinner")))
-        )
-        username_input = self.browser.find_element("css selector", "#OtherUsername")
-        password_input = self.browser.find_element("css selector", "#OtherPassword")
-        captcha_photo = self.browser.find_element(
-            "xpath", "/html/body/div[4]/form/div[4]/img"
+            (EC.element_to_be_clickable(self.selectors["login_button"]))
+            and (EC.invisibility_of_element_located(self.selectors["spinner"]))
         )
-        captcha_input = self.browser.find_element("css selector", "#Captcha")
-        login_button = self.browser.find_element("css selector", "#btnSend")
+        username_input = self.browser.find_element(*self.selectors["username"])
+        password_input = self.browser.find_element(*self.selectors["password"])
+        captcha_photo = self.browser.find_element(*self.selectors["captcha_image"])
+        captcha_input = self.browser.find_element(*self.selectors["captcha_input"])
+        login_button = self.browser.find_element(*self.selectors["login_button"])
 
         return {
             "username": username_input,
@@ -141,81 +287,42 @@ class Scraper:
             "login": login_button,
         }
 
+    @tracing.traced()
     def closeForm(self):
         logger.info("Closing form..")
-        self.wait.until(
-            EC.presence_of_element_located(
-                ("xpath", "/html/body/div[16]/div[3]/div/button")
-            )
-        )
-        form_button = self.browser.find_element(
-            "xpath", "/html/body/div[16]/div[3]/div/button"
-        )
-        self.wait.until(
-            EC.element_to_be_clickable(
-                ("xpath", "/html/body/div[16]/div[3]/div/button")
-            )
-        )
-        self.wait.until(EC.invisibility_of_element(("xpath", "/html/body/div[1]")))
+        self.wait.until(EC.presence_of_element_located(self.selectors["form_close"]))
+        form_button = self.browser.find_element(*self.selectors["form_close"])
+        self.wait.until(EC.element_to_be_clickable(self.selectors["form_close"]))
+        self.wait.until(EC.invisibility_of_element(self.selectors["overlay"]))
         form_button.click()
-        self.wait.until(
-            EC.invisibility_of_element(
-                ("xpath", "/html/body/div[16]/div[3]/div/button")
-            )
-        )
+        self.wait.until(EC.invisibility_of_element(self.selectors["form_close"]))
 
+    @tracing.traced()
     def enterResultsPage(self):
         logger.info("Entering the exam results page..")
-        self.wait.until(
-            EC.visibility_of_element_located(
-                ("xpath", "/html/body/div[8]/div[1]/ul/li[1]/a")
-            )
-        )
-        button_1 = self.browser.find_element(
-            "xpath", "/html/body/div[8]/div[1]/ul/li[1]/a"
-        )
-        button_1.click()
-        self.wait.until(
-            EC.visibility_of_element_located(
-                ("xpath", "/html/body/div[8]/div[1]/ul/li[1]/ul/li[2]/a")
-            )
-        )
-        button_2 = self.browser.find_element(
-            "xpath", "/html/body/div[8]/div[1]/ul/li[1]/ul/li[2]/a"
-        )
-        button_2.click()
-        self.wait.until(
-            EC.visibility_of_element_located(
-                ("xpath", "/html/body/div[8]/div[1]/ul/li[1]/ul/li[2]/ul/li[4]/a")
-            )
-        )
-        button_3 = self.browser.find_element(
-            "xpath", "/html/body/div[8]/div[1]/ul/li[1]/ul/li[2]/ul/li[4]/a"
-        )
-        button_3.click()
+        for menu_item in ("menu_1", "menu_2", "menu_3"):
+            self.wait.until(EC.visibility_of_element_located(self.selectors[menu_item]))
+            self.browser.find_element(*self.selectors[menu_item]).click()
 
+    @tracing.traced()
     def extractResults(self):
         logger.info("Extracting exam results..")
+        start_time = time.perf_counter()
         self.wait.until(
-            EC.visibility_of_element_located(("xpath", '//*[@id="btnToggle"]'))
+            EC.visibility_of_element_located(self.selectors["results_toggle"])
         )
         results = []
-        open_all = self.browser.find_element("xpath", '//*[@id="btnToggle"]')
+        open_all = self.browser.find_element(*self.selectors["results_toggle"])
         open_all.click()
+        html = self.browser.page_source if self.recorder is not None else None
 
-        lesson_table = self.browser.find_element(
-            "xpath", "/html/body/div[8]/div[4]/div[5]/form/table/tbody"
-        )
+        lesson_table = self.browser.find_element(*self.selectors["results_table"])
 
         # Get the necessary elements from the lesson table
-        normal_tr_tags = lesson_table.find_elements(
-            "css selector", "#confirmationReport-list > tbody > tr:not(.sub-tr)"
-        )
-        subtr_tr_tags = lesson_table.find_elements(
-            "css selector", "#confirmationReport-list > tbody > tr.sub-tr"
-        )
+        normal_tr_tags = lesson_table.find_elements(*self.selectors["lecture_rows"])
+        subtr_tr_tags = lesson_table.find_elements(*self.selectors["exam_rows"])
         try:
-            surveys = lesson_table.find_elements("css selector", "a.noteview-survey")
+            surveys = lesson_table.find_elements(*self.selectors["surveys"])
         except Exception:
             surveys = []
 
@@ -229,18 +336,12 @@ class Scraper:
         for i in range(len(normal_tr_tags)):
             lesson_information = {"name": None, "exams": []}
             lesson_information["name"] = (
-                normal_tr_tags[i]
-                .find_element(
-                    "css selector",
-                    "#confirmationReport-list > tbody > tr > td:nth-child(1)",
-                )
-                .text
+                normal_tr_tags[i].find_element(*self.selectors["lecture_name"]).text
             )
             is_surveyed = False
             try:
                 surveys = normal_tr_tags[i].find_element(
-                    "css selector",
-                    "#confirmationReport-list > tbody > tr > td.textC > a.noteview-survey",
+                    *self.selectors["lecture_survey"]
                 )
                 # If an element is found, that means there is a survey.
                 # Which means exam data must be extracted a different way.
@@ -256,18 +357,14 @@ class Scraper:
                         "name": "Harf Notu / Letter Grade",
                         "percentage": "%100",
                         "date": normal_tr_tags[i]
-                        .find_element(
-                            "css selector",
-                            "#confirmationReport-list > tbody > tr > td:nth-child(3)",
-                        )
+                        .find_element(*self.selectors["lecture_date"])
                         .text,
                     }
                 )
             else:
                 try:
                     subtr_info = subtr_tr_tags[i - survey_count].find_elements(
-                        "xpath",
-                        ".//td[2]/table/tbody/tr[count(*) > 1]",
+                        *self.selectors["exams"]
                     )
                 except Exception:
                     logger.info(
@@ -279,19 +376,21 @@ class Scraper:
                     lesson_information["exams"].append(
                         {
                             "name": subtr.find_element(
-                                "css selector", "td:nth-child(1)"
+                                *self.selectors["exam_name"]
                             ).text,
                             "percentage": subtr.find_element(
-                                "css selector", "td:nth-child(3)"
+                                *self.selectors["exam_percentage"]
                             ).text,
                             "date": subtr.find_element(
-                                "css selector", "td:nth-child(4)"
+                                *self.selectors["exam_date"]
                             ).text,
                         }
                     )
             # print(lesson_information)
             results.append(lesson_information)
         self.results = results
+        if self.recorder is not None:
+            self.recorder.results(html, results, time.perf_counter() - start_time)
 
     def stop(self):
         logger.info("Quitting the scraper..")
@@ -302,13 +401,23 @@ class Scraper:
 
     def start(self):
         logger.info("Starting the scraper..")
-        browser = webdriver.Firefox()
-        browser.get(OBS_LOGIN_URL)
+        browser = Firefox(self.name)
+        browser.set_page_load_timeout(PAGE_LOAD_TIMEOUT)
         self.browser = browser
         self.wait = WebDriverWait(driver=self.browser, timeout=10, poll_frequency=1)
+        try:
+            browser.get(self.site.login_url)
+        except Exception as e:
+            # navigateSite tries again once the site is back
+            logger.warning(f"Couldn't open the login page, {e}")
+            circuit.get(self.site.login_url).record_failure()
 
     def refresh(self):
-        self.browser.refresh()
+        # The login page never loaded if OBS was down when the browser started
+        if self.browser.current_url.startswith("about:"):
+            self.browser.get(self.site.login_url)
+        else:
+            self.browser.refresh()
 
     def __del__(self):
         self.stop()
@@ -0,0 +1,172 @@
+import json
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from global_variables import (
+    get_logger,
+    OBS_LOGIN_URL,
+    OCR_MODEL_PATH,
+    OCR_PIPELINE,
+    SITES_JSON_PATH,
+)
+
+logger = get_logger("sites")
+
+# The site of the accounts that don't name one
+DEFAULT_SITE = "ankara"
+
+# How the scraper finds the elements it needs, as (strategy, value) for Selenium's
+# find_element. These are the ones of Ankara University's OBS
+DEFAULT_SELECTORS: dict[str, tuple[str, str]] = {
+    "recaptcha": ("css selector", ".g-recaptcha"),
+    "login_page": ("css selector", "#recover"),
+    "username": ("css selector", "#OtherUsername"),
+    "password": ("css selector", "#OtherPassword"),
+    "captcha_image": ("xpath", "/html/body/div[4]/form/div[4]/img"),
+    "captcha_input": ("css selector", "#Captcha"),
+    "login_button": ("css selector", "#btnSend"),
+    "spinner": ("css selector", ".page_spinner"),
+    "form": ("xpath", "/html/body/div[16]"),
+    "form_close": ("xpath", "/html/body/div[16]/div[3]/div/button"),
+    "overlay": ("xpath", "/html/body/div[1]"),
+    "main_menu": ("css selector", "#column-1"),
+    # The menu items clicked, in order, to get from the main menu to the results
+    "menu_1": ("xpath", "/html/body/div[8]/div[1]/ul/li[1]/a"),
+    "menu_2": ("xpath", "/html/body/div[8]/div[1]/ul/li[1]/ul/li[2]/a"),
+    "menu_3": ("xpath", "/html/body/div[8]/div[1]/ul/li[1]/ul/li[2]/ul/li[4]/a"),
+    "results_page": ("css selector", "#confirmationReport-list"),
+    "results_toggle": ("xpath", '//*[@id="btnToggle"]'),
+    "results_table": ("xpath", "/html/body/div[8]/div[4]/div[5]/form/table/tbody"),
+    "lecture_rows": (
+        "css selector",
+        "#confirmationReport-list > tbody > tr:not(.sub-tr)",
+    ),
+    "exam_rows": ("css selector", "#confirmationReport-list > tbody > tr.sub-tr"),
+    "surveys": ("css selector", "a.noteview-survey"),
+    # Inside a lecture row
+    "lecture_name": (
+        "css selector",
+        "#confirmationReport-list > tbody > tr > td:nth-child(1)",
+    ),
+    "lecture_survey": (
+        "css selector",
+        "#confirmationReport-list > tbody > tr > td.textC > a.noteview-survey",
+    ),
+    "lecture_date": (
+        "css selector",
+        "#confirmationReport-list > tbody > tr > td:nth-child(3)",
+    ),
+    # Inside an exam row
+    "exams": ("xpath", ".//td[2]/table/tbody/tr[count(*) > 1]"),
+    # Inside an exam
+    "exam_name": ("css selector", "td:nth-child(1)"),
+    "exam_percentage": ("css selector", "td:nth-child(3)"),
+    "exam_date": ("css selector", "td:nth-child(4)"),
+}
+
+
+@dataclass(frozen=True)
+class SiteProfile:
+    """
+    Everything that differs between the OBS instances of universities. The CAPTCHA
+    settings left as None use the defaults of ocr/solver.py.
+    """
+
+    name: str
+    login_url: str
+    selectors: dict[str, tuple[str, str]] = field(
+        default_factory=lambda: dict(DEFAULT_SELECTORS)
+    )
+    model_path: str = OCR_MODEL_PATH
+    captcha_pipeline: str = OCR_PIPELINE
+    # Where the numbers are on the CAPTCHA, (x, y) by "left" and "right"
+    captcha_positions: dict[str, tuple[int, int]] = None
+    # Where the numbers are relative to the operator, (x, y) by "left" and "right"
+    captcha_offsets: dict[str, tuple[int, int]] = None
+    # How many accounts of the site are polled at the same time at most, 0 for no limit
+    max_concurrency: int = 0
+
+
+def parse_profile(name: str, entry: dict, default: SiteProfile) -> SiteProfile:
+    """
+    Creates a profile from an entry of the sites file, taking anything it doesn't set
+    (selectors one by one) from the default profile.
+    """
+
+    def points(value: dict) -> dict[str, tuple[int, int]]:
+        return {side: tuple(point) for side, point in value.items()}
+
+    selectors = dict(default.selectors)
+    selectors.update(
+        {key: tuple(selector) for key, selector in entry.get("selectors", {}).items()}
+    )
+    return replace(
+        default,
+        name=name,
+        login_url=entry.get("login_url", default.login_url),
+        selectors=selectors,
+        model_path=entry.get("model_path", default.model_path),
+        captcha_pipeline=entry.get("captcha_pipeline", default.captcha_pipeline),
+        captcha_positions=(
+            points(entry["captcha_positions"])
+            if "captcha_positions" in entry
+            else default.captcha_positions
+        ),
+        captcha_offsets=(
+            points(entry["captcha_offsets"])
+            if "captcha_offsets" in entry
+            else default.captcha_offsets
+        ),
+        max_concurrency=entry.get("max_concurrency", default.max_concurrency),
+    )
+
+
+def load_sites() -> dict[str, SiteProfile]:
+    """
+    Returns the default site and the ones in SITES_JSON_PATH, by name. The file maps
+    names to the settings that differ from the default site, see sites.json.example.
+    """
+    default = SiteProfile(name=DEFAULT_SITE, login_url=OBS_LOGIN_URL)
+    profiles = {DEFAULT_SITE: default}
+    if not SITES_JSON_PATH:
+        return profiles
+    logger.info("Loading sites.")
+    with open(SITES_JSON_PATH, "r", encoding="utf-8") as file:
+        entries: dict[str, dict] = json.load(file)
+    # The default site can be changed in the file too
+    if DEFAULT_SITE in entries:
+        default = parse_profile(DEFAULT_SITE, entries[DEFAULT_SITE], default)
+        profiles[DEFAULT_SITE] = default
+    for name, entry in entries.items():
+        if name != DEFAULT_SITE:
+            profiles[name] = parse_profile(name, entry, default)
+    return profiles
+
+
+# Limits how many accounts of a site are polled at once, by site name and limit
+semaphores: dict[tuple[str, int], threading.Semaphore] = {}
+semaphores_lock = threading.Lock()
+
+
+@contextmanager
+def limit(profile: SiteProfile, stopped: threading.Event):
+    """
+    Waits until the site has fewer than max_concurrency polls running. Yields False
+    without waiting any longer if "stopped" is set in the meantime.
+    """
+    if profile.max_concurrency <= 0:
+        yield True
+        return
+    key = (profile.name, profile.max_concurrency)
+    with semaphores_lock:
+        if key not in semaphores:
+            semaphores[key] = threading.Semaphore(profile.max_concurrency)
+        semaphore = semaphores[key]
+    while not semaphore.acquire(timeout=1):
+        if stopped.is_set():
+            yield False
+            return
+    try:
+        yield True
+    finally:
+        semaphore.release()
@@ -1,8 +1,24 @@
 import asyncio
-from global_variables import BOT_TOKEN, logger
-from aiogram import Bot, Dispatcher, Router, html
+import time
+from typing import Any, Awaitable, Callable
+from global_variables import (
+    BOT_TOKEN,
+    BOT_MODE,
+    BOT_API_URL,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    SHUTDOWN_TIMEOUT,
+    get_logger,
+)
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, html
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.types import (
     Message,
@@ -10,17 +26,72 @@ from aiogram.types import (
     BotCommand,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
+    TelegramObject,
 )
 from aiogram.types.callback_query import CallbackQuery
-import manager as m
+import async_db as db
+import catalog
+import notifier
+import metrics
+
+logger = get_logger("telegram")
+
+
+class HandlerTimer(BaseMiddleware):
+    """
+    Observes how long each handler takes.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        start_time = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.HANDLER_SECONDS.observe(
+                time.perf_counter() - start_time,
+                handler=data["handler"].callback.__name__,
+            )
+
 
 # All handlers should be attached to the Router (or Dispatcher)
 dp = Dispatcher()
 
 # Create a router for message handlers
 router = Router()
+router.message.middleware(HandlerTimer())
+router.callback_query.middleware(HandlerTimer())
 dp.include_router(router)
 
+# Sends notifications on the bot's event loop, created when the bot starts
+dispatcher: "notifier.NotificationDispatcher" = None
+
+# Set once the bot starts receiving updates
+started = asyncio.Event()
+
+# How many buttons are shown on a single page of a keyboard
+PAGE_SIZE = 10
+
+DEPARTMENTS_TEXT = (
+    "Anlık notları takip edilen bölümler aşağıdadır: \n"
+    "Herhangi bir bölümün takip edilen derslerini görmek ve o dersin bildirimlerini almak için o bölüme tıklabilirsiniz."
+)
+
+NOTIFICATIONS_TEXT = (
+    "Bildirimlerini takip ettiğiniz bölümler aşağıdadır: \n"
+    "Herhangi bir bölüme tıklayarak bildirimlerini almayı bırakabilirsiniz."
+)
+
+
+@dp.startup()
+async def on_startup() -> None:
+    logger.info("The bot is up.")
+    started.set()
+
 
 @router.message(Command("start"))
 async def command_start_handler(message: Message) -> None:
@@ -41,16 +112,8 @@ async def bolumler_handler(message: Message) -> None:
     """
     This handler recieves messages with "/bolumler" command
     """
-    inline_keyboard = [
-        [InlineKeyboardButton(text=name, callback_data=f"dept_{id}")]
-        for id, name in m.get_departments()
-    ]
-    keyboard = InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
-    text = (
-        "Anlık notları takip edilen bölümler aşağıdadır: \n"
-        "Herhangi bir bölümün takip edilen derslerini görmek ve o dersin bildirimlerini almak için o bölüme tıklabilirsiniz."
-    )
-    await message.answer(text, reply_markup=keyboard)
+    keyboard = departments_keyboard(await catalog.cache.get(), 0)
+    await message.answer(DEPARTMENTS_TEXT, reply_markup=keyboard)
 
 
 @router.message(Command("bildirimlerim"))
@@ -59,33 +122,43 @@ async def bildirimlerim_handler(message: Message) -> None:
     This handler revieces messages with "/bildirimlerim" command.
 
     """
-    inline_keyboard = [
-        [
-            InlineKeyboardButton(
-                text=m.get_lecture_name(id), callback_data=f"lecture_{id}"
-            )
-        ]
-        for id in m.get_user_notifications(message.from_user.id)
-    ]
-    keyboard = InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
-    text = (
-        "Bildirimlerini takip ettiğiniz bölümler aşağıdadır: \n"
-        "Herhangi bir bölüme tıklayarak bildirimlerini almayı bırakabilirsiniz."
-    )
-    await message.answer(text, reply_markup=keyboard)
+    keyboard = await notifications_keyboard(message.from_user.id, 0)
+    await message.answer(NOTIFICATIONS_TEXT, reply_markup=keyboard)
 
 
 @router.callback_query()
 async def callback_matcher(call: CallbackQuery):
-    prefix = call.data[: call.data.find("_")]
-    data = call.data[call.data.find("_") + 1 :]
+    # Callback data is a prefix followed by integer arguments, all separated by "_"
+    prefix, *args = call.data.split("_")
+    args = [int(arg) for arg in args]
+    if prefix not in ("l", "lecture", "u"):
+        # Stop the spinner on the user's side right away,
+        # toggling a lecture answers with the result instead
+        await call.answer()
     match prefix:
-        case "dept":
-            await dept_callback(call, data)
-            await call.message.delete()
-        case "lecture":
-            await lecture_callback(call, data)
-            await call.answer()
+        case "b":
+            await edit_message(
+                call,
+                DEPARTMENTS_TEXT,
+                departments_keyboard(await catalog.cache.get(), args[0]),
+            )
+        case "d" | "dept":
+            page = args[1] if len(args) > 1 else 0
+            await dept_callback(call, args[0], page)
+        case "l" | "lecture":
+            await call.answer(await lecture_callback(call, args[0]))
+        case "u":
+            text = await lecture_callback(call, args[0])
+            keyboard = await notifications_keyboard(call.from_user.id, args[1])
+            # Both requests go out together, the tap costs a single round-trip
+            await asyncio.gather(
+                call.answer(text), edit_message(call, reply_markup=keyboard)
+            )
+        case "n":
+            await edit_message(
+                call,
+                reply_markup=await notifications_keyboard(call.from_user.id, args[0]),
+            )
 
 
 @router.message(Command("hakkinda"))
@@ -104,56 +177,202 @@ async def ayarlar_handler(message: Message) -> None:
     await message.answer("ayarlar")
 
 
-async def dept_callback(call: CallbackQuery, data: str):
-    inline_keyboard = [
-        [InlineKeyboardButton(text=name, callback_data=f"lecture_{id}")]
-        for id, name in m.get_lectures(data)
-    ]
-    keyboard = InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
+async def dept_callback(call: CallbackQuery, dept_id: int, page: int):
+    snapshot = await catalog.cache.get()
+    if dept_id not in snapshot.department_names:
+        # The department is gone, show the ones that are left
+        await edit_message(call, DEPARTMENTS_TEXT, departments_keyboard(snapshot, 0))
+        return
     text = (
-        f"{html.bold(f"{m.get_department_name(data)}")} "
+        f"{html.bold(snapshot.department_names[dept_id])} "
         "bölümünde takip edilen dersler aşağıdadır: \n"
         "İstediğiniz derse tıklayarak bu dersin not açıklanma bildirimini etkinleştirebilirsiniz."
     )
-    await call.message.answer(text, reply_markup=keyboard)
+    await edit_message(call, text, lectures_keyboard(snapshot, dept_id, page))
 
 
-async def lecture_callback(call: CallbackQuery, data: str):
-    user_id = call.from_user.id
-    if not m.does_user_follow_lecture(data, user_id):
-        m.add_lecture_notification(data, user_id)
-        await call.message.answer(
-            f"{html.bold(m.get_lecture_name(data))} ders bildirim listenize eklendi! Bu derse yeni bir not girilince bildirim alacaksınız."
-        )
+async def lecture_callback(call: CallbackQuery, lecture_id: int) -> str:
+    """
+    Follows the lecture for the user or stops following it, returns the text to answer
+    the callback with.
+    """
+    followed = await db.toggle_lecture_notification(lecture_id, call.from_user.id)
+    lecture_name = (await catalog.cache.get()).lecture_names.get(lecture_id, "Bu")
+    # Callback answers can't be longer than 200 characters
+    if len(lecture_name) > 60:
+        lecture_name = lecture_name[:57] + "..."
+    if followed:
+        text = f"{lecture_name} ders bildirim listenize eklendi! Bu derse yeni bir not girilince bildirim alacaksınız."
     else:
-        m.delete_lecture_notification(data, user_id)
-        await call.message.answer(
-            f"{html.bold(m.get_lecture_name(data))} ders bildirim listenizden çıkarıldı! Artık bu ders ile ilgili bildirimler almayacaksınız."
+        text = f"{lecture_name} ders bildirim listenizden çıkarıldı! Artık bu ders ile ilgili bildirimler almayacaksınız."
+    return text
+
+
+async def edit_message(
+    call: CallbackQuery, text: str = None, reply_markup: InlineKeyboardMarkup = None
+) -> None:
+    """
+    Shows the text and keyboard in the message of the callback, only the keyboard is
+    changed if there is no text. Nothing is done if they are already shown, e.g. when
+    the button of the page that is open is pressed again.
+    """
+    if text is None and call.message.reply_markup == reply_markup:
+        return
+    try:
+        if text is None:
+            await call.message.edit_reply_markup(reply_markup=reply_markup)
+        else:
+            await call.message.edit_text(text, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in e.message:
+            raise
+
+
+def paginated_keyboard(
+    items: list[tuple[int, str]],
+    prefix: str,
+    page: int,
+    page_prefix: str,
+    pass_page: bool = False,
+) -> InlineKeyboardMarkup:
+    """
+    Builds a keyboard with a button for every item on the given page, with callback data
+    "{prefix}_{id}", and buttons for switching pages with callback data "{page_prefix}_{page}".
+    If "pass_page" is True, the page number is appended to the items' callback data.
+    """
+    page_count = max(1, -(-len(items) // PAGE_SIZE))
+    page = min(max(page, 0), page_count - 1)
+    suffix = f"_{page}" if pass_page else ""
+    inline_keyboard = [
+        [InlineKeyboardButton(text=name, callback_data=f"{prefix}_{id}{suffix}")]
+        for id, name in items[page * PAGE_SIZE : (page + 1) * PAGE_SIZE]
+    ]
+    if page_count > 1:
+        navigation = []
+        if page > 0:
+            navigation.append(
+                InlineKeyboardButton(
+                    text="◀️", callback_data=f"{page_prefix}_{page - 1}"
+                )
+            )
+        navigation.append(
+            InlineKeyboardButton(text=f"{page + 1}/{page_count}", callback_data="x")
+        )
+        if page < page_count - 1:
+            navigation.append(
+                InlineKeyboardButton(
+                    text="▶️", callback_data=f"{page_prefix}_{page + 1}"
+                )
+            )
+        inline_keyboard.append(navigation)
+    return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
+
+
+def departments_keyboard(
+    snapshot: "catalog.CatalogSnapshot", page: int
+) -> InlineKeyboardMarkup:
+    key = f"departments_{page}"
+    if key not in snapshot.cache:
+        snapshot.cache[key] = paginated_keyboard(snapshot.departments, "d", page, "b")
+    return snapshot.cache[key]
+
+
+def lectures_keyboard(
+    snapshot: "catalog.CatalogSnapshot", dept_id: int, page: int
+) -> InlineKeyboardMarkup:
+    key = f"lectures_{dept_id}_{page}"
+    if key not in snapshot.cache:
+        keyboard = paginated_keyboard(
+            snapshot.lectures.get(dept_id, []), "l", page, f"d_{dept_id}"
+        )
+        keyboard.inline_keyboard.append(
+            [InlineKeyboardButton(text="⬅️ Bölümler", callback_data="b_0")]
         )
+        snapshot.cache[key] = keyboard
+    return snapshot.cache[key]
 
 
-async def send_mass_notifications(
-    user_ids: list[str], lecture_name: str, exam_name: str
-):
-    for user_id in user_ids:
-        await send_notification(user_id, lecture_name, exam_name)
+async def notifications_keyboard(user_id: str, page: int) -> InlineKeyboardMarkup:
+    return paginated_keyboard(
+        await db.get_user_lectures(user_id), "u", page, "n", pass_page=True
+    )
+
 
+def wake_notifications() -> None:
+    """
+    Lets the dispatcher know new notifications were queued. Safe to call from the scraper threads.
+    If the bot isn't running yet, they will be sent once it starts.
+    """
+    if dispatcher is not None:
+        dispatcher.wake()
 
-async def send_notification(
-    user_id: str,
-    lecture_name: str,
-    exam_name: str,
-):
-    text = f"{html.bold(lecture_name)} dersinde {html.bold(exam_name)} sınavına dair bilgi girildi."
-    await Bot.send_message(chat_id=user_id, text=text)
+
+def create_bot(**kwargs) -> Bot:
+    """
+    Creates a Bot that talks to BOT_API_URL instead of Telegram if it is set.
+    """
+    session = None
+    if BOT_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL))
+    return Bot(token=BOT_TOKEN, session=session, **kwargs)
 
 
 async def start() -> None:
+    global dispatcher
     # Initialize Bot instance with default bot properties which will be passed to all API calls
-    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    bot = create_bot(default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+
+    notification_dispatcher = notifier.NotificationDispatcher(bot)
+    await notification_dispatcher.start()
+    dispatcher = notification_dispatcher
 
     # And the run events dispatching
-    await dp.start_polling(bot)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot)
+        else:
+            # Telegram doesn't allow polling while a webhook is set
+            await bot.delete_webhook()
+            # Signals are handled by main, which stops the scrapers before the bot
+            await dp.start_polling(bot, handle_signals=False)
+    finally:
+        # Runs when the task is cancelled too, the notifications queued by the
+        # scrapers' last polls are sent before the bot goes away
+        await dispatcher.stop(SHUTDOWN_TIMEOUT)
+        await bot.session.close()
+
+
+async def run_webhook(bot: Bot) -> None:
+    """
+    Serves Telegram's updates from a web server running on the current event loop.
+    """
+    # Only needed in webhook mode
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info(
+        f"Listening for updates on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}."
+    )
+
+    await bot.set_webhook(
+        url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 
 async def set_bot_commands(bot: Bot):
@@ -176,7 +395,7 @@ async def set_menu_button(bot: Bot):
 
 
 async def menu():
-    bot = Bot(token=BOT_TOKEN)
+    bot = create_bot()
 
     # Set commands and menu button
     await set_bot_commands(bot)
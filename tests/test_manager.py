@@ -0,0 +1,86 @@
+"""
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Every test gets a database of its own, see setUp
+folder = tempfile.TemporaryDirectory()
+os.environ["SQL_DATABASE_PATH"] = os.path.join(folder.name, "results.db")
+os.environ.setdefault("INTERVAL", "60")
+os.environ.setdefault("LOG_MODE", "none")
+
+import manager as m
+
+
+def results(percentage: str, date: str = "01.01.2025") -> list[dict]:
+    return [
+        {
+            "name": "Lecture",
+            "exams": [{"name": "Exam", "percentage": percentage, "date": date}],
+        }
+    ]
+
+
+class MergeResultsTest(unittest.TestCase):
+    """
+    Polls two accounts of a department the way Manager.poll does.
+    """
+
+    def setUp(self):
+        if os.path.exists(m.SQL_DATABASE_PATH):
+            os.remove(m.SQL_DATABASE_PATH)
+        m.initializeDatabase()
+        m.upsert_data("CS", [{"name": "Lecture", "exams": []}])
+        lecture_id = m.get_catalog()[1][0][0]
+        m.add_lecture_notification(lecture_id, "1")
+        self.snapshots = {}
+
+    def poll(self, name: str, polled: list[dict]) -> None:
+        merged = m.merge_results(polled, self.snapshots.get(name, {}))
+        m.upsert_data("CS", merged)
+        self.snapshots[name] = m.snapshot(polled)
+
+    def saved(self) -> tuple[str, str]:
+        conn = m.connect()
+        row = conn.execute("SELECT percentage, date FROM Exams").fetchone()
+        conn.close()
+        return row
+
+    def notifications(self) -> int:
+        conn = m.connect()
+        count = conn.execute("SELECT COUNT(*) FROM Outbox").fetchone()[0]
+        conn.close()
+        return count
+
+    def test_first_sighting_is_saved_when_another_account_saw_something_else(self):
+        self.poll("a", results("40"))
+        # The other account's next poll failed, or it was removed, before it saw "60"
+        self.poll("b", results("60"))
+        self.assertEqual(self.saved(), ("60", "01.01.2025"))
+        self.assertEqual(self.notifications(), 2)
+        self.poll("b", results("60"))
+        self.assertEqual(self.notifications(), 2)
+
+    def test_first_sighting_of_a_saved_value_is_not_notified_again(self):
+        self.poll("a", results("40"))
+        self.poll("b", results("40"))
+        self.assertEqual(self.notifications(), 1)
+
+    def test_account_that_still_sees_the_old_value_does_not_revert_it(self):
+        self.poll("a", results("40"))
+        self.poll("b", results("40"))
+        self.poll("a", results("60"))
+        self.poll("b", results("40"))
+        self.assertEqual(self.saved(), ("60", "01.01.2025"))
+        self.assertEqual(self.notifications(), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
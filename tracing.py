@@ -0,0 +1,202 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from functools import wraps
+from global_variables import (
+    get_logger,
+    TRACE_ENABLED,
+    PROFILE_ENABLED,
+    TRACE_DIR,
+    TRACE_DUMP_INTERVAL,
+)
+
+logger = get_logger("tracing")
+
+# How many spans are kept in memory between dumps, older ones are dropped
+MAX_SPANS = 100000
+# How often the sampling profiler looks at the threads, in seconds
+SAMPLE_INTERVAL = 0.01
+
+spans: deque = deque(maxlen=MAX_SPANS)
+thread_names: dict[int, str] = {}
+# Every span is measured relative to this, Chrome traces use microseconds
+origin = time.perf_counter()
+
+
+@contextmanager
+def span(name: str, **args):
+    """
+    Records how long the body of the with statement takes as a span in the trace.
+    Does nothing unless TRACE_ENABLED is set.
+    """
+    if not TRACE_ENABLED:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, start_time, time.perf_counter(), args)
+
+
+def traced(name: str = None):
+    """
+    Decorator that records every call to the decorated function as a span.
+    The function is returned untouched unless TRACE_ENABLED is set.
+    """
+
+    def decorator(function):
+        if not TRACE_ENABLED:
+            return function
+        span_name = name or function.__qualname__
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(span_name, start_time, time.perf_counter(), None)
+
+        return wrapper
+
+    return decorator
+
+
+def record(name: str, start_time: float, end_time: float, args: dict) -> None:
+    thread = threading.current_thread()
+    thread_names[thread.ident] = thread.name
+    event = {
+        "name": name,
+        "ph": "X",
+        "ts": (start_time - origin) * 1e6,
+        "dur": (end_time - start_time) * 1e6,
+        "pid": os.getpid(),
+        "tid": thread.ident,
+    }
+    if args:
+        event["args"] = args
+    # Appending to a deque is thread-safe
+    spans.append(event)
+
+
+def export_chrome_trace(path: str) -> int:
+    """
+    Writes the recorded spans to "path" in Chrome's trace event format, which can be opened
+    in chrome://tracing or https://ui.perfetto.dev, and forgets them. Returns the span count.
+    """
+    events = []
+    while spans:
+        events.append(spans.popleft())
+    metadata = [
+        {
+            "name": "thread_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": ident,
+            "args": {"name": name},
+        }
+        for ident, name in list(thread_names.items())
+    ]
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({"traceEvents": metadata + events}, file)
+    return len(events)
+
+
+class SamplingProfiler:
+    """
+    Periodically samples the stack of every thread in the process.
+    The samples are written in the collapsed stack format, which flamegraph.pl and
+    https://www.speedscope.app can read.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples: Counter[str] = Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def run(self) -> None:
+        own_ident = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                with self.lock:
+                    self.samples[";".join(reversed(stack))] += 1
+
+    def dump(self, path: str) -> int:
+        """
+        Writes the samples taken since the last dump to "path". Returns the sample count.
+        """
+        with self.lock:
+            samples, self.samples = self.samples, Counter()
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in samples.most_common():
+                file.write(f"{stack} {count}\n")
+        return sum(samples.values())
+
+
+profiler: SamplingProfiler = None
+
+
+def dump() -> None:
+    """
+    Writes the spans and profiler samples gathered since the last dump into TRACE_DIR.
+    """
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+    if spans:
+        path = f"{TRACE_DIR}/trace_{timestamp}.json"
+        count = export_chrome_trace(path)
+        logger.info(f'Wrote {count} spans to "{path}".')
+    if profiler is not None and profiler.samples:
+        path = f"{TRACE_DIR}/profile_{timestamp}.txt"
+        count = profiler.dump(path)
+        logger.info(f'Wrote {count} profiler samples to "{path}".')
+
+
+def start() -> None:
+    """
+    Starts the sampling profiler if PROFILE_ENABLED is set, and writes the traces and
+    profiles every TRACE_DUMP_INTERVAL seconds and when the process exits.
+    """
+    global profiler
+    if not TRACE_ENABLED and not PROFILE_ENABLED:
+        return
+    if PROFILE_ENABLED:
+        logger.info("Starting the sampling profiler.")
+        profiler = SamplingProfiler()
+        profiler.start()
+
+    def dump_periodically():
+        while True:
+            time.sleep(TRACE_DUMP_INTERVAL)
+            try:
+                dump()
+            except Exception as e:
+                logger.exception(f"Exception while writing traces, {e}")
+
+    threading.Thread(target=dump_periodically, name="tracing", daemon=True).start()
+    atexit.register(dump)